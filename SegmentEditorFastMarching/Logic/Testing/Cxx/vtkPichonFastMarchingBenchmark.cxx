@@ -0,0 +1,233 @@
+/*=auto=========================================================================
+
+  Portions (c) Copyright 2005 Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+  See COPYRIGHT.txt
+  or http://www.slicer.org/copyright/copyright.txt for details.
+
+=========================================================================auto=*/
+
+// Timings of vtkPichonFastMarching on a synthetic image. This is not run as a
+// test (it does not check anything), run it from the test driver:
+//
+//   vtkSlicerSegmentEditorFastMarchingModuleLogicCxxTests vtkPichonFastMarchingBenchmark [size] [percentMax]
+//
+// size is the number of voxels along each axis of the image (default 128),
+// percentMax is the volume reached by the front, in percent of the image (default 20).
+
+// EditorLib includes
+#include "vtkPichonFastMarching.h"
+
+// VTK includes
+#include <vtkImageData.h>
+#include <vtkNew.h>
+#include <vtkTimerLog.h>
+
+// STD includes
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <iostream>
+#include <random>
+#include <thread>
+
+namespace
+{
+
+/// Bright sphere in a darker background with noise, intensities are in [0, 300]
+void createTestImage(vtkImageData* image, int size)
+{
+  image->SetExtent(0, size-1, 0, size-1, 0, size-1);
+  image->AllocateScalars(VTK_SHORT, 1);
+  short* voxels = static_cast<short*>(image->GetScalarPointer());
+  std::mt19937 generator(1);
+  std::normal_distribution<double> noise(0.0, 5.0);
+  for (int k = 0; k < size; k++)
+    {
+    for (int j = 0; j < size; j++)
+      {
+      for (int i = 0; i < size; i++)
+        {
+        double r = sqrt((i-size/2.)*(i-size/2.) + (j-size/2.)*(j-size/2.) + (k-size/2.)*(k-size/2.));
+        double value = (r < size/4. ? 150.0 : 50.0) + noise(generator);
+        *(voxels++) = static_cast<short>(std::min(std::max(value, 0.0), 300.0));
+        }
+      }
+    }
+}
+
+/// 3x3x3 seed in the center of the image
+void createSeedImage(vtkImageData* seeds, int size)
+{
+  seeds->SetExtent(0, size-1, 0, size-1, 0, size-1);
+  seeds->AllocateScalars(VTK_SHORT, 1);
+  short* voxels = static_cast<short*>(seeds->GetScalarPointer());
+  for (int k = 0; k < size; k++)
+    {
+    for (int j = 0; j < size; j++)
+      {
+      for (int i = 0; i < size; i++)
+        {
+        bool seed = abs(i-size/2) <= 1 && abs(j-size/2) <= 1 && abs(k-size/2) <= 1;
+        *(voxels++) = seed ? 1 : 0;
+        }
+      }
+    }
+}
+
+struct MarchingResult
+{
+  /// time of the initialization pass, in seconds
+  double InitializationTime;
+  /// time of the evolution of the front, in seconds
+  double EvolutionTime;
+  vtkIdType NumberOfKnownPoints;
+};
+
+/// Median and inhomogeneity image where nothing has been computed yet
+void createStatisticsImage(vtkImageData* statistics, int size)
+{
+  statistics->SetExtent(0, size-1, 0, size-1, 0, size-1);
+  statistics->AllocateScalars(VTK_SHORT, 2);
+  short* voxels = static_cast<short*>(statistics->GetScalarPointer());
+  vtkIdType numberOfVoxels = static_cast<vtkIdType>(size) * size * size;
+  for (vtkIdType index = 0; index < numberOfVoxels; index++)
+    {
+    voxels[2*index] = 0;
+    voxels[2*index+1] = -1;
+    }
+}
+
+/// Run the filter the same way as the Fast Marching effect does.
+/// The arrival rank image is returned if arrivalRank is specified.
+MarchingResult runFastMarching(vtkImageData* input, vtkImageData* seeds, vtkIdType numberOfPoints,
+  int priorityQueueType, vtkImageData* arrivalRank = nullptr, vtkImageData* statistics = nullptr,
+  int numberOfThreads = 0, bool precomputeStatistics = true)
+{
+  int dims[3];
+  input->GetDimensions(dims);
+  vtkNew<vtkPichonFastMarching> fm;
+  fm->setPriorityQueueType(priorityQueueType);
+  fm->setNumberOfThreads(numberOfThreads);
+  fm->setPrecomputeStatistics(precomputeStatistics);
+  fm->init(dims[0], dims[1], dims[2], 300, 1, 1, 1);
+  fm->SetInputData(input);
+  fm->setStatisticsImage(statistics);
+  fm->setNPointsEvolution(numberOfPoints);
+  fm->setActiveLabel(1);
+  fm->addSeedsFromImage(seeds);
+
+  MarchingResult result;
+  double startTime = vtkTimerLog::GetUniversalTime();
+  fm->Update();
+  result.InitializationTime = vtkTimerLog::GetUniversalTime() - startTime;
+
+  fm->show(1);
+  fm->Modified();
+  startTime = vtkTimerLog::GetUniversalTime();
+  fm->Update();
+  result.EvolutionTime = vtkTimerLog::GetUniversalTime() - startTime;
+
+  result.NumberOfKnownPoints = fm->nKnownPoints();
+  if (arrivalRank)
+    {
+    fm->getArrivalRankImage(arrivalRank);
+    }
+  return result;
+}
+
+/// Fraction of the first n points reached by the front in rank1 that are also
+/// among the first n points in rank2
+double commonPointsRatio(vtkImageData* rank1, vtkImageData* rank2, vtkIdType n)
+{
+  int dims[3];
+  rank1->GetDimensions(dims);
+  vtkIdType numberOfVoxels = static_cast<vtkIdType>(dims[0]) * dims[1] * dims[2];
+  vtkIdType* ranks1 = static_cast<vtkIdType*>(rank1->GetScalarPointer());
+  vtkIdType* ranks2 = static_cast<vtkIdType*>(rank2->GetScalarPointer());
+  vtkIdType inFirst = 0;
+  vtkIdType inBoth = 0;
+  for (vtkIdType index = 0; index < numberOfVoxels; index++)
+    {
+    if (ranks1[index] > 0 && ranks1[index] <= n)
+      {
+      inFirst++;
+      if (ranks2[index] > 0 && ranks2[index] <= n)
+        {
+        inBoth++;
+        }
+      }
+    }
+  return inFirst > 0 ? double(inBoth) / inFirst : 1.0;
+}
+
+} // end of anonymous namespace
+
+//----------------------------------------------------------------------------
+int vtkPichonFastMarchingBenchmark(int argc, char* argv[])
+{
+  int size = (argc > 1) ? atoi(argv[1]) : 128;
+  double percentMax = (argc > 2) ? atof(argv[2]) : 20.0;
+  if (size < 8 || percentMax <= 0.0)
+    {
+    std::cerr << "Usage: vtkPichonFastMarchingBenchmark [size] [percentMax]" << std::endl;
+    return EXIT_FAILURE;
+    }
+
+  vtkNew<vtkImageData> input;
+  createTestImage(input, size);
+  vtkNew<vtkImageData> seeds;
+  createSeedImage(seeds, size);
+  vtkIdType numberOfPoints = static_cast<vtkIdType>(double(size) * size * size * percentMax / 100.0);
+  std::cout << "Image size: " << size << "^3, front volume: " << percentMax << "% (" << numberOfPoints << " voxels)" << std::endl;
+
+  // Priority queues
+  vtkNew<vtkImageData> heapRank;
+  MarchingResult heap = runFastMarching(input, seeds, numberOfPoints, vtkPichonFastMarching::PriorityQueueBinaryHeap, heapRank);
+  vtkNew<vtkImageData> bucketRank;
+  MarchingResult bucket = runFastMarching(input, seeds, numberOfPoints, vtkPichonFastMarching::PriorityQueueBucket, bucketRank);
+  std::cout << "Binary heap: evolution " << heap.EvolutionTime << "s, "
+    << heap.NumberOfKnownPoints / heap.EvolutionTime << " voxels/s" << std::endl;
+  std::cout << "Bucket queue: evolution " << bucket.EvolutionTime << "s, "
+    << bucket.NumberOfKnownPoints / bucket.EvolutionTime << " voxels/s, speedup "
+    << heap.EvolutionTime / bucket.EvolutionTime << std::endl;
+  for (double fraction : {0.1, 0.5, 1.0})
+    {
+    vtkIdType n = static_cast<vtkIdType>(fraction * heap.NumberOfKnownPoints);
+    std::cout << "  common points in the first " << n << " points: "
+      << 100.0 * commonPointsRatio(heapRank, bucketRank, n) << "%" << std::endl;
+    }
+
+  // Median and inhomogeneity of the neighborhood of the voxels: computed voxel by voxel
+  // when the front reaches them, precomputed in the initialization, then read from
+  // the statistics image written by the previous filter
+  vtkNew<vtkImageData> statistics;
+  createStatisticsImage(statistics, size);
+  MarchingResult computed = runFastMarching(input, seeds, numberOfPoints, vtkPichonFastMarching::PriorityQueueBinaryHeap,
+    nullptr, nullptr, 0, false);
+  MarchingResult precomputed = runFastMarching(input, seeds, numberOfPoints, vtkPichonFastMarching::PriorityQueueBinaryHeap,
+    nullptr, statistics);
+  MarchingResult reused = runFastMarching(input, seeds, numberOfPoints, vtkPichonFastMarching::PriorityQueueBinaryHeap,
+    nullptr, statistics);
+  double computedTime = computed.InitializationTime + computed.EvolutionTime;
+  for (const MarchingResult* result : { &computed, &precomputed, &reused })
+    {
+    double totalTime = result->InitializationTime + result->EvolutionTime;
+    std::cout << (result == &computed ? "Statistics computed by the front" :
+      result == &precomputed ? "Statistics precomputed" : "Statistics reused")
+      << ": initialization " << result->InitializationTime << "s, evolution " << result->EvolutionTime
+      << "s, total " << totalTime << "s, speedup " << computedTime / totalTime << std::endl;
+    }
+
+  // Whole-image passes of the initialization (including reading the statistics image).
+  // The times only show the scaling if the machine has enough cores.
+  std::cout << "Initialization with " << std::thread::hardware_concurrency() << " cores available:" << std::endl;
+  for (int numberOfThreads : {1, 4, 16, 32})
+    {
+    MarchingResult result = runFastMarching(input, seeds, numberOfPoints, vtkPichonFastMarching::PriorityQueueBinaryHeap,
+      nullptr, statistics, numberOfThreads);
+    std::cout << "  " << numberOfThreads << " threads: " << result.InitializationTime << "s" << std::endl;
+    }
+
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,153 @@
+/*=auto=========================================================================
+
+  Portions (c) Copyright 2005 Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+  See COPYRIGHT.txt
+  or http://www.slicer.org/copyright/copyright.txt for details.
+
+=========================================================================auto=*/
+
+// Continuing the evolution of a front must reach the same points in the same
+// order as a single evolution to the total number of points, if the update rate
+// of the statistics does not depend on the number of points of the evolution.
+
+// EditorLib includes
+#include "vtkPichonFastMarching.h"
+
+// VTK includes
+#include <vtkImageData.h>
+#include <vtkMath.h>
+#include <vtkNew.h>
+
+// STD includes
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <iostream>
+#include <random>
+#include <vector>
+
+namespace
+{
+
+const int SIZE = 32;
+const int STATISTICS_UPDATE_RATE = 50;
+
+/// Bright sphere (radius SIZE/4) in a darker background, with noise
+void createTestImage(vtkImageData* image)
+{
+  image->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  image->AllocateScalars(VTK_SHORT, 1);
+  short* voxels = static_cast<short*>(image->GetScalarPointer());
+  std::mt19937 generator(1);
+  std::normal_distribution<double> noise(0.0, 10.0);
+  for (int k = 0; k < SIZE; k++)
+    {
+    for (int j = 0; j < SIZE; j++)
+      {
+      for (int i = 0; i < SIZE; i++)
+        {
+        double r = sqrt((i-SIZE/2.)*(i-SIZE/2.) + (j-SIZE/2.)*(j-SIZE/2.) + (k-SIZE/2.)*(k-SIZE/2.));
+        double value = (r < SIZE/4. ? 150.0 : 50.0) + noise(generator);
+        *(voxels++) = static_cast<short>(std::min(std::max(value, 0.0), 300.0));
+        }
+      }
+    }
+}
+
+/// Grows the front from a 3x3x3 seed in the center of the image by each number
+/// of points in turn, continuing the previous evolution, and returns the arrival rank image.
+/// Returns false if the known points are not the known seeds and the points of the evolutions.
+bool runFastMarching(vtkImageData* input, const std::vector<vtkIdType>& numberOfPoints, int priorityQueueType,
+  vtkImageData* arrivalRank)
+{
+  vtkNew<vtkImageData> seeds;
+  seeds->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  seeds->AllocateScalars(VTK_SHORT, 1);
+  short* seedVoxels = static_cast<short*>(seeds->GetScalarPointer());
+  for (int k = 0; k < SIZE; k++)
+    {
+    for (int j = 0; j < SIZE; j++)
+      {
+      for (int i = 0; i < SIZE; i++)
+        {
+        bool seed = abs(i-SIZE/2) <= 1 && abs(j-SIZE/2) <= 1 && abs(k-SIZE/2) <= 1;
+        *(seedVoxels++) = seed ? 1 : 0;
+        }
+      }
+    }
+
+  vtkNew<vtkPichonFastMarching> fm;
+  fm->setPriorityQueueType(priorityQueueType);
+  fm->setStatisticsUpdateRate(STATISTICS_UPDATE_RATE);
+  fm->init(SIZE, SIZE, SIZE, 300, 1, 1, 1);
+  fm->SetInputData(input);
+  fm->setActiveLabel(1);
+  fm->addSeedsFromImage(seeds);
+  // the first update only initializes the filter
+  fm->Update();
+  vtkIdType totalNumberOfPoints = 0;
+  for (vtkIdType points : numberOfPoints)
+    {
+    // continue from the complete front, as the segment editor effect does
+    fm->show(1);
+    fm->setNPointsEvolution(points);
+    fm->Modified();
+    fm->Update();
+    totalNumberOfPoints += points;
+    }
+  fm->getArrivalRankImage(arrivalRank);
+
+  // some seeds are reached by the front of the neighboring seeds before they are planted
+  if (fm->nKnownSeeds() < 1 || fm->nKnownSeeds() > 27
+    || fm->nKnownPoints() - fm->nKnownSeeds() != totalNumberOfPoints)
+    {
+    std::cerr << fm->nKnownPoints() << " known points and " << fm->nKnownSeeds() << " known seeds after "
+      << totalNumberOfPoints << " points of evolution" << std::endl;
+    return false;
+    }
+  return true;
+}
+
+bool testContinue(int priorityQueueType)
+{
+  vtkNew<vtkImageData> input;
+  createTestImage(input);
+  // more than the volume of the sphere, so that the front reaches the background
+  vtkIdType numberOfPoints = static_cast<vtkIdType>(4.0/3.0*vtkMath::Pi()*pow(SIZE/4., 3)*1.5);
+
+  vtkNew<vtkImageData> singleRank;
+  vtkNew<vtkImageData> continuedRank;
+  if (!runFastMarching(input, { numberOfPoints }, priorityQueueType, singleRank)
+    || !runFastMarching(input, { numberOfPoints/5, numberOfPoints/2 - numberOfPoints/5, numberOfPoints - numberOfPoints/2 },
+      priorityQueueType, continuedRank))
+    {
+    return false;
+    }
+
+  const vtkIdType* singleRanks = static_cast<vtkIdType*>(singleRank->GetScalarPointer());
+  const vtkIdType* continuedRanks = static_cast<vtkIdType*>(continuedRank->GetScalarPointer());
+  for (vtkIdType index = 0; index < SIZE*SIZE*SIZE; index++)
+    {
+    if (singleRanks[index] != continuedRanks[index])
+      {
+      std::cerr << "Queue type " << priorityQueueType << ": voxel " << index << " has rank " << continuedRanks[index]
+        << " in the continued evolution, " << singleRanks[index] << " in the single evolution" << std::endl;
+      return false;
+      }
+    }
+  return true;
+}
+
+} // end of anonymous namespace
+
+//----------------------------------------------------------------------------
+int vtkPichonFastMarchingContinueTest(int vtkNotUsed(argc), char* vtkNotUsed(argv)[])
+{
+  if (!testContinue(vtkPichonFastMarching::PriorityQueueBinaryHeap)
+    || !testContinue(vtkPichonFastMarching::PriorityQueueBucket))
+    {
+    return EXIT_FAILURE;
+    }
+  return EXIT_SUCCESS;
+}
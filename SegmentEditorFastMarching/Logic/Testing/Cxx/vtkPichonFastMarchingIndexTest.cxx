@@ -0,0 +1,138 @@
+/*=auto=========================================================================
+
+  Portions (c) Copyright 2005 Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+  See COPYRIGHT.txt
+  or http://www.slicer.org/copyright/copyright.txt for details.
+
+=========================================================================auto=*/
+
+// The voxel index type follows the SegmentEditorFastMarching_USE_32BIT_INDEX
+// build option (FASTMARCHING_32BIT_INDEX) and init() refuses images that have
+// more voxels than the index type can address.
+
+// EditorLib includes
+#include "vtkPichonFastMarching.h"
+
+// VTK includes
+#include <vtkImageData.h>
+#include <vtkNew.h>
+
+// STD includes
+#include <climits>
+#include <cstdlib>
+#include <iostream>
+#include <vector>
+
+namespace
+{
+
+const int SIZE = 16;
+
+bool testIndexType()
+{
+#ifdef FASTMARCHING_32BIT_INDEX
+  const size_t expectedSize = sizeof(int);
+#else
+  const size_t expectedSize = sizeof(vtkIdType);
+#endif
+  if (sizeof(FMindex) != expectedSize)
+    {
+    std::cerr << "Voxel index has " << sizeof(FMindex) << " bytes, expected " << expectedSize << std::endl;
+    return false;
+    }
+  return true;
+}
+
+/// No per-voxel array must be allocated for an image that is too large
+bool testTooManyVoxels()
+{
+#ifdef FASTMARCHING_32BIT_INDEX
+  // 2^32 voxels
+  const int dims[3] = { 2048, 2048, 1024 };
+#else
+  const int dims[3] = { INT_MAX, INT_MAX, INT_MAX };
+#endif
+  vtkNew<vtkPichonFastMarching> fm;
+  vtkObject::GlobalWarningDisplayOff();
+  fm->init(dims[0], dims[1], dims[2], 300, 1, 1, 1);
+  vtkObject::GlobalWarningDisplayOn();
+  if (fm->memoryBytesPerVoxel() != 0.0)
+    {
+    std::cerr << "Image of " << dims[0] << "x" << dims[1] << "x" << dims[2] << " voxels accepted with "
+      << sizeof(FMindex)*8 << "-bit indices" << std::endl;
+    return false;
+    }
+  return true;
+}
+
+/// Each voxel reached by the front gets a distinct rank
+bool testArrivalRanks()
+{
+  vtkNew<vtkImageData> input;
+  input->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  input->AllocateScalars(VTK_SHORT, 1);
+  short* voxels = static_cast<short*>(input->GetScalarPointer());
+  vtkNew<vtkImageData> seeds;
+  seeds->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  seeds->AllocateScalars(VTK_SHORT, 1);
+  short* seedVoxels = static_cast<short*>(seeds->GetScalarPointer());
+  for (vtkIdType index = 0; index < SIZE*SIZE*SIZE; index++)
+    {
+    voxels[index] = static_cast<short>(100 + index % 7);
+    seedVoxels[index] = 0;
+    }
+  seedVoxels[SIZE/2 + SIZE*(SIZE/2) + SIZE*SIZE*(SIZE/2)] = 1;
+
+  vtkNew<vtkPichonFastMarching> fm;
+  fm->init(SIZE, SIZE, SIZE, 300, 1, 1, 1);
+  if (fm->memoryBytesPerVoxel() == 0.0)
+    {
+    std::cerr << "Image of " << SIZE << "^3 voxels refused" << std::endl;
+    return false;
+    }
+  const vtkIdType numberOfPoints = 500;
+  fm->SetInputData(input);
+  fm->setNPointsEvolution(numberOfPoints);
+  fm->setActiveLabel(1);
+  fm->addSeedsFromImage(seeds);
+  fm->Update();
+  fm->Modified();
+  fm->Update();
+  if (fm->nKnownPoints() != numberOfPoints + 1)
+    {
+    std::cerr << fm->nKnownPoints() << " known points, expected " << numberOfPoints + 1 << std::endl;
+    return false;
+    }
+
+  vtkNew<vtkImageData> arrivalRank;
+  fm->getArrivalRankImage(arrivalRank);
+  const vtkIdType* ranks = static_cast<vtkIdType*>(arrivalRank->GetScalarPointer());
+  std::vector<bool> rankFound(numberOfPoints + 1, false);
+  for (vtkIdType index = 0; index < SIZE*SIZE*SIZE; index++)
+    {
+    if (ranks[index] == 0)
+      {
+      continue;
+      }
+    if (ranks[index] < 1 || ranks[index] > numberOfPoints + 1 || rankFound[ranks[index] - 1])
+      {
+      std::cerr << "Voxel " << index << " has invalid or repeated rank " << ranks[index] << std::endl;
+      return false;
+      }
+    rankFound[ranks[index] - 1] = true;
+    }
+  return true;
+}
+
+} // end of anonymous namespace
+
+//----------------------------------------------------------------------------
+int vtkPichonFastMarchingIndexTest(int vtkNotUsed(argc), char* vtkNotUsed(argv)[])
+{
+  if (!testIndexType() || !testTooManyVoxels() || !testArrivalRanks())
+    {
+    return EXIT_FAILURE;
+    }
+  return EXIT_SUCCESS;
+}
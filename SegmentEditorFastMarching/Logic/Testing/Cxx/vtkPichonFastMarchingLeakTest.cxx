@@ -0,0 +1,183 @@
+/*=auto=========================================================================
+
+  Portions (c) Copyright 2005 Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+  See COPYRIGHT.txt
+  or http://www.slicer.org/copyright/copyright.txt for details.
+
+=========================================================================auto=*/
+
+// A front grown in a bright sphere that is connected to a large bright region
+// by a thin channel must stop when it reaches the boundary of the sphere if
+// leak detection is enabled: the leak onset is near the volume of the sphere,
+// the bright region is not reached before the onset, and marching stops soon
+// after it. Without leak detection the front grows far beyond the sphere.
+
+// EditorLib includes
+#include "vtkPichonFastMarching.h"
+
+// VTK includes
+#include <vtkImageData.h>
+#include <vtkNew.h>
+
+// STD includes
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <iostream>
+#include <random>
+
+namespace
+{
+
+const int SIZE = 48;
+const double SPHERE_RADIUS = 8.0;
+/// center of the sphere along the i axis, it is centered along the other axes
+const int SPHERE_CENTER = 14;
+/// the bright region is beyond this i index, it is connected to the sphere
+/// by a channel of one voxel along the i axis
+const int REGION_START = 30;
+const double LEAK_DETECTION_RATIO = 10.0;
+
+bool isInSphere(int i, int j, int k)
+{
+  return (i-SPHERE_CENTER)*(i-SPHERE_CENTER) + (j-SIZE/2)*(j-SIZE/2) + (k-SIZE/2)*(k-SIZE/2)
+    < SPHERE_RADIUS*SPHERE_RADIUS;
+}
+
+bool isInRegion(int i, int j, int k)
+{
+  return i >= REGION_START && i < SIZE-4 && j >= 4 && j < SIZE-4 && k >= 4 && k < SIZE-4;
+}
+
+/// Bright sphere, channel and region in a darker background, with noise
+void createTestImage(vtkImageData* image, vtkIdType& sphereVolume)
+{
+  image->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  image->AllocateScalars(VTK_SHORT, 1);
+  short* voxels = static_cast<short*>(image->GetScalarPointer());
+  std::mt19937 generator(1);
+  std::normal_distribution<double> noise(0.0, 5.0);
+  sphereVolume = 0;
+  for (int k = 0; k < SIZE; k++)
+    {
+    for (int j = 0; j < SIZE; j++)
+      {
+      for (int i = 0; i < SIZE; i++)
+        {
+        bool inChannel = i >= SPHERE_CENTER && i < REGION_START && j == SIZE/2 && k == SIZE/2;
+        bool bright = isInSphere(i, j, k) || inChannel || isInRegion(i, j, k);
+        double value = (bright ? 150.0 : 50.0) + noise(generator);
+        *(voxels++) = static_cast<short>(std::min(std::max(value, 0.0), 300.0));
+        if (isInSphere(i, j, k))
+          {
+          sphereVolume++;
+          }
+        }
+      }
+    }
+}
+
+/// Grows the front from the center of the sphere and returns the arrival rank image
+vtkIdType runFastMarching(vtkImageData* input, vtkIdType numberOfPoints, int priorityQueueType, double leakDetectionRatio,
+  vtkImageData* arrivalRank, vtkIdType& leakOnsetPoints)
+{
+  vtkNew<vtkImageData> seeds;
+  seeds->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  seeds->AllocateScalars(VTK_SHORT, 1);
+  short* seedVoxels = static_cast<short*>(seeds->GetScalarPointer());
+  std::fill(seedVoxels, seedVoxels+SIZE*SIZE*SIZE, 0);
+  seedVoxels[SPHERE_CENTER + SIZE*(SIZE/2) + SIZE*SIZE*(SIZE/2)] = 1;
+
+  vtkNew<vtkPichonFastMarching> fm;
+  fm->setPriorityQueueType(priorityQueueType);
+  fm->setLeakDetectionRatio(leakDetectionRatio);
+  fm->init(SIZE, SIZE, SIZE, 300, 1, 1, 1);
+  fm->SetInputData(input);
+  fm->setNPointsEvolution(numberOfPoints);
+  fm->setActiveLabel(1);
+  fm->addSeedsFromImage(seeds);
+  fm->Update();
+  fm->Modified();
+  fm->Update();
+  fm->getArrivalRankImage(arrivalRank);
+  leakOnsetPoints = fm->getLeakOnsetPoints();
+  return fm->nKnownPoints();
+}
+
+/// Number of voxels of the bright region with an arrival rank from 1 to maximumRank
+vtkIdType reachedInRegion(vtkImageData* arrivalRank, vtkIdType maximumRank)
+{
+  const vtkIdType* ranks = static_cast<vtkIdType*>(arrivalRank->GetScalarPointer());
+  vtkIdType reached = 0;
+  for (int k = 0; k < SIZE; k++)
+    {
+    for (int j = 0; j < SIZE; j++)
+      {
+      for (int i = 0; i < SIZE; i++)
+        {
+        vtkIdType rank = ranks[i + j*SIZE + k*SIZE*SIZE];
+        if (rank > 0 && rank <= maximumRank && isInRegion(i, j, k))
+          {
+          reached++;
+          }
+        }
+      }
+    }
+  return reached;
+}
+
+bool testLeak(int priorityQueueType)
+{
+  vtkNew<vtkImageData> input;
+  vtkIdType sphereVolume = 0;
+  createTestImage(input, sphereVolume);
+  vtkIdType numberOfPoints = 4 * sphereVolume;
+
+  // without leak detection the front grows far beyond the sphere
+  vtkNew<vtkImageData> arrivalRank;
+  vtkIdType leakOnsetPoints = 0;
+  vtkIdType knownPoints = runFastMarching(input, numberOfPoints, priorityQueueType, 0.0, arrivalRank, leakOnsetPoints);
+  if (leakOnsetPoints != 0 || knownPoints != numberOfPoints+1)
+    {
+    std::cerr << "Queue type " << priorityQueueType << ": without leak detection " << knownPoints
+      << " known points and leak onset " << leakOnsetPoints << ", expected " << numberOfPoints+1 << " and 0" << std::endl;
+    return false;
+    }
+
+  knownPoints = runFastMarching(input, numberOfPoints, priorityQueueType, LEAK_DETECTION_RATIO, arrivalRank, leakOnsetPoints);
+  // the front reaches the boundary of the sphere before filling it completely
+  if (leakOnsetPoints < sphereVolume/2 || leakOnsetPoints > sphereVolume)
+    {
+    std::cerr << "Queue type " << priorityQueueType << ": leak onset " << leakOnsetPoints
+      << ", sphere volume " << sphereVolume << std::endl;
+    return false;
+    }
+  // the leak is confirmed at most LEAK_CONFIRM_SPAN windows after the onset
+  vtkIdType windowSize = std::max<vtkIdType>(numberOfPoints/LEAK_WINDOWS, LEAK_MIN_WINDOW_SIZE);
+  if (knownPoints < leakOnsetPoints || knownPoints > leakOnsetPoints + LEAK_CONFIRM_SPAN*windowSize)
+    {
+    std::cerr << "Queue type " << priorityQueueType << ": " << knownPoints << " known points after a leak onset at "
+      << leakOnsetPoints << std::endl;
+    return false;
+    }
+  if (reachedInRegion(arrivalRank, leakOnsetPoints) != 0)
+    {
+    std::cerr << "Queue type " << priorityQueueType << ": the bright region is reached before the leak onset" << std::endl;
+    return false;
+    }
+  return true;
+}
+
+} // end of anonymous namespace
+
+//----------------------------------------------------------------------------
+int vtkPichonFastMarchingLeakTest(int vtkNotUsed(argc), char* vtkNotUsed(argv)[])
+{
+  if (!testLeak(vtkPichonFastMarching::PriorityQueueBinaryHeap)
+    || !testLeak(vtkPichonFastMarching::PriorityQueueBucket))
+    {
+    return EXIT_FAILURE;
+    }
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,175 @@
+/*=auto=========================================================================
+
+  Portions (c) Copyright 2005 Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+  See COPYRIGHT.txt
+  or http://www.slicer.org/copyright/copyright.txt for details.
+
+=========================================================================auto=*/
+
+// The front must never reach the voxels of the mask image. The extent of the
+// input does not start at 0 and the mask only covers a part of the input, as
+// when the segment editor effect marches in a region of the source volume.
+
+// EditorLib includes
+#include "vtkPichonFastMarching.h"
+
+// VTK includes
+#include <vtkImageData.h>
+#include <vtkNew.h>
+
+// STD includes
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <iostream>
+#include <random>
+
+namespace
+{
+
+const int SIZE = 32;
+/// first index of the input extent along each axis
+const int ORIGIN = 10;
+const int CENTER = ORIGIN + SIZE/2;
+
+void setInputExtent(vtkImageData* image)
+{
+  image->SetExtent(ORIGIN, ORIGIN+SIZE-1, ORIGIN, ORIGIN+SIZE-1, ORIGIN, ORIGIN+SIZE-1);
+}
+
+/// Uniform intensity with noise, so that only the mask holds back the front
+void createTestImage(vtkImageData* image)
+{
+  setInputExtent(image);
+  image->AllocateScalars(VTK_SHORT, 1);
+  short* voxels = static_cast<short*>(image->GetScalarPointer());
+  std::mt19937 generator(1);
+  std::normal_distribution<double> noise(100.0, 10.0);
+  for (vtkIdType index = 0; index < SIZE*SIZE*SIZE; index++)
+    {
+    voxels[index] = static_cast<short>(std::min(std::max(noise(generator), 0.0), 300.0));
+    }
+}
+
+/// Mask of the voxels whose (i, j, k) position is masked, with an extent that
+/// goes beyond the input on one side and only covers a part of it
+template <class IsMasked>
+void createMaskImage(vtkImageData* mask, IsMasked isMasked)
+{
+  mask->SetExtent(CENTER-8, ORIGIN+SIZE+4, ORIGIN, ORIGIN+SIZE-1, ORIGIN-2, ORIGIN+SIZE-1);
+  mask->AllocateScalars(VTK_UNSIGNED_CHAR, 1);
+  unsigned char* voxels = static_cast<unsigned char*>(mask->GetScalarPointer());
+  int* extent = mask->GetExtent();
+  for (int k = extent[4]; k <= extent[5]; k++)
+    {
+    for (int j = extent[2]; j <= extent[3]; j++)
+      {
+      for (int i = extent[0]; i <= extent[1]; i++)
+        {
+        *(voxels++) = isMasked(i, j, k) ? 1 : 0;
+        }
+      }
+    }
+}
+
+/// Grows the front from the center of the input, returns the number of known points.
+/// Returns -1 if a masked voxel was reached.
+template <class IsMasked>
+vtkIdType runFastMarching(vtkImageData* input, IsMasked isMasked, vtkIdType numberOfPoints, int priorityQueueType)
+{
+  vtkNew<vtkImageData> mask;
+  createMaskImage(mask, isMasked);
+  vtkNew<vtkImageData> seeds;
+  setInputExtent(seeds);
+  seeds->AllocateScalars(VTK_SHORT, 1);
+  short* seedVoxels = static_cast<short*>(seeds->GetScalarPointer());
+  std::fill(seedVoxels, seedVoxels+SIZE*SIZE*SIZE, 0);
+  seedVoxels[SIZE/2 + SIZE*(SIZE/2) + SIZE*SIZE*(SIZE/2)] = 1;
+
+  vtkNew<vtkPichonFastMarching> fm;
+  fm->setPriorityQueueType(priorityQueueType);
+  fm->init(SIZE, SIZE, SIZE, 300, 1, 1, 1);
+  fm->SetInputData(input);
+  fm->setMaskImage(mask);
+  fm->setNPointsEvolution(numberOfPoints);
+  fm->setActiveLabel(1);
+  fm->addSeedsFromImage(seeds);
+  fm->Update();
+  fm->Modified();
+  fm->Update();
+  fm->show(1);
+  fm->Modified();
+  fm->Update();
+
+  vtkNew<vtkImageData> arrivalRank;
+  fm->getArrivalRankImage(arrivalRank);
+  const vtkIdType* ranks = static_cast<vtkIdType*>(arrivalRank->GetScalarPointer());
+  const short* labels = static_cast<short*>(fm->GetOutput()->GetScalarPointer());
+  const int* maskExtent = mask->GetExtent();
+  for (int k = ORIGIN; k < ORIGIN+SIZE; k++)
+    {
+    for (int j = ORIGIN; j < ORIGIN+SIZE; j++)
+      {
+      for (int i = ORIGIN; i < ORIGIN+SIZE; i++)
+        {
+        bool inMask = i >= maskExtent[0] && i <= maskExtent[1] && j >= maskExtent[2] && j <= maskExtent[3]
+          && k >= maskExtent[4] && k <= maskExtent[5] && isMasked(i, j, k);
+        vtkIdType index = (i-ORIGIN) + (j-ORIGIN)*SIZE + (k-ORIGIN)*SIZE*SIZE;
+        if (inMask && (ranks[index] != 0 || labels[index] != 0))
+          {
+          std::cerr << "Queue type " << priorityQueueType << ": masked voxel (" << i << ", " << j << ", " << k
+            << ") has rank " << ranks[index] << " and label " << labels[index] << std::endl;
+          return -1;
+          }
+        }
+      }
+    }
+  return fm->nKnownPoints();
+}
+
+bool testMask(int priorityQueueType)
+{
+  vtkNew<vtkImageData> input;
+  createTestImage(input);
+
+  // a wall next to the seed, the front goes around it
+  auto isWall = [](int i, int j, int vtkNotUsed(k)) { return i == CENTER+2 && j > CENTER-8; };
+  vtkIdType numberOfPoints = SIZE*SIZE*SIZE/2;
+  vtkIdType knownPoints = runFastMarching(input, isWall, numberOfPoints, priorityQueueType);
+  if (knownPoints != numberOfPoints+1)
+    {
+    std::cerr << "Queue type " << priorityQueueType << ": " << knownPoints << " known points next to a wall, expected "
+      << numberOfPoints+1 << std::endl;
+    return false;
+    }
+
+  // the seed is enclosed in a box, the front stops when it is filled
+  const int radius = 4;
+  auto isBox = [radius](int i, int j, int k)
+    {
+    int distance = std::max(std::max(abs(i-CENTER), abs(j-CENTER)), abs(k-CENTER));
+    return distance == radius;
+    };
+  knownPoints = runFastMarching(input, isBox, numberOfPoints, priorityQueueType);
+  if (knownPoints != (2*radius-1)*(2*radius-1)*(2*radius-1))
+    {
+    std::cerr << "Queue type " << priorityQueueType << ": " << knownPoints << " known points in a box, expected "
+      << (2*radius-1)*(2*radius-1)*(2*radius-1) << std::endl;
+    return false;
+    }
+  return true;
+}
+
+} // end of anonymous namespace
+
+//----------------------------------------------------------------------------
+int vtkPichonFastMarchingMaskTest(int vtkNotUsed(argc), char* vtkNotUsed(argv)[])
+{
+  if (!testMask(vtkPichonFastMarching::PriorityQueueBinaryHeap)
+    || !testMask(vtkPichonFastMarching::PriorityQueueBucket))
+    {
+    return EXIT_FAILURE;
+    }
+  return EXIT_SUCCESS;
+}
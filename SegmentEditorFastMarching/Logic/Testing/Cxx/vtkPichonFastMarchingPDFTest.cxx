@@ -0,0 +1,136 @@
+/*=auto=========================================================================
+
+  Portions (c) Copyright 2005 Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+  See COPYRIGHT.txt
+  or http://www.slicer.org/copyright/copyright.txt for details.
+
+=========================================================================auto=*/
+
+// The smoothed histogram of PichonFastMarchingPDF is updated incrementally
+// (only the bins that changed are added) while the smoothing kernel is kept.
+// It must be the same as the histogram smoothed from scratch with that kernel,
+// including the far tails after many points were removed, and close to the
+// histogram smoothed with the kernel of the current variance.
+
+// EditorLib includes
+#include "vtkPichonFastMarchingPDF.h"
+
+// VTK includes
+#include <vtkSetGet.h>
+
+// STD includes
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <iostream>
+#include <random>
+#include <vector>
+
+namespace
+{
+
+const int REALIZATION_MAX = 300;
+const int MEMORY_SIZE = 2000;
+const int UPDATE_INTERVAL = 100;
+
+/// Histogram of the PDF smoothed from scratch with the Gaussian kernel of variance kernelSigma2
+std::vector<double> smoothHistogram(PichonFastMarchingPDF& pdf, double kernelSigma2)
+{
+  std::vector<double> smoothed(REALIZATION_MAX+1, 0.0);
+  for (int k = 0; k <= REALIZATION_MAX; k++)
+    {
+    double value = 0.0;
+    double coefSum = 0.0;
+    for (int j = 0; j <= REALIZATION_MAX; j++)
+      {
+      double coef = exp(-0.5*double((k-j)*(k-j))/kernelSigma2);
+      value += coef * pdf.bins[j];
+      coefSum += coef;
+      }
+    smoothed[k] = value / coefSum / pdf.nRealInBins;
+    }
+  return smoothed;
+}
+
+/// Points of a Gaussian distribution whose mean and width drift, so that old
+/// points are removed from the histogram, followed by a jump of the mean, so
+/// that the bins of the first points become far tails
+bool testIncrementalSmoothing()
+{
+  PichonFastMarchingPDF pdf(REALIZATION_MAX);
+  pdf.setMemory(MEMORY_SIZE);
+  // updates are triggered by the test
+  pdf.setUpdateRate(-1);
+
+  std::mt19937 generator(1);
+  int nIncrementalUpdates = 0;
+  for (int n = 1; n <= 40000; n++)
+    {
+    double mean = (n < 30000) ? 80.0 + n * 0.002 : 220.0;
+    double sigma = 8.0 + 4.0 * sin(n * 0.0005);
+    std::normal_distribution<double> distribution(mean, sigma);
+    int k = static_cast<int>(std::round(distribution(generator)));
+    pdf.addRealization(std::min(std::max(k, 0), REALIZATION_MAX));
+    if (n % UPDATE_INTERVAL != 0)
+      {
+      continue;
+      }
+
+    double previousKernelSigma2 = pdf.kernelSigma2;
+    pdf.update();
+    if (pdf.willUseGaussian())
+      {
+      continue;
+      }
+    if (pdf.kernelSigma2 == previousKernelSigma2)
+      {
+      nIncrementalUpdates++;
+      }
+
+    // same kernel: the same up to rounding errors
+    std::vector<double> sameKernel = smoothHistogram(pdf, pdf.kernelSigma2);
+    for (int bin = 0; bin <= REALIZATION_MAX; bin++)
+      {
+      double error = fabs(pdf.value(bin) - sameKernel[bin]);
+      if (error > 1e-6 * sameKernel[bin] + 1e-300)
+        {
+        std::cerr << "Point " << n << ": bin " << bin << " is " << pdf.value(bin) << ", smoothed from scratch "
+          << sameKernel[bin] << std::endl;
+        return false;
+        }
+      }
+
+    // kernel of the current variance: the width of the kernel differs by less than PDF_KERNEL_TOLERANCE/2
+    std::vector<double> currentKernel = smoothHistogram(pdf, pdf.sigma2SmoothPDF * pdf.getSigma2());
+    double maximum = *std::max_element(currentKernel.begin(), currentKernel.end());
+    for (int bin = 0; bin <= REALIZATION_MAX; bin++)
+      {
+      if (fabs(pdf.value(bin) - currentKernel[bin]) > 0.01 * maximum)
+        {
+        std::cerr << "Point " << n << ": bin " << bin << " is " << pdf.value(bin)
+          << ", smoothed with the kernel of the current variance " << currentKernel[bin] << std::endl;
+        return false;
+        }
+      }
+    }
+
+  if (nIncrementalUpdates == 0)
+    {
+    std::cerr << "The smoothed histogram was never updated incrementally" << std::endl;
+    return false;
+    }
+  return true;
+}
+
+} // end of anonymous namespace
+
+//----------------------------------------------------------------------------
+int vtkPichonFastMarchingPDFTest(int vtkNotUsed(argc), char* vtkNotUsed(argv)[])
+{
+  if (!testIncrementalSmoothing())
+    {
+    return EXIT_FAILURE;
+    }
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,217 @@
+/*=auto=========================================================================
+
+  Portions (c) Copyright 2005 Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+  See COPYRIGHT.txt
+  or http://www.slicer.org/copyright/copyright.txt for details.
+
+=========================================================================auto=*/
+
+// Compare the arrival of the front with the binary heap and the bucket
+// priority queue. The bucket queue does not sort the points of a bucket, so
+// arrival times may differ by up to one bucket width.
+
+// EditorLib includes
+#include "vtkPichonFastMarching.h"
+
+// VTK includes
+#include <vtkImageData.h>
+#include <vtkMath.h>
+#include <vtkNew.h>
+
+// STD includes
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <iostream>
+#include <random>
+
+namespace
+{
+
+const int SIZE = 32;
+
+/// Bright sphere (radius SIZE/4) in a darker background, with noise of the
+/// specified standard deviation. If noise is negative then the image is uniform.
+void createTestImage(vtkImageData* image, double noiseSigma)
+{
+  image->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  image->AllocateScalars(VTK_SHORT, 1);
+  short* voxels = static_cast<short*>(image->GetScalarPointer());
+  std::mt19937 generator(1);
+  std::normal_distribution<double> noise(0.0, std::max(noiseSigma, 1.0));
+  for (int k = 0; k < SIZE; k++)
+    {
+    for (int j = 0; j < SIZE; j++)
+      {
+      for (int i = 0; i < SIZE; i++)
+        {
+        double value = 100.0;
+        if (noiseSigma >= 0.0)
+          {
+          double r = sqrt((i-SIZE/2.)*(i-SIZE/2.) + (j-SIZE/2.)*(j-SIZE/2.) + (k-SIZE/2.)*(k-SIZE/2.));
+          value = (r < SIZE/4. ? 150.0 : 50.0) + noise(generator);
+          }
+        *(voxels++) = static_cast<short>(std::min(std::max(value, 0.0), 300.0));
+        }
+      }
+    }
+}
+
+/// Returns the arrival time image of the front that grows from a 3x3x3 seed
+/// in the center of the image until it reaches numberOfPoints voxels.
+void runFastMarching(vtkImageData* input, vtkIdType numberOfPoints, int priorityQueueType, vtkImageData* arrivalTime)
+{
+  vtkNew<vtkImageData> seeds;
+  seeds->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  seeds->AllocateScalars(VTK_SHORT, 1);
+  short* seedVoxels = static_cast<short*>(seeds->GetScalarPointer());
+  for (int k = 0; k < SIZE; k++)
+    {
+    for (int j = 0; j < SIZE; j++)
+      {
+      for (int i = 0; i < SIZE; i++)
+        {
+        bool seed = abs(i-SIZE/2) <= 1 && abs(j-SIZE/2) <= 1 && abs(k-SIZE/2) <= 1;
+        *(seedVoxels++) = seed ? 1 : 0;
+        }
+      }
+    }
+
+  vtkNew<vtkPichonFastMarching> fm;
+  fm->setPriorityQueueType(priorityQueueType);
+  fm->init(SIZE, SIZE, SIZE, 300, 1, 1, 1);
+  fm->SetInputData(input);
+  fm->setNPointsEvolution(numberOfPoints);
+  fm->setActiveLabel(1);
+  fm->addSeedsFromImage(seeds);
+  fm->Update();
+  fm->show(1);
+  fm->Modified();
+  fm->Update();
+  fm->getArrivalTimeImage(arrivalTime);
+}
+
+/// Fraction of the reached voxels that are inside the sphere
+double insideRatio(vtkImageData* arrivalTime)
+{
+  const float* times = static_cast<float*>(arrivalTime->GetScalarPointer());
+  vtkIdType reached = 0;
+  vtkIdType inside = 0;
+  for (int k = 0; k < SIZE; k++)
+    {
+    for (int j = 0; j < SIZE; j++)
+      {
+      for (int i = 0; i < SIZE; i++)
+        {
+        if (*(times++) >= INF)
+          {
+          continue;
+          }
+        reached++;
+        double r = sqrt((i-SIZE/2.)*(i-SIZE/2.) + (j-SIZE/2.)*(j-SIZE/2.) + (k-SIZE/2.)*(k-SIZE/2.));
+        if (r < SIZE/4.)
+          {
+          inside++;
+          }
+        }
+      }
+    }
+  return reached > 0 ? double(inside) / reached : 0.0;
+}
+
+/// With uniform speed, the arrival times must not differ by more than the automatic
+/// bucket width, which is half of the time needed to cross one voxel.
+bool testUniformImage()
+{
+  vtkNew<vtkImageData> input;
+  createTestImage(input, -1.0);
+  vtkIdType numberOfPoints = SIZE*SIZE*SIZE/10;
+  vtkNew<vtkImageData> heapTime;
+  runFastMarching(input, numberOfPoints, vtkPichonFastMarching::PriorityQueueBinaryHeap, heapTime);
+  vtkNew<vtkImageData> bucketTime;
+  runFastMarching(input, numberOfPoints, vtkPichonFastMarching::PriorityQueueBucket, bucketTime);
+
+  const float* heapTimes = static_cast<float*>(heapTime->GetScalarPointer());
+  const float* bucketTimes = static_cast<float*>(bucketTime->GetScalarPointer());
+  vtkIdType numberOfVoxels = SIZE*SIZE*SIZE;
+  double crossingTime = INF;
+  vtkIdType heapReached = 0;
+  vtkIdType bucketReached = 0;
+  for (vtkIdType index = 0; index < numberOfVoxels; index++)
+    {
+    if (heapTimes[index] < INF)
+      {
+      heapReached++;
+      if (heapTimes[index] > 0)
+        {
+        crossingTime = std::min(crossingTime, double(heapTimes[index]));
+        }
+      }
+    if (bucketTimes[index] < INF)
+      {
+      bucketReached++;
+      }
+    }
+  if (heapReached != bucketReached)
+    {
+    std::cerr << "Uniform image: the heap reached " << heapReached << " voxels, the buckets " << bucketReached << std::endl;
+    return false;
+    }
+
+  double maxDifference = 0.0;
+  for (vtkIdType index = 0; index < numberOfVoxels; index++)
+    {
+    if (heapTimes[index] < INF && bucketTimes[index] < INF)
+      {
+      maxDifference = std::max(maxDifference, fabs(double(heapTimes[index]) - bucketTimes[index]));
+      }
+    }
+  if (maxDifference > 0.5*crossingTime)
+    {
+    std::cerr << "Uniform image: arrival times differ by " << maxDifference
+      << ", more than the bucket width " << 0.5*crossingTime << std::endl;
+    return false;
+    }
+  return true;
+}
+
+/// The speed depends on statistics that are updated from the points reached so far,
+/// so the order cannot be compared point by point. Both queues must fill the sphere
+/// equally well.
+bool testNoisyImage(double noiseSigma)
+{
+  vtkNew<vtkImageData> input;
+  createTestImage(input, noiseSigma);
+  // volume of the sphere
+  vtkIdType numberOfPoints = static_cast<vtkIdType>(4.0/3.0*vtkMath::Pi()*pow(SIZE/4., 3));
+  vtkNew<vtkImageData> heapTime;
+  runFastMarching(input, numberOfPoints, vtkPichonFastMarching::PriorityQueueBinaryHeap, heapTime);
+  vtkNew<vtkImageData> bucketTime;
+  runFastMarching(input, numberOfPoints, vtkPichonFastMarching::PriorityQueueBucket, bucketTime);
+  double heapInside = insideRatio(heapTime);
+  double bucketInside = insideRatio(bucketTime);
+  if (bucketInside < heapInside - 0.1)
+    {
+    std::cerr << "Noisy image (sigma=" << noiseSigma << "): " << bucketInside
+      << " of the voxels reached with buckets are inside the sphere, " << heapInside << " with the heap" << std::endl;
+    return false;
+    }
+  return true;
+}
+
+} // end of anonymous namespace
+
+//----------------------------------------------------------------------------
+int vtkPichonFastMarchingQueueTest(int vtkNotUsed(argc), char* vtkNotUsed(argv)[])
+{
+  if (!testUniformImage())
+    {
+    return EXIT_FAILURE;
+    }
+  if (!testNoisyImage(5.0) || !testNoisyImage(20.0))
+    {
+    return EXIT_FAILURE;
+    }
+  return EXIT_SUCCESS;
+}
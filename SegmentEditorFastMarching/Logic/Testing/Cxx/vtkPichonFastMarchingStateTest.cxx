@@ -0,0 +1,414 @@
+/*=auto=========================================================================
+
+  Portions (c) Copyright 2005 Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+  See COPYRIGHT.txt
+  or http://www.slicer.org/copyright/copyright.txt for details.
+
+=========================================================================auto=*/
+
+// Check the voxel state of the filter, which is stored in separate compact
+// arrays (arrival time, 4-bit status shared by two voxels, minheap position,
+// front label). The image has an odd number of voxels per row and in total,
+// so that voxel pairs sharing a status byte span rows and the last byte is
+// only half used. A background update must leave the filter in the same
+// state as Update(), show() must report the region of the output it changed,
+// and a new expansion must not depend on the number of threads.
+
+// EditorLib includes
+#include "vtkPichonFastMarching.h"
+
+// VTK includes
+#include <vtkImageData.h>
+#include <vtkMath.h>
+#include <vtkNew.h>
+
+// STD includes
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <iostream>
+#include <random>
+#include <vector>
+
+namespace
+{
+
+const int SIZE = 31;
+
+/// Bright sphere (radius SIZE/4) in a darker background, with noise
+void createTestImage(vtkImageData* image)
+{
+  image->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  image->AllocateScalars(VTK_SHORT, 1);
+  short* voxels = static_cast<short*>(image->GetScalarPointer());
+  std::mt19937 generator(1);
+  std::normal_distribution<double> noise(0.0, 10.0);
+  for (int k = 0; k < SIZE; k++)
+    {
+    for (int j = 0; j < SIZE; j++)
+      {
+      for (int i = 0; i < SIZE; i++)
+        {
+        double r = sqrt((i-SIZE/2)*(i-SIZE/2) + (j-SIZE/2)*(j-SIZE/2) + (k-SIZE/2)*(k-SIZE/2));
+        double value = (r < SIZE/4. ? 150.0 : 50.0) + noise(generator);
+        *(voxels++) = static_cast<short>(std::min(std::max(value, 0.0), 300.0));
+        }
+      }
+    }
+}
+
+/// Single seed voxel in the center of the image, on an odd index so that it
+/// shares a status byte with its left neighbor
+void createSeedImage(vtkImageData* seeds)
+{
+  seeds->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  seeds->AllocateScalars(VTK_SHORT, 1);
+  short* seedVoxels = static_cast<short*>(seeds->GetScalarPointer());
+  std::fill(seedVoxels, seedVoxels+SIZE*SIZE*SIZE, 0);
+  seedVoxels[SIZE/2 + SIZE*(SIZE/2) + SIZE*SIZE*(SIZE/2)] = 1;
+}
+
+/// Memory of the per-voxel arrays: arrival time (4 bytes), status (4 bits),
+/// median and inhomogeneity (2+2 bytes), minheap position (4 bytes, only with
+/// the heap) and front label (1 byte, only in multi-label mode).
+bool testMemoryBytesPerVoxel()
+{
+  const double expected[2][2] = { { 12.5, 13.5 }, { 8.5, 9.5 } };
+  const int queueTypes[2] = { vtkPichonFastMarching::PriorityQueueBinaryHeap, vtkPichonFastMarching::PriorityQueueBucket };
+  for (int queue = 0; queue < 2; queue++)
+    {
+    for (int multiLabel = 0; multiLabel < 2; multiLabel++)
+      {
+      vtkNew<vtkPichonFastMarching> fm;
+      fm->setPriorityQueueType(queueTypes[queue]);
+      fm->setMultiLabel(multiLabel != 0);
+      fm->init(SIZE, SIZE, SIZE, 300, 1, 1, 1);
+      if (fm->memoryBytesPerVoxel() != expected[queue][multiLabel])
+        {
+        std::cerr << "Queue type " << queueTypes[queue] << ", multi-label " << multiLabel << ": "
+          << fm->memoryBytesPerVoxel() << " bytes per voxel, expected " << expected[queue][multiLabel] << std::endl;
+        return false;
+        }
+      }
+    }
+  return true;
+}
+
+/// The points reached by the front must have a finite arrival time and an
+/// arrival rank, must be shown in the output, and all the other voxels must not.
+bool testReachedPoints(int priorityQueueType)
+{
+  vtkNew<vtkImageData> input;
+  createTestImage(input);
+
+  vtkNew<vtkImageData> seeds;
+  createSeedImage(seeds);
+
+  vtkIdType numberOfPoints = static_cast<vtkIdType>(4.0/3.0*vtkMath::Pi()*pow(SIZE/4., 3));
+  vtkNew<vtkPichonFastMarching> fm;
+  fm->setPriorityQueueType(priorityQueueType);
+  fm->init(SIZE, SIZE, SIZE, 300, 1, 1, 1);
+  fm->SetInputData(input);
+  fm->setNPointsEvolution(numberOfPoints);
+  fm->setActiveLabel(1);
+  fm->addSeedsFromImage(seeds);
+  // the first update only initializes the filter, the second one grows the front
+  fm->Update();
+  fm->Modified();
+  fm->Update();
+  // the output is written by show()
+  fm->show(1);
+  fm->Modified();
+  fm->Update();
+
+  vtkNew<vtkImageData> arrivalTime;
+  fm->getArrivalTimeImage(arrivalTime);
+  vtkNew<vtkImageData> arrivalRank;
+  fm->getArrivalRankImage(arrivalRank);
+  const float* times = static_cast<float*>(arrivalTime->GetScalarPointer());
+  const vtkIdType* ranks = static_cast<vtkIdType*>(arrivalRank->GetScalarPointer());
+  const short* labels = static_cast<short*>(fm->GetOutput()->GetScalarPointer());
+
+  // the seed is known before the evolution starts
+  if (fm->nKnownPoints() != numberOfPoints+1)
+    {
+    std::cerr << "Queue type " << priorityQueueType << ": " << fm->nKnownPoints()
+      << " known points, expected " << numberOfPoints+1 << std::endl;
+    return false;
+    }
+
+  vtkIdType reached = 0;
+  std::vector<bool> rankFound(numberOfPoints+2, false);
+  for (vtkIdType index = 0; index < SIZE*SIZE*SIZE; index++)
+    {
+    bool hasTime = times[index] < INF;
+    bool hasRank = ranks[index] > 0;
+    if (hasTime != hasRank || hasRank != (labels[index] == 1))
+      {
+      std::cerr << "Queue type " << priorityQueueType << ": voxel " << index << " has arrival time " << times[index]
+        << ", rank " << ranks[index] << " and label " << labels[index] << std::endl;
+      return false;
+      }
+    if (!hasRank)
+      {
+      continue;
+      }
+    if (ranks[index] > numberOfPoints+1 || rankFound[ranks[index]])
+      {
+      std::cerr << "Queue type " << priorityQueueType << ": invalid or duplicate rank " << ranks[index] << std::endl;
+      return false;
+      }
+    rankFound[ranks[index]] = true;
+    reached++;
+    }
+  if (reached != fm->nKnownPoints())
+    {
+    std::cerr << "Queue type " << priorityQueueType << ": " << reached << " voxels reached, "
+      << fm->nKnownPoints() << " known points" << std::endl;
+    return false;
+    }
+
+  // the front never reaches the band at the image boundary
+  int extent[6];
+  fm->getKnownPointsExtent(extent);
+  for (int axis = 0; axis < 3; axis++)
+    {
+    if (extent[axis*2] < BAND_OUT || extent[axis*2+1] >= SIZE-BAND_OUT)
+      {
+      std::cerr << "Queue type " << priorityQueueType << ": known points extent " << extent[axis*2]
+        << ".." << extent[axis*2+1] << " along axis " << axis << " is in the boundary band" << std::endl;
+      return false;
+      }
+    }
+  return true;
+}
+
+/// The extent reported by getShowModifiedExtent() must be the bounding box of
+/// the output voxels changed by the last show(), as the segment editor effect
+/// only updates that region of the segment when the volume slider is moved.
+bool testShowModifiedExtent()
+{
+  vtkNew<vtkImageData> input;
+  createTestImage(input);
+  vtkNew<vtkImageData> seeds;
+  createSeedImage(seeds);
+
+  vtkNew<vtkPichonFastMarching> fm;
+  fm->init(SIZE, SIZE, SIZE, 300, 1, 1, 1);
+  fm->SetInputData(input);
+  fm->setNPointsEvolution(static_cast<vtkIdType>(4.0/3.0*vtkMath::Pi()*pow(SIZE/4., 3)));
+  fm->setActiveLabel(1);
+  fm->addSeedsFromImage(seeds);
+  fm->Update();
+  fm->Modified();
+  fm->Update();
+
+  std::vector<short> previousLabels(SIZE*SIZE*SIZE, 0);
+  for (float r : { 0.5f, 0.5f, 1.0f, 0.8f, 0.1f, 0.3f })
+    {
+    fm->show(r);
+    fm->Modified();
+    fm->Update();
+    const short* labels = static_cast<short*>(fm->GetOutput()->GetScalarPointer());
+    int expectedExtent[6] = { 0, -1, 0, -1, 0, -1 };
+    for (int k = 0; k < SIZE; k++)
+      {
+      for (int j = 0; j < SIZE; j++)
+        {
+        for (int i = 0; i < SIZE; i++)
+          {
+          vtkIdType index = i + j*SIZE + k*SIZE*SIZE;
+          if (labels[index] == previousLabels[index])
+            {
+            continue;
+            }
+          const int ijk[3] = { i, j, k };
+          for (int axis = 0; axis < 3; axis++)
+            {
+            if (expectedExtent[axis*2] > expectedExtent[axis*2+1])
+              {
+              expectedExtent[axis*2] = expectedExtent[axis*2+1] = ijk[axis];
+              }
+            expectedExtent[axis*2] = std::min(expectedExtent[axis*2], ijk[axis]);
+            expectedExtent[axis*2+1] = std::max(expectedExtent[axis*2+1], ijk[axis]);
+            }
+          }
+        }
+      }
+    previousLabels.assign(labels, labels+SIZE*SIZE*SIZE);
+
+    int extent[6];
+    fm->getShowModifiedExtent(extent);
+    bool emptyExpected = expectedExtent[0] > expectedExtent[1];
+    bool empty = extent[0] > extent[1];
+    if (empty != emptyExpected || (!empty && !std::equal(extent, extent+6, expectedExtent)))
+      {
+      std::cerr << "show(" << r << ") modified extent is " << extent[0] << ".." << extent[1] << ", "
+        << extent[2] << ".." << extent[3] << ", " << extent[4] << ".." << extent[5] << ", changed voxels are in "
+        << expectedExtent[0] << ".." << expectedExtent[1] << ", " << expectedExtent[2] << ".." << expectedExtent[3]
+        << ", " << expectedExtent[4] << ".." << expectedExtent[5] << std::endl;
+      return false;
+      }
+    }
+  return true;
+}
+
+/// A background update must reach the same points as Update(). The input is
+/// copied (and the copy is included in the memory usage) only if it is enabled.
+bool testBackgroundUpdate(bool copyInput)
+{
+  vtkNew<vtkImageData> input;
+  createTestImage(input);
+  vtkNew<vtkImageData> seeds;
+  createSeedImage(seeds);
+
+  vtkIdType numberOfPoints = static_cast<vtkIdType>(4.0/3.0*vtkMath::Pi()*pow(SIZE/4., 3));
+  vtkNew<vtkImageData> arrivalRank[2];
+  double bytesPerVoxel[2] = { 0.0, 0.0 };
+  for (int background = 0; background < 2; background++)
+    {
+    vtkNew<vtkPichonFastMarching> fm;
+    fm->setCopyInput(copyInput);
+    fm->init(SIZE, SIZE, SIZE, 300, 1, 1, 1);
+    fm->SetInputData(input);
+    fm->setNPointsEvolution(numberOfPoints);
+    fm->setActiveLabel(1);
+    fm->addSeedsFromImage(seeds);
+    for (int update = 0; update < 2; update++)
+      {
+      fm->Modified();
+      if (background)
+        {
+        fm->startBackgroundUpdate();
+        fm->waitForBackgroundUpdate();
+        }
+      else
+        {
+        fm->Update();
+        }
+      }
+    if (background && (fm->GetInput() == input.GetPointer()) == copyInput)
+      {
+      std::cerr << "Copy input " << copyInput << ": the input of the background update is "
+        << (copyInput ? "not " : "") << "copied" << std::endl;
+      return false;
+      }
+    fm->getArrivalRankImage(arrivalRank[background]);
+    bytesPerVoxel[background] = fm->memoryBytesPerVoxel();
+    }
+
+  double expectedBytesPerVoxel = bytesPerVoxel[0] + (copyInput ? input->GetScalarSize() : 0);
+  if (bytesPerVoxel[1] != expectedBytesPerVoxel)
+    {
+    std::cerr << "Copy input " << copyInput << ": " << bytesPerVoxel[1] << " bytes per voxel after the background update, expected "
+      << expectedBytesPerVoxel << std::endl;
+    return false;
+    }
+  const vtkIdType* ranks = static_cast<vtkIdType*>(arrivalRank[0]->GetScalarPointer());
+  const vtkIdType* backgroundRanks = static_cast<vtkIdType*>(arrivalRank[1]->GetScalarPointer());
+  for (vtkIdType index = 0; index < SIZE*SIZE*SIZE; index++)
+    {
+    if (ranks[index] != backgroundRanks[index])
+      {
+      std::cerr << "Copy input " << copyInput << ": voxel " << index << " has rank " << backgroundRanks[index]
+        << " after the background update, " << ranks[index] << " after Update()" << std::endl;
+      return false;
+      }
+    }
+  return true;
+}
+
+/// A new expansion from the output of the filter must not depend on the
+/// number of threads that collect the seeds and the statistics of the label.
+bool testNewExpansion()
+{
+  vtkNew<vtkImageData> input;
+  createTestImage(input);
+  vtkNew<vtkImageData> seeds;
+  createSeedImage(seeds);
+
+  vtkIdType numberOfPoints = static_cast<vtkIdType>(4.0/3.0*vtkMath::Pi()*pow(SIZE/4., 3));
+  const int numberOfThreads[2] = { 1, 4 };
+  vtkIdType numberOfSeeds[2] = { 0, 0 };
+  vtkNew<vtkImageData> arrivalRank[2];
+  for (int run = 0; run < 2; run++)
+    {
+    vtkNew<vtkPichonFastMarching> fm;
+    fm->setNumberOfThreads(numberOfThreads[run]);
+    fm->init(SIZE, SIZE, SIZE, 300, 1, 1, 1);
+    fm->SetInputData(input);
+    fm->setNPointsEvolution(numberOfPoints/2);
+    fm->setActiveLabel(1);
+    fm->addSeedsFromImage(seeds);
+    fm->Update();
+    fm->Modified();
+    fm->Update();
+    fm->show(1);
+    fm->Modified();
+    fm->Update();
+
+    // grow a new front from the boundary of the output
+    fm->initNewExpansion();
+    numberOfSeeds[run] = fm->nValidSeeds();
+    fm->setNPointsEvolution(numberOfPoints/2);
+    fm->Modified();
+    fm->Update();
+    fm->getArrivalRankImage(arrivalRank[run]);
+    }
+
+  if (numberOfSeeds[0] == 0 || numberOfSeeds[0] != numberOfSeeds[1])
+    {
+    std::cerr << "New expansion: " << numberOfSeeds[0] << " seeds with " << numberOfThreads[0] << " thread, "
+      << numberOfSeeds[1] << " with " << numberOfThreads[1] << " threads" << std::endl;
+    return false;
+    }
+  const vtkIdType* ranks[2] = { static_cast<vtkIdType*>(arrivalRank[0]->GetScalarPointer()),
+    static_cast<vtkIdType*>(arrivalRank[1]->GetScalarPointer()) };
+  vtkIdType reached = 0;
+  for (vtkIdType index = 0; index < SIZE*SIZE*SIZE; index++)
+    {
+    if (ranks[0][index] != ranks[1][index])
+      {
+      std::cerr << "New expansion: voxel " << index << " has rank " << ranks[1][index] << " with "
+        << numberOfThreads[1] << " threads, " << ranks[0][index] << " with " << numberOfThreads[0] << std::endl;
+      return false;
+      }
+    reached += (ranks[0][index] > 0);
+    }
+  if (reached == 0)
+    {
+    std::cerr << "New expansion: no voxel reached" << std::endl;
+    return false;
+    }
+  return true;
+}
+
+} // end of anonymous namespace
+
+//----------------------------------------------------------------------------
+int vtkPichonFastMarchingStateTest(int vtkNotUsed(argc), char* vtkNotUsed(argv)[])
+{
+  if (!testMemoryBytesPerVoxel())
+    {
+    return EXIT_FAILURE;
+    }
+  if (!testReachedPoints(vtkPichonFastMarching::PriorityQueueBinaryHeap)
+    || !testReachedPoints(vtkPichonFastMarching::PriorityQueueBucket))
+    {
+    return EXIT_FAILURE;
+    }
+  if (!testShowModifiedExtent())
+    {
+    return EXIT_FAILURE;
+    }
+  if (!testBackgroundUpdate(true) || !testBackgroundUpdate(false))
+    {
+    return EXIT_FAILURE;
+    }
+  if (!testNewExpansion())
+    {
+    return EXIT_FAILURE;
+    }
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,198 @@
+/*=auto=========================================================================
+
+  Portions (c) Copyright 2005 Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+  See COPYRIGHT.txt
+  or http://www.slicer.org/copyright/copyright.txt for details.
+
+=========================================================================auto=*/
+
+// The median and inhomogeneity of the voxels that are precomputed in the
+// initialization (sliding histogram of the intensity bins) must be the same
+// as the ones computed voxel by voxel when the front reaches the voxels.
+
+// EditorLib includes
+#include "vtkPichonFastMarching.h"
+
+// VTK includes
+#include <vtkDoubleArray.h>
+#include <vtkImageData.h>
+#include <vtkMath.h>
+#include <vtkNew.h>
+
+// STD includes
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <iostream>
+#include <random>
+
+namespace
+{
+
+const int SIZE = 29;
+
+/// Bright sphere (radius SIZE/4) in a darker background, with strong noise
+/// so that the order statistics change a lot between neighbor voxels
+template <class T>
+void createTestImage(vtkImageData* image, int scalarType, double maximum)
+{
+  image->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  image->AllocateScalars(scalarType, 1);
+  T* voxels = static_cast<T*>(image->GetScalarPointer());
+  std::mt19937 generator(1);
+  std::normal_distribution<double> noise(0.0, 40.0);
+  for (int k = 0; k < SIZE; k++)
+    {
+    for (int j = 0; j < SIZE; j++)
+      {
+      for (int i = 0; i < SIZE; i++)
+        {
+        double r = sqrt((i-SIZE/2)*(i-SIZE/2) + (j-SIZE/2)*(j-SIZE/2) + (k-SIZE/2)*(k-SIZE/2));
+        double value = (r < SIZE/4. ? 0.6 : 0.3) * maximum + noise(generator);
+        *(voxels++) = static_cast<T>(std::min(std::max(value, 0.0), maximum));
+        }
+      }
+    }
+}
+
+/// Median and inhomogeneity image where nothing has been computed yet
+void createStatisticsImage(vtkImageData* statistics)
+{
+  statistics->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  statistics->AllocateScalars(VTK_SHORT, 2);
+  short* voxels = static_cast<short*>(statistics->GetScalarPointer());
+  for (vtkIdType index = 0; index < SIZE*SIZE*SIZE; index++)
+    {
+    voxels[2*index] = 0;
+    voxels[2*index+1] = -1;
+    }
+}
+
+/// Grows the front from the center of the image, the median and inhomogeneity
+/// are written to the statistics image
+void runFastMarching(vtkImageData* input, vtkDoubleArray* intensityBinEdges, int depth, bool precomputeStatistics,
+  vtkImageData* statistics, vtkImageData* arrivalRank)
+{
+  vtkNew<vtkImageData> seeds;
+  seeds->SetExtent(0, SIZE-1, 0, SIZE-1, 0, SIZE-1);
+  seeds->AllocateScalars(VTK_SHORT, 1);
+  short* seedVoxels = static_cast<short*>(seeds->GetScalarPointer());
+  std::fill(seedVoxels, seedVoxels+SIZE*SIZE*SIZE, 0);
+  seedVoxels[SIZE/2 + SIZE*(SIZE/2) + SIZE*SIZE*(SIZE/2)] = 1;
+
+  vtkNew<vtkPichonFastMarching> fm;
+  fm->setPrecomputeStatistics(precomputeStatistics);
+  fm->init(SIZE, SIZE, SIZE, depth, 1, 1, 1);
+  fm->setIntensityBinEdges(intensityBinEdges);
+  fm->SetInputData(input);
+  fm->setStatisticsImage(statistics);
+  fm->setNPointsEvolution(static_cast<vtkIdType>(4.0/3.0*vtkMath::Pi()*pow(SIZE/4., 3)));
+  fm->setActiveLabel(1);
+  fm->addSeedsFromImage(seeds);
+  fm->Update();
+  fm->Modified();
+  fm->Update();
+  fm->getArrivalRankImage(arrivalRank);
+}
+
+/// If allPrecomputed is set then the statistics of all the voxels that the
+/// front can reach must be precomputed, otherwise (intensities out of the
+/// range of the bins) they may be left to be computed voxel by voxel.
+bool testStatistics(const char* name, vtkImageData* input, vtkDoubleArray* intensityBinEdges, int depth,
+  bool allPrecomputed)
+{
+  vtkNew<vtkImageData> statistics[2];
+  vtkNew<vtkImageData> arrivalRank[2];
+  for (int precompute = 0; precompute < 2; precompute++)
+    {
+    createStatisticsImage(statistics[precompute]);
+    runFastMarching(input, intensityBinEdges, depth, precompute != 0, statistics[precompute], arrivalRank[precompute]);
+    }
+
+  const short* computed = static_cast<short*>(statistics[0]->GetScalarPointer());
+  const short* precomputed = static_cast<short*>(statistics[1]->GetScalarPointer());
+  const vtkIdType* ranks = static_cast<vtkIdType*>(arrivalRank[0]->GetScalarPointer());
+  const vtkIdType* precomputedRanks = static_cast<vtkIdType*>(arrivalRank[1]->GetScalarPointer());
+  vtkIdType nComputed = 0;
+  for (int k = BAND_OUT; k < SIZE-BAND_OUT; k++)
+    {
+    for (int j = BAND_OUT; j < SIZE-BAND_OUT; j++)
+      {
+      for (int i = BAND_OUT; i < SIZE-BAND_OUT; i++)
+        {
+        vtkIdType index = i + j*SIZE + k*SIZE*SIZE;
+        if (allPrecomputed && precomputed[2*index+1] == -1)
+          {
+          std::cerr << name << ": statistics of voxel " << index << " are not precomputed" << std::endl;
+          return false;
+          }
+        if (computed[2*index+1] == -1 || precomputed[2*index+1] == -1)
+          {
+          continue;
+          }
+        if (computed[2*index] != precomputed[2*index] || computed[2*index+1] != precomputed[2*index+1])
+          {
+          std::cerr << name << ": voxel " << index << " has median " << precomputed[2*index]
+            << " and inhomogeneity " << precomputed[2*index+1] << " precomputed, " << computed[2*index]
+            << " and " << computed[2*index+1] << " computed by the front" << std::endl;
+          return false;
+          }
+        nComputed++;
+        }
+      }
+    }
+  if (nComputed == 0)
+    {
+    std::cerr << name << ": no statistics computed" << std::endl;
+    return false;
+    }
+
+  for (vtkIdType index = 0; index < SIZE*SIZE*SIZE; index++)
+    {
+    if (ranks[index] != precomputedRanks[index])
+      {
+      std::cerr << name << ": voxel " << index << " has rank " << precomputedRanks[index]
+        << " with precomputed statistics, " << ranks[index] << " without" << std::endl;
+      return false;
+      }
+    }
+  return true;
+}
+
+} // end of anonymous namespace
+
+//----------------------------------------------------------------------------
+int vtkPichonFastMarchingStatisticsTest(int vtkNotUsed(argc), char* vtkNotUsed(argv)[])
+{
+  // one bin per intensity value
+  vtkNew<vtkImageData> shortInput;
+  createTestImage<short>(shortInput, VTK_SHORT, 300.0);
+  if (!testStatistics("Short", shortInput, nullptr, 300, true))
+    {
+    return EXIT_FAILURE;
+    }
+
+  // intensities of a floating-point image in 100 bins
+  vtkNew<vtkImageData> floatInput;
+  createTestImage<float>(floatInput, VTK_FLOAT, 1000.0);
+  vtkNew<vtkDoubleArray> intensityBinEdges;
+  for (int bin = 1; bin < 100; bin++)
+    {
+    intensityBinEdges->InsertNextValue(bin * 10.0 + 0.5);
+    }
+  if (!testStatistics("Float", floatInput, intensityBinEdges, 99, true))
+    {
+    return EXIT_FAILURE;
+    }
+
+  // intensities beyond the depth are not binned, the statistics of the
+  // voxels around them are computed by the front if it reaches them
+  static_cast<short*>(shortInput->GetScalarPointer())[BAND_OUT*(1+SIZE+SIZE*SIZE)] = 1000;
+  if (!testStatistics("Out of range", shortInput, nullptr, 300, false))
+    {
+    return EXIT_FAILURE;
+    }
+
+  return EXIT_SUCCESS;
+}
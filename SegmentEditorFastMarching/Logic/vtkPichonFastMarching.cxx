@@ -16,19 +16,118 @@
 
 // VTK includes
 #include <vtkInformation.h>
+#include <vtkInformationVector.h>
 #include <vtkDataArray.h>
+#include <vtkDoubleArray.h>
 #include <vtkMath.h>
 #include <vtkObjectFactory.h>
 #include <vtkPointData.h>
+#include <vtkSMPTools.h>
 #include <vtkStreamingDemandDrivenPipeline.h>
 
+// STD includes
+#include <atomic>
+#include <climits>
+#include <cstring>
+#include <limits>
+#include <mutex>
+#include <thread>
+
+///////////////////////////////////////////////////////////////////////
+///////////////////////////////////////////////////////////////////////
+
+class vtkPichonFastMarching::vtkInternals
+{
+public:
+  std::thread BackgroundUpdateThread;
+  std::atomic<bool> BackgroundUpdateRunning{false};
+  std::atomic<double> Progress{0.0};
+
+  /// input of the background update, the caller may modify its own image meanwhile
+  vtkSmartPointer<vtkImageData> InputCopy;
+
+  /// output at the last preview, the output itself is only written by the filter
+  std::mutex PreviewMutex;
+  std::vector<short> PreviewOutput;
+  std::atomic<FMindex> PreviewedPoints{0};
+};
+
 ///////////////////////////////////////////////////////////////////////
 ///////////////////////////////////////////////////////////////////////
 
-// used to compute the median
-int compareInt(const void *a, const void *b)
+// run functor(begin,end) on parts of [begin,end) in parallel, using at most
+// numberOfThreads threads (0 means the default of the SMP backend)
+template <typename Functor>
+void vtkPichonFastMarchingParallelFor(int numberOfThreads, vtkIdType begin, vtkIdType end, Functor functor)
+{
+#if VTK_VERSION_NUMBER >= VTK_VERSION_CHECK(9, 2, 0)
+  if( numberOfThreads>0 )
+    {
+    vtkSMPTools::LocalScope(vtkSMPTools::Config(numberOfThreads),
+      [&]() { vtkSMPTools::For(begin, end, functor); });
+    return;
+    }
+#else
+  // the number of threads can only be set for the whole process, the default
+  // of the SMP backend is used so that the other VTK filters are not affected
+  (void)numberOfThreads;
+#endif
+  vtkSMPTools::For(begin, end, functor);
+}
+
+// order statistics of the 27-neighborhood of a voxel that are used for
+// the median and the inhomogeneity, read from input of any scalar type
+template <class T>
+void vtkPichonFastMarchingOrderStatistics(const T* data, FMindex index, const FMindex* shifts, double statistics[3])
+{
+  T neighborhood[27];
+  for(int k=0;k<=26;k++)
+    neighborhood[k] = data[index + shifts[k]];
+
+  // only 3 order statistics are needed, partial selection is much faster
+  // than sorting the whole neighborhood
+  T *first = neighborhood;
+  T *last = neighborhood + 27;
+  std::nth_element( first, first + 13, last );
+  std::nth_element( first, first + 5, first + 13 );
+  std::nth_element( first + 14, first + 21, last );
+
+  statistics[0] = (double)neighborhood[5];
+  statistics[1] = (double)neighborhood[13];
+  statistics[2] = (double)neighborhood[21];
+}
+
+// order statistic of a window that slides over the image, found from the
+// histogram of the window: bin of the value of the given rank in the window
+// and number of values of the window that are in lower bins
+struct vtkPichonFastMarchingSlidingStatistic
 {
-  return  (*(int*)a) - (*(int*)b);
+  int Rank;
+  int Bin;
+  int NumberBelow;
+
+  void Add(int bin, int count)
+  {
+    if( bin<Bin )
+      NumberBelow += count;
+  }
+
+  // move to the bin that contains the rank after values were added and removed
+  void Update(const int* histogram)
+  {
+    while( NumberBelow>Rank )
+      NumberBelow -= histogram[ --Bin ];
+    while( NumberBelow+histogram[ Bin ]<=Rank )
+      NumberBelow += histogram[ Bin++ ];
+  }
+};
+
+// intensities of n consecutive voxels, read from input of any scalar type
+template <class T>
+void vtkPichonFastMarchingReadValues(const T* data, FMindex n, double* values)
+{
+  for(FMindex p=0;p<n;p++)
+    values[p] = (double)data[p];
 }
 
 ///////////////////////////////////////////////////////////////////////
@@ -38,17 +137,17 @@ int compareInt(const void *a, const void *b)
 vtkStandardNewMacro(vtkPichonFastMarching);
 
 //------------------------------------------------------------------------------
-void vtkPichonFastMarching::collectInfoSeed( int index )
+void vtkPichonFastMarching::collectInfoSeed( FMindex index, int labelIndex )
 {
   int med, inh;
   getMedianInhomo(index, med, inh);
 
-  pdfIntensityIn->addRealization( med );
-  pdfInhomoIn->addRealization( inh );
+  pdfIntensityIn[labelIndex]->addRealization( med );
+  pdfInhomoIn[labelIndex]->addRealization( inh );
 }
 
 // speed at index
-float vtkPichonFastMarching::speed( int index )
+float vtkPichonFastMarching::speed( FMindex index )
 {
   int I;
   int H;
@@ -58,8 +157,8 @@ float vtkPichonFastMarching::speed( int index )
 
   float s;
 
-  double pI=pdfIntensityIn->value(I);
-  double pH=pdfInhomoIn->value(H);
+  double pI=pdfIntensityIn[labelIndex(index)]->value(I);
+  double pH=pdfInhomoIn[labelIndex(index)]->value(H);
 
 
 
@@ -91,7 +190,7 @@ float vtkPichonFastMarching::speed( int index )
   return s;
 }
 
-void vtkPichonFastMarching::setSeed( int index )
+void vtkPichonFastMarching::setSeed( FMindex index )
 {
   //assert( (index>=(1+dimX+dimXY)) && (index<(dimXYZ-1-dimX-dimXY)) );
   if(!( (index>=(1+dimX+dimXY)) && (index<(dimXYZ-1-dimX-dimXY)) ))
@@ -100,34 +199,46 @@ void vtkPichonFastMarching::setSeed( int index )
       return;
     }
 
-  if( node[index].status!=fmsFAR )
+  if( getStatus(index)!=fmsFAR )
     {
       // this seed has already been planted
       return;
     }
 
   // by definition, T=0, and that voxel is known
-  node[index].T=0.0;
-  node[index].status=fmsKNOWN;
+  nodeT[index]=0.0;
+  setStatus(index,fmsKNOWN);
 
   knownPoints.push_back(index);
+  nKnownSeedPoints++;
 
   // add all FAR 26-neighbors to TRIAL
   for(int n=1;n<=26;n++)
     {
       FMleaf f;
       f.nodeIndex=index + shiftNeighbor(n);
-      if( node[ f.nodeIndex ].status==fmsFAR )
+      if( getStatus(f.nodeIndex)==fmsFAR )
     {
-      node[f.nodeIndex].status=fmsTRIAL;
-      node[f.nodeIndex].T = (float) ( distanceNeighbor(n) / speed(f.nodeIndex) );
+      setStatus(f.nodeIndex,fmsTRIAL);
+      if(nodeLabel!=nullptr)
+        nodeLabel[f.nodeIndex]=nodeLabel[index];
+      nodeT[f.nodeIndex] = (float) ( distanceNeighbor(n) / speed(f.nodeIndex) );
 
       insert( f ); // insert in minheap
     }
     }
 }
 
-inline void vtkPichonFastMarching::getMedianInhomo( int index, int &med, int &inh )
+inline int vtkPichonFastMarching::intensityBin( double value )
+{
+  if( intensityBinEdges.empty() )
+    return (int)value;
+
+  return (int)( std::upper_bound( intensityBinEdges.begin(), intensityBinEdges.end(), value )
+                - intensityBinEdges.begin() );
+}
+
+inline void vtkPichonFastMarching::getMedianInhomo( FMindex index, int &med, int &inh )
 {
   // assert( (index>=(1+dimX+dimXY)) && (index<(dimXYZ-1-dimX-dimXY)) );
 
@@ -140,31 +251,137 @@ inline void vtkPichonFastMarching::getMedianInhomo( int index, int &med, int &in
     }
 
   // otherwise, just do it
-  for(int k=0;k<=26;k++)
-      tmpNeighborhood[k] = (int)indata[index + arrayShiftNeighbor[k]];
+  // binning is monotonic, so the order statistics can be computed
+  // on the intensities and binned afterwards
+  double statistics[3] = { 0.0, 0.0, 0.0 };
+  switch (indataScalarType)
+    {
+    vtkTemplateMacro( vtkPichonFastMarchingOrderStatistics( static_cast<VTK_TT*>(indata), index, arrayShiftNeighbor, statistics ) );
+    }
 
-  qsort( (void*)tmpNeighborhood, 27, sizeof(int), &compareInt );
+  inh = intensityBin(statistics[2]) - intensityBin(statistics[0]);
+  med = intensityBin(statistics[1]);
 
-  inh = inhomo[ index ] = (tmpNeighborhood[21] - tmpNeighborhood[5]);
-  med = median[ index ] = tmpNeighborhood[13];
+  // stored on 16 bits, the range is bounded by depth
+  inhomo[ index ] = (short)inh;
+  median[ index ] = (short)med;
+}
 
-  /*
-    // same thing for 125-neighbors
+void vtkPichonFastMarching::computeMedianInhomo(int beginK, int endK)
+{
+  // binning is monotonic, so the order statistics of the bins are the bins
+  // of the order statistics computed by getMedianInhomo
+  int nBins = intensityBinEdges.empty() ? depth+1 : (int)intensityBinEdges.size()+1;
+
+  // bins of the slices k-1, k and k+1, slice k is in sliceBins[k%3]
+  std::vector<double> values(dimXY);
+  std::vector<short> sliceBins[3];
+  auto binSlice = [&](int k) -> bool
+    {
+      switch (indataScalarType)
+        {
+        vtkTemplateMacro( vtkPichonFastMarchingReadValues( static_cast<VTK_TT*>(indata) + k*dimXY, dimXY, values.data() ) );
+        }
+      std::vector<short>& bins = sliceBins[k%3];
+      bins.resize(dimXY);
+      for(FMindex p=0;p<dimXY;p++)
+        {
+          int bin = intensityBin(values[p]);
+          // intensities that are not binned may be out of the range of the
+          // histogram, they are left to getMedianInhomo
+          if( (bin<0) || (bin>=nBins) )
+            return false;
+          bins[p] = (short)bin;
+        }
+      return true;
+    };
+
+  // histogram of the bins in the window of 3x3x3 voxels that slides along the rows,
+  // the 27 voxels of the window are in columns of 9 voxels along j and k
+  std::vector<int> histogramBuffer(nBins, 0);
+  int* histogram = histogramBuffer.data();
+  const short* slices[3];
+  auto getColumn = [&](FMindex column, short bins[9])
+    {
+      for(int s=0;s<3;s++)
+        for(int dj=-1;dj<=1;dj++)
+          bins[3*s+dj+1] = slices[s][column+dj*dimX];
+    };
 
-    int p=0;
-    for(int px=-2;px<=2;px++)
-    for(int py=-2;py<=2;py++)
-    for(int pz=-2;pz<=2;pz++)
+  if( !binSlice(beginK-1) || !binSlice(beginK) )
+    return;
+  for(int k=beginK;k<endK;k++)
     {
-    int k=index + px + py * dimX + pz * dimXY;
-    tmpNeighborhood[p++] = (int)indata[k];
-    }
+      if( !binSlice(k+1) )
+        return;
+      for(int s=0;s<3;s++)
+        slices[s] = sliceBins[(k-1+s)%3].data();
 
-    qsort( (void*)tmpNeighborhood, 125, sizeof(int), &compareInt );
+      for(int j=BAND_OUT;j<dimY-BAND_OUT;j++)
+        {
+          FMindex rowIndex = (FMindex)k*dimXY + (FMindex)j*dimX;
+          FMindex rowColumn = (FMindex)j*dimX;
+
+          // rows read from the statistics image are not computed again
+          bool computed = true;
+          for(int i=BAND_OUT;(i<dimX-BAND_OUT) && computed;i++)
+            computed = (inhomo[rowIndex+i]!=-1);
+          if( computed )
+            continue;
+
+          // first window of the row, the order statistics are the ones
+          // used by getMedianInhomo (see vtkPichonFastMarchingOrderStatistics)
+          short window[27];
+          for(int di=-1;di<=1;di++)
+            getColumn(rowColumn+BAND_OUT+di, window+9*(di+1));
+          for(int n=0;n<27;n++)
+            histogram[ window[n] ]++;
+          std::sort(window, window+27);
+          vtkPichonFastMarchingSlidingStatistic low = { 5, window[5], 0 };
+          vtkPichonFastMarchingSlidingStatistic med = { 13, window[13], 0 };
+          vtkPichonFastMarchingSlidingStatistic high = { 21, window[21], 0 };
+          for(int n=0;n<27;n++)
+            {
+              low.Add(window[n], 1);
+              med.Add(window[n], 1);
+              high.Add(window[n], 1);
+            }
 
-    inh = inhomo[ index ] = (tmpNeighborhood[105] - tmpNeighborhood[20]);
-    med = median[ index ] = tmpNeighborhood[63];
-  */
+          for(int i=BAND_OUT;i<dimX-BAND_OUT;i++)
+            {
+              if( i>BAND_OUT )
+                {
+                  short removed[9], added[9];
+                  getColumn(rowColumn+i-2, removed);
+                  getColumn(rowColumn+i+1, added);
+                  for(int n=0;n<9;n++)
+                    {
+                      histogram[ removed[n] ]--;
+                      histogram[ added[n] ]++;
+                      low.Add(removed[n], -1);
+                      med.Add(removed[n], -1);
+                      high.Add(removed[n], -1);
+                      low.Add(added[n], 1);
+                      med.Add(added[n], 1);
+                      high.Add(added[n], 1);
+                    }
+                  low.Update(histogram);
+                  med.Update(histogram);
+                  high.Update(histogram);
+                }
+              median[rowIndex+i] = (short)med.Bin;
+              inhomo[rowIndex+i] = (short)(high.Bin-low.Bin);
+            }
+
+          // empty the histogram for the next row
+          for(int di=-1;di<=1;di++)
+            {
+              getColumn(rowColumn+dimX-BAND_OUT-1+di, window);
+              for(int n=0;n<9;n++)
+                histogram[ window[n] ]--;
+            }
+        }
+    }
 }
 
 void vtkPichonFastMarching::initNewExpansion( void )
@@ -172,87 +389,84 @@ void vtkPichonFastMarching::initNewExpansion( void )
   if(invalidInputs)
     return;
 
-  pdfIntensityIn->reset();
-  pdfInhomoIn->reset();
-
-  // empty interface points
-  while(tree.size()>0)
+  for(unsigned int l=0;l<pdfIntensityIn.size();l++)
     {
-      node[ tree[tree.size()-1].nodeIndex ].status=fmsFAR;
-      node[ tree[tree.size()-1].nodeIndex ].T=(float)INF;
-      tree.pop_back();
+      pdfIntensityIn[l]->reset();
+      pdfInhomoIn[l]->reset();
     }
 
+  // empty interface points
+  clearTree();
+
   // empty the list of known points
   while(knownPoints.size()>0)
     {
       knownPoints.pop_back();
     }
+  nKnownSeedPoints=0;
   nEvolutions=-1;
+  nEmptyTreeSteps=0;
 
   firstCall=true;
 
   while(seedPoints.size()>0)
     seedPoints.pop_back();
 
-  int index=0;
-  for(int k=0;k<dimZ;k++)
-    for(int j=0;j<dimY;j++)
-      for(int i=0;i<dimX;i++)
+  // Slices are processed in parallel, the median and inhomogeneity of the
+  // points of the label are computed there. The statistics and the seeds
+  // are then collected in the order of the voxels.
+  std::vector<VecFMindex> sliceLabelPoints(dimZ);
+  std::vector<VecFMindex> sliceSeedPoints(dimZ);
+  vtkPichonFastMarchingParallelFor(numberOfThreads, 0, dimZ,
+    [&](vtkIdType beginK, vtkIdType endK)
     {
-      if( (outdata[index]==label) && (node[index].status!=fmsOUT) )
-        {
-            collectInfoSeed( index );
-            for(int n=1;n<nNeighbors;n++)
-            if(outdata[index+shiftNeighbor(n)]==0)
-              {
-                seedPoints.push_back( index+shiftNeighbor(n) );
-                }
-
-/*
-          bool hasIntensityZeroNeighbor = false;
-          for(int n=1;n<nNeighbors;n++)
-        if(outdata[index+shiftNeighbor(n)]==0)
+      int med, inh;
+      for(int k=(int)beginK;k<(int)endK;k++)
+        for(FMindex index=(FMindex)k*dimXY;index<(FMindex)(k+1)*dimXY;index++)
           {
-            hasIntensityZeroNeighbor=true;
-            break;
+            if( (outdata[index]!=label) || (getStatus(index)==fmsOUT) )
+              continue;
+            getMedianInhomo( index, med, inh );
+            sliceLabelPoints[k].push_back( index );
+            for(int n=1;n<nNeighbors;n++)
+              if(outdata[index+shiftNeighbor(n)]==0)
+                sliceSeedPoints[k].push_back( index+shiftNeighbor(n) );
           }
+    });
 
-          if(hasIntensityZeroNeighbor)
-        {
-          node[index].status=fmsFAR;
-          seedPoints.push_back( index );
-        }
-          else
-        {
-          node[index].status=fmsDONE;
-          node[index].T=0.0;
-        }
-*/
-
-        }
-
-      index++;
+  for(int k=0;k<dimZ;k++)
+    {
+      for(FMindex index : sliceLabelPoints[k])
+        collectInfoSeed( index );
+      seedPoints.insert( seedPoints.end(), sliceSeedPoints[k].begin(), sliceSeedPoints[k].end() );
     }
 }
 
-int vtkPichonFastMarching::nValidSeeds( void )
+vtkIdType vtkPichonFastMarching::nValidSeeds( void )
 {
   if(invalidInputs)
     return 0;
 
-  return (int)(seedPoints.size()+tree.size());
+  return (vtkIdType)(seedPoints.size()+treeSize());
 }
 
-int vtkPichonFastMarching::nKnownPoints(void)
+vtkIdType vtkPichonFastMarching::nKnownPoints(void)
 {
   if(invalidInputs)
     return 0;
-  return knownPoints.size();
+  return (vtkIdType)knownPoints.size();
+}
+
+vtkIdType vtkPichonFastMarching::nKnownSeeds(void)
+{
+  if(invalidInputs)
+    return 0;
+  // seeds are planted at the start of an evolution, before the points it reaches
+  return (vtkIdType)std::min<FMindex>(nKnownSeedPoints, (FMindex)knownPoints.size());
 }
 
 void vtkPichonFastMarchingExecute(vtkPichonFastMarching *self,
-                vtkImageData *vtkNotUsed(inData), short *inPtr,
+                vtkImageData *vtkNotUsed(inData), void *inPtr,
                 vtkImageData *vtkNotUsed(outData), short *outPtr,
                 int vtkNotUsed(outExt)[6])
 {
@@ -260,50 +474,58 @@ void vtkPichonFastMarchingExecute(vtkPichonFastMarching *self,
     return;
   int n=0;
   int k;
+  FMindex p;
 
-  self->setInData( (short *)inPtr );
+  self->indata = inPtr;
   self->setOutData( (short *)outPtr );
 
   if( !self->initialized )
     {
     self->initialized = true;
 
-    int index=0;
-    int lastPercentageProgressBarUpdated=-1;
-
-    for(k=0;k<self->dimZ;k++)
+    // The image is processed in GRANULARITY_PROGRESS blocks to report progress,
+    // voxels of a block are processed in parallel. Two voxels share a status byte,
+    // so the blocks are split into voxel pairs.
+    double statisticsProgress = self->precomputeStatistics ? 0.5 : 1.0;
+    FMindex nPairs = (self->dimXYZ+1)/2;
+    FMindex nPairsPerBlock = nPairs/GRANULARITY_PROGRESS + 1;
+    for(FMindex firstPair=0;firstPair<nPairs;firstPair+=nPairsPerBlock)
       {
-      // update progress bar
-      int currentPercentage = GRANULARITY_PROGRESS * index / self->dimXYZ;
-      if (currentPercentage > lastPercentageProgressBarUpdated)
+      self->reportProgress(statisticsProgress * float(firstPair) / float(nPairs));
+      if (self->GetAbortExecute())
         {
-        lastPercentageProgressBarUpdated = currentPercentage;
-        self->UpdateProgress(float(currentPercentage) / float(GRANULARITY_PROGRESS));
+        // initialization is incomplete, it has to be done again
+        self->initialized = false;
+        return;
         }
-      for (int j = 0; j<self->dimY; j++)
-        for (int i = 0; i<self->dimX; i++)
+      vtkPichonFastMarchingParallelFor(self->numberOfThreads, firstPair, std::min(firstPair+nPairsPerBlock, nPairs),
+        [self](vtkIdType beginPair, vtkIdType endPair)
         {
-          self->node[index].T = (float)INF;
-
-          if (self->outdata[index] == 0)
-            self->node[index].status = fmsFAR;
-          else
-            self->node[index].status = fmsDONE;
+          self->initNodes( (FMindex)(2*beginPair), std::min((FMindex)(2*endPair), self->dimXYZ) );
+        });
+      }
 
-          self->inhomo[index] = -1; // meaning inhomo and median have not been computed there
+    // use median and inhomogeneity computed by previous filters
+    self->readStatisticsImage();
 
-          if ((i<BAND_OUT) || (j<BAND_OUT) || (k<BAND_OUT) ||
-            (i >= (self->dimX - BAND_OUT)) || (j >= (self->dimY - BAND_OUT)) || (k >= (self->dimZ - BAND_OUT)))
+    // median and inhomogeneity of the other voxels, the slices of a block are processed in parallel
+    if( self->precomputeStatistics )
+      {
+      int endK = self->dimZ-BAND_OUT;
+      int nSlicesPerBlock = (endK-BAND_OUT)/GRANULARITY_PROGRESS + 1;
+      for(int firstK=BAND_OUT;firstK<endK;firstK+=nSlicesPerBlock)
+        {
+        self->reportProgress(statisticsProgress + (1.0-statisticsProgress) * float(firstK-BAND_OUT) / float(endK-BAND_OUT));
+        if (self->GetAbortExecute())
           {
-
-            self->node[index].status = fmsOUT;
-
-            // we should never have to look at these values anyway !
-            self->inhomo[index] = self->depth;
-            self->median[index] = 0;
+          self->initialized = false;
+          return;
           }
-
-          index++;
+        vtkPichonFastMarchingParallelFor(self->numberOfThreads, firstK, std::min(firstK+nSlicesPerBlock, endK),
+          [self](vtkIdType beginK, vtkIdType endK)
+          {
+            self->computeMedianInhomo( (int)beginK, (int)endK );
+          });
         }
       }
 
@@ -314,6 +536,8 @@ void vtkPichonFastMarchingExecute(vtkPichonFastMarching *self,
     {
     self->firstCall=false;
 
+    // the front never goes into masked voxels
+    self->applyMaskImage();
 
     //assert(self->seedPoints.size()>0);
     if(!(self->seedPoints.size()>0))
@@ -322,11 +546,14 @@ void vtkPichonFastMarchingExecute(vtkPichonFastMarching *self,
       self->firstCall=true; // we did not complete this step
       return;
       }
-    for(k=0;k<(int)self->seedPoints.size();k++)
-      self->collectInfoSeed( self->seedPoints[k] );
+    for(p=0;p<(FMindex)self->seedPoints.size();p++)
+      self->collectInfoSeed( self->seedPoints[p], self->labelIndex(self->seedPoints[p]) );
 
-    self->pdfIntensityIn->update();
-    self->pdfInhomoIn->update();
+    for(k=0;k<(int)self->pdfIntensityIn.size();k++)
+      {
+      self->pdfIntensityIn[k]->update();
+      self->pdfInhomoIn[k]->update();
+      }
     }
 
   if(self->nPointsEvolution<=0)
@@ -336,14 +563,14 @@ void vtkPichonFastMarchingExecute(vtkPichonFastMarching *self,
   // reinitialize the points that were removed by the user
   if( self->nEvolutions>0 )
     if( (self->knownPoints.size()>1) &&
-      ((signed)self->knownPoints.size()-1>self->nPointsBeforeLeakEvolution) )
+      ((FMindex)self->knownPoints.size()-1>self->nPointsBeforeLeakEvolution) )
       {
       // reinitialize all the points
-      for(k=self->nPointsBeforeLeakEvolution;k<(int)self->knownPoints.size();k++)
+      for(p=self->nPointsBeforeLeakEvolution;p<(FMindex)self->knownPoints.size();p++)
         {
-        int index = self->knownPoints[k];
-        self->node[ index ].status = fmsFAR;
-        self->node[ index ].T = (float)INF;
+        FMindex index = self->knownPoints[p];
+        self->setStatus(index,fmsFAR);
+        self->nodeT[ index ] = (float)INF;
 
         /*
            we also want to remove the neighbors of these points that would be in TRIAL
@@ -353,35 +580,41 @@ void vtkPichonFastMarchingExecute(vtkPichonFastMarching *self,
 
         for(n=1;n<=self->nNeighbors;n++)
           {
-          int indexN=index+self->shiftNeighbor(n);
-          if( self->node[indexN].status==fmsTRIAL )
+          FMindex indexN=index+self->shiftNeighbor(n);
+          if( self->getStatus(indexN)==fmsTRIAL )
             {
-            self->node[indexN].T=(float)INF;
-            self->downTree( self->node[indexN].leafIndex );
+            float previousT=self->nodeT[indexN];
+            self->nodeT[indexN]=(float)INF;
+            self->updateLeaf( indexN, previousT );
             }
           }
         }
 
       // if the points still have a KNOWN neighbor, put them back in TRIAL
-      for(k=self->nPointsBeforeLeakEvolution;k<(int)self->knownPoints.size();k++)
+      for(p=self->nPointsBeforeLeakEvolution;p<(FMindex)self->knownPoints.size();p++)
         {
-        int index = self->knownPoints[k];
-        int indexN;
+        FMindex index = self->knownPoints[p];
+        FMindex indexN;
 
         bool hasKnownNeighbor =  false;
         for(n=1;n<=self->nNeighbors;n++)
           {
           indexN=index+self->shiftNeighbor(n);
-          if( self->node[indexN].status==fmsKNOWN )
+          if( self->getStatus(indexN)==fmsKNOWN )
+            {
             hasKnownNeighbor=true;
+            // the point goes back to the front of its known neighbor
+            if( self->nodeLabel!=nullptr )
+              self->nodeLabel[index]=self->nodeLabel[indexN];
+            }
           }
 
-        if( (hasKnownNeighbor) && (self->node[index].status!=fmsOUT) )
+        if( (hasKnownNeighbor) && (self->getStatus(index)!=fmsOUT) )
           {
           FMleaf f;
 
-          self->node[index].T=self->computeT(index);
-          self->node[index].status=fmsTRIAL;
+          self->nodeT[index]=self->computeT(index);
+          self->setStatus(index,fmsTRIAL);
           f.nodeIndex=index;
 
           self->insert( f );
@@ -391,50 +624,143 @@ void vtkPichonFastMarchingExecute(vtkPichonFastMarching *self,
       // remove all the points from the displayed knownPoints
       // ok since (self->knownPoints[self->nEvolutions].size()-1>self->nPointsBeforeLeakEvolution)
       // is true
-      while((int)self->knownPoints.size()>self->nPointsBeforeLeakEvolution)
+      while((FMindex)self->knownPoints.size()>self->nPointsBeforeLeakEvolution)
         self->knownPoints.pop_back();
       }
 
   // start a new evolution
   self->nEvolutions++;
 
-  self->nPointsBeforeLeakEvolution=(int)(self->knownPoints.size()-1);
+  self->nPointsBeforeLeakEvolution=(FMindex)self->knownPoints.size()-1;
 
   // use the seeds
   while(self->seedPoints.size()>0)
     {
-    int index=self->seedPoints[self->seedPoints.size()-1];
+    FMindex index=self->seedPoints[self->seedPoints.size()-1];
     self->seedPoints.pop_back();
 
     self->setSeed( index );
     }
 
+#ifndef NDEBUG
   // check minHeap OK
   self->minHeapIsSorted();
+#endif
 
-  self->pdfIntensityIn->setUpdateRate(self->nPointsEvolution/100);
-  self->pdfInhomoIn->setUpdateRate(self->nPointsEvolution/100);
+  int updateRate=self->statisticsUpdateRate;
+  if( updateRate<=0 )
+    updateRate=(int)std::min<FMindex>(self->nPointsEvolution/100, INT_MAX);
+  for(k=0;k<(int)self->pdfIntensityIn.size();k++)
+    {
+    self->pdfIntensityIn[k]->setUpdateRate(updateRate);
+    self->pdfInhomoIn[k]->setUpdateRate(updateRate);
+    }
 
-  for(n=0;n<self->nPointsEvolution;n++)
+  // points before this index are already in the output
+  FMindex nPreviewed=self->nPointsBeforeLeakEvolution+1;
+  if( self->previewInterval>0 )
+    self->initPreviewImage();
+
+  // leak detection: median T of the windows before the current one
+  // (windows where T jumped are not included)
+  self->leakOnsetPoints=0;
+  FMindex leakWindowSize=0;
+  if( self->leakDetectionRatio>0 )
+    leakWindowSize=std::max<FMindex>(self->nPointsEvolution/LEAK_WINDOWS, LEAK_MIN_WINDOW_SIZE);
+  std::vector<float> leakWindowT;
+  std::vector<float> leakMedianT;
+  float leakReferenceT=0;
+  FMindex leakWindowStartPoints=(FMindex)self->knownPoints.size();
+  FMindex leakCandidatePoints=0;
+  int nLeakWindows=0; // windows where T jumped since the candidate onset
+  int nLeakCandidateWindows=0; // windows since the candidate onset
+
+  for(p=0;p<self->nPointsEvolution;p++)
     {
-    if( (n*GRANULARITY_PROGRESS) % self->nPointsEvolution == 0 )
-      self->UpdateProgress(float(n)/float(self->nPointsEvolution));
+    if( (p*GRANULARITY_PROGRESS) % self->nPointsEvolution == 0 )
+      self->reportProgress(float(p)/float(self->nPointsEvolution));
+
+    if( self->GetAbortExecute() )
+      {
+      // the points that are already known remain valid
+      break;
+      }
 
     float T=self->step();
 
     // all the statistics should be gathered from a band 3 pixels from the interface
-    self->pdfIntensityIn->setMemory((int)(5*self->tree.size()));
-    self->pdfInhomoIn->setMemory((int)(5*self->tree.size()));
+    for(k=0;k<(int)self->pdfIntensityIn.size();k++)
+      {
+      self->pdfIntensityIn[k]->setMemory((int)std::min<FMindex>(5*self->treeSize(), INT_MAX));
+      self->pdfInhomoIn[k]->setMemory((int)std::min<FMindex>(5*self->treeSize(), INT_MAX));
+      }
 
     if( T==INF )
       {
-      vtkErrorWithObjectMacro(self, "FastMarching: nowhere else to go. End of evolution." );
+      // the front can run out of voxels if they are masked
+      if( self->maskImage==nullptr )
+        vtkErrorWithObjectMacro(self, "FastMarching: nowhere else to go. End of evolution." );
       break;
       }
+
+    if( leakWindowSize>0 )
+      {
+      leakWindowT.push_back(T);
+      if( (FMindex)leakWindowT.size()==leakWindowSize )
+        {
+        // median is not sensitive to the few points that get a very large T
+        // before the statistics of the front are updated
+        std::nth_element(leakWindowT.begin(), leakWindowT.begin()+leakWindowT.size()/2, leakWindowT.end());
+        float medianT=leakWindowT[leakWindowT.size()/2];
+        leakWindowT.clear();
+
+        if( nLeakWindows==0 && leakMedianT.size()>=LEAK_MIN_WINDOWS )
+          leakReferenceT=*std::max_element(leakMedianT.end()-LEAK_HISTORY_WINDOWS, leakMedianT.end());
+
+        if( nLeakWindows>0 )
+          nLeakCandidateWindows++;
+        if( (leakMedianT.size()>=LEAK_MIN_WINDOWS) && (medianT>self->leakDetectionRatio*leakReferenceT) )
+          {
+          // the front is held back, it reached the boundary of the structure
+          if( nLeakWindows==0 )
+            {
+            leakCandidatePoints=leakWindowStartPoints;
+            nLeakCandidateWindows=1;
+            }
+          nLeakWindows++;
+          if( nLeakWindows>=LEAK_CONFIRM_WINDOWS )
+            {
+            self->leakOnsetPoints=leakCandidatePoints;
+            break;
+            }
+          }
+        else if( nLeakWindows==0 || nLeakCandidateWindows>=LEAK_CONFIRM_SPAN )
+          {
+          // no jump, or it was not confirmed in time: the windows since
+          // the candidate onset are not used as reference
+          nLeakWindows=0;
+          leakMedianT.push_back(medianT);
+          }
+        leakWindowStartPoints=(FMindex)self->knownPoints.size();
+        }
+      }
+
+    if( (self->previewInterval>0) && ((p+1)%self->previewInterval==0) )
+      {
+      // same as show(1), for the points reached since the last preview
+      self->previewKnownPoints(nPreviewed);
+      nPreviewed=(FMindex)self->knownPoints.size();
+      self->nPointsBeforeLeakEvolution=nPreviewed-1;
+      }
     }
 
+#ifndef NDEBUG
   // check minHeap still OK
   self->minHeapIsSorted();
+#endif
+
+  // share the median and inhomogeneity computed during this evolution
+  self->writeStatisticsImage();
 
   self->firstPassThroughShow = true;
 
@@ -443,11 +769,77 @@ void vtkPichonFastMarchingExecute(vtkPichonFastMarching *self,
   self->nPointsEvolution=0;
 }
 
+void vtkPichonFastMarching::initNodes(FMindex beginIndex, FMindex endIndex)
+{
+  int k=(int)(beginIndex/dimXY);
+  int j=(int)((beginIndex%dimXY)/dimX);
+  int i=(int)(beginIndex%dimX);
+
+  for(FMindex index=beginIndex;index<endIndex;index++)
+    {
+      nodeT[index] = (float)INF;
+
+      if (outdata[index] == 0)
+        setStatus(index,fmsFAR);
+      else
+        setStatus(index,fmsDONE);
+
+      inhomo[index] = -1; // meaning inhomo and median have not been computed there
+
+      if ((i<BAND_OUT) || (j<BAND_OUT) || (k<BAND_OUT) ||
+        (i >= (dimX - BAND_OUT)) || (j >= (dimY - BAND_OUT)) || (k >= (dimZ - BAND_OUT)))
+      {
+
+        setStatus(index,fmsOUT);
+
+        // we should never have to look at these values anyway !
+        inhomo[index] = depth;
+        median[index] = 0;
+      }
+
+      if(++i==dimX)
+        {
+          i=0;
+          if(++j==dimY)
+        {
+          j=0;
+          k++;
+        }
+        }
+    }
+}
+
+void vtkPichonFastMarching::initPreviewImage(void)
+{
+  std::lock_guard<std::mutex> lock(Internals->PreviewMutex);
+  Internals->PreviewOutput.assign(outdata, outdata+dimXYZ);
+}
+
+void vtkPichonFastMarching::previewKnownPoints(FMindex beginPoint)
+{
+  // the preview image is read by the main thread while the filter is running
+  std::lock_guard<std::mutex> lock(Internals->PreviewMutex);
+  short* preview = Internals->PreviewOutput.data();
+  for(FMindex q=beginPoint;q<(FMindex)knownPoints.size();q++)
+    if( outdata[ knownPoints[q] ]==0 )
+      {
+      outdata[ knownPoints[q] ]=outputLabel( knownPoints[q] );
+      preview[ knownPoints[q] ]=outdata[ knownPoints[q] ];
+      }
+  Internals->PreviewedPoints=(FMindex)knownPoints.size();
+}
+
 void vtkPichonFastMarching::show(float r)
 {
   if(invalidInputs)
     return;
 
+  if( isBackgroundUpdateRunning() )
+    {
+      vtkErrorMacro("Error in vtkPichonFastMarching::show(...): the filter is running in the background");
+      return;
+    }
+
   //assert( (r>=0) && (r<=1.0) );
   if(!( (r>=0) && (r<=1.0) ))
     {
@@ -461,39 +853,128 @@ void vtkPichonFastMarching::show(float r)
   if( knownPoints.size()<1 )
     return;
 
-  int oldIndex = nPointsBeforeLeakEvolution;
-  int newIndex = (int)((knownPoints.size()-1)*r);
+  FMindex oldIndex = nPointsBeforeLeakEvolution;
+  FMindex newIndex = (FMindex)((knownPoints.size()-1)*(double)r);
+
+  // empty extent
+  showModifiedExtent[0]=showModifiedExtent[2]=showModifiedExtent[4]=0;
+  showModifiedExtent[1]=showModifiedExtent[3]=showModifiedExtent[5]=-1;
 
   if( newIndex > oldIndex )
-    for(int index=(oldIndex+1);index<=newIndex;index++)
+    for(FMindex index=(oldIndex+1);index<=newIndex;index++)
       {
-    if( node[ knownPoints[index] ].status==fmsKNOWN )
+    if( getStatus(knownPoints[index])==fmsKNOWN )
         if(outdata[ knownPoints[index] ]==0)
-          outdata[ knownPoints[index] ]=label;
+          {
+          outdata[ knownPoints[index] ]=outputLabel( knownPoints[index] );
+          expandExtent( knownPoints[index], showModifiedExtent );
+          }
       }
   else if( newIndex < oldIndex )
-    for(int index=oldIndex;index>newIndex;index--)
+    for(FMindex index=oldIndex;index>newIndex;index--)
       {
-    if(node[ knownPoints[index] ].status==fmsKNOWN )
-        if(outdata[ knownPoints[index] ]==label)
+    if(getStatus(knownPoints[index])==fmsKNOWN )
+        if(outdata[ knownPoints[index] ]==outputLabel( knownPoints[index] ))
+          {
           outdata[ knownPoints[index] ]=0;
+          expandExtent( knownPoints[index], showModifiedExtent );
+          }
       }
 
   nPointsBeforeLeakEvolution=newIndex;
   firstPassThroughShow=false;
 }
 
+void vtkPichonFastMarching::getShowModifiedExtent(int extent[6])
+{
+  for(int a=0;a<6;a++)
+    extent[a]=showModifiedExtent[a];
+}
+
 void vtkPichonFastMarching::setActiveLabel(int _label)
 {
   this->label=_label;
 }
 
+void vtkPichonFastMarching::setMultiLabel( bool _multiLabel )
+{
+  if( _multiLabel==multiLabel )
+    return;
+  multiLabel=_multiLabel;
+
+  // front of each point is only needed in multi-label mode
+  delete[] nodeLabel;
+  nodeLabel = nullptr;
+  if( multiLabel && (dimXYZ>0) )
+    {
+      nodeLabel = new unsigned char[ dimXYZ ];
+      if(nodeLabel==nullptr)
+    {
+      vtkErrorMacro("Error in vtkPichonFastMarching::setMultiLabel(...), not enough memory for allocation of 'nodeLabel'");
+      invalidInputs = true;
+      return;
+    }
+      memset( nodeLabel, 0, dimXYZ );
+    }
+}
+
+bool vtkPichonFastMarching::getMultiLabel( void )
+{
+  return multiLabel;
+}
+
+int vtkPichonFastMarching::addLabelValue(short value)
+{
+  for(unsigned int l=0;l<labelValues.size();l++)
+    if( labelValues[l]==value )
+      return l;
+
+  if( labelValues.size()>=N_MAX_LABELS )
+    {
+      vtkErrorMacro("Error in vtkPichonFastMarching::addLabelValue(...): more than " << N_MAX_LABELS << " labels");
+      return -1;
+    }
+  labelValues.push_back(value);
+
+  // the first front uses the statistics created in init()
+  while( pdfIntensityIn.size()<labelValues.size() )
+    {
+      pdfIntensityIn.push_back( new PichonFastMarchingPDF( depth ) );
+      pdfInhomoIn.push_back( new PichonFastMarchingPDF( depth ) );
+    }
+
+  return (int)(labelValues.size()-1);
+}
+
+void vtkPichonFastMarching::deletePDFs(void)
+{
+  for(unsigned int l=0;l<pdfIntensityIn.size();l++)
+    {
+      delete pdfIntensityIn[l];
+      delete pdfInhomoIn[l];
+    }
+  pdfIntensityIn.clear();
+  pdfInhomoIn.clear();
+}
+
 //----------------------------------------------------------------------------
 // Description:
 // This method is passed a input and output data, and executes the filter
 // algorithm to fill the output from the input.
 // It just executes a switch statement to call the correct function for
 // the datas data types.
+int vtkPichonFastMarching::RequestInformation(vtkInformation *request,
+                                              vtkInformationVector **inputVector,
+                                              vtkInformationVector *outputVector)
+{
+  if( !this->Superclass::RequestInformation(request, inputVector, outputVector) )
+    return 0;
+
+  // the output is a label image, whatever the input scalar type
+  vtkDataObject::SetPointDataActiveScalarInfo(outputVector->GetInformationObject(0), VTK_SHORT, 1);
+  return 1;
+}
+
 void vtkPichonFastMarching::ExecuteDataWithInformation(vtkDataObject *output, vtkInformation* outInfo)
 {
   vtkImageData *inData = vtkImageData::SafeDownCast(this->GetInput());
@@ -501,6 +982,9 @@ void vtkPichonFastMarching::ExecuteDataWithInformation(vtkDataObject *output, vt
 
   int outExt[6], s;
   outInfo->Get(vtkStreamingDemandDrivenPipeline::WHOLE_EXTENT(), outExt);
+  // extent does not have to start at 0
+  for(int k=0;k<6;k++)
+    imageExtent[k]=outExt[k];
   void *inPtr = inData->GetScalarPointerForExtent(outExt);
   void *outPtr = outData->GetScalarPointerForExtent(outExt);
 
@@ -514,24 +998,239 @@ void vtkPichonFastMarching::ExecuteDataWithInformation(vtkDataObject *output, vt
       return;
     }
 
-  /* Need short data */
+  /* Need short data, unless intensities are binned */
   s = inData->GetScalarType();
-  if (s != VTK_SHORT)
+  if ( (s != VTK_SHORT) && intensityBinEdges.empty() )
     {
       vtkErrorMacro("Input scalars are type "<< s
-            << " instead of "<< VTK_SHORT);
+            << " instead of "<< VTK_SHORT << ", intensity bin edges must be set for other types");
       invalidInputs = true;
       return;
     }
+  indataScalarType = s;
+
+  vtkPichonFastMarchingExecute(this, inData, inPtr,
+             outData, (short *)(outPtr), outExt);
+
+}
+
+void vtkPichonFastMarching::startBackgroundUpdate( void )
+{
+  // only one update at a time
+  waitForBackgroundUpdate();
+
+  // the filter keeps processing the same copy in the next updates
+  vtkImageData* input = vtkImageData::SafeDownCast(this->GetInput());
+  if( copyInput && input!=nullptr && input!=Internals->InputCopy.GetPointer() )
+    {
+      Internals->InputCopy = vtkSmartPointer<vtkImageData>::New();
+      Internals->InputCopy->DeepCopy(input);
+      this->SetInputData(Internals->InputCopy);
+    }
+
+  this->SetAbortExecute(0);
+  this->reportProgress(0.0);
+  Internals->BackgroundUpdateRunning = true;
+  Internals->BackgroundUpdateThread = std::thread( [this]()
+    {
+    this->Update();
+    this->Internals->BackgroundUpdateRunning = false;
+    } );
+}
+
+bool vtkPichonFastMarching::isBackgroundUpdateRunning( void )
+{
+  return Internals->BackgroundUpdateRunning;
+}
+
+void vtkPichonFastMarching::setCopyInput( bool copy )
+{
+  copyInput=copy;
+}
+
+bool vtkPichonFastMarching::getCopyInput( void )
+{
+  return copyInput;
+}
+
+void vtkPichonFastMarching::waitForBackgroundUpdate( void )
+{
+  if( Internals->BackgroundUpdateThread.joinable() )
+    Internals->BackgroundUpdateThread.join();
+}
+
+double vtkPichonFastMarching::getBackgroundUpdateProgress( void )
+{
+  return Internals->Progress;
+}
+
+void vtkPichonFastMarching::reportProgress(double amount)
+{
+  Internals->Progress=amount;
+  this->UpdateProgress(amount);
+}
+
+void vtkPichonFastMarching::setPreviewInterval( int n )
+{
+  previewInterval=n;
+}
+
+int vtkPichonFastMarching::getPreviewInterval( void )
+{
+  return previewInterval;
+}
+
+vtkIdType vtkPichonFastMarching::nPreviewedPoints( void )
+{
+  return Internals->PreviewedPoints;
+}
+
+void vtkPichonFastMarching::getPreviewImage(vtkImageData* image)
+{
+  if(invalidInputs || image==nullptr)
+    {
+      vtkErrorMacro("vtkPichonFastMarching::getPreviewImage failed: no valid inputs specified");
+      return;
+    }
+
+  // the input of a background update is not changed by the filter
+  vtkImageData* input = Internals->InputCopy;
+  if( input==nullptr )
+    input = vtkImageData::SafeDownCast(this->GetInput());
+  image->SetExtent(imageExtent);
+  if(input)
+    {
+      image->SetOrigin(input->GetOrigin());
+      image->SetSpacing(input->GetSpacing());
+    }
+  image->AllocateScalars(VTK_SHORT, 1);
+
+  short* preview = static_cast<short*>(image->GetScalarPointer());
+  std::lock_guard<std::mutex> lock(Internals->PreviewMutex);
+  if( (FMindex)Internals->PreviewOutput.size()==dimXYZ )
+    std::copy(Internals->PreviewOutput.begin(), Internals->PreviewOutput.end(), preview);
+  else
+    std::fill(preview, preview+dimXYZ, (short)0);
+}
+
+void vtkPichonFastMarching::setLeakDetectionRatio( double ratio )
+{
+  leakDetectionRatio=ratio;
+}
+
+double vtkPichonFastMarching::getLeakDetectionRatio( void )
+{
+  return leakDetectionRatio;
+}
+
+vtkIdType vtkPichonFastMarching::getLeakOnsetPoints( void )
+{
+  return leakOnsetPoints;
+}
+
+void vtkPichonFastMarching::setNumberOfThreads( int n )
+{
+  numberOfThreads=n;
+}
+
+int vtkPichonFastMarching::getNumberOfThreads( void )
+{
+  return numberOfThreads;
+}
+
+void vtkPichonFastMarching::setPrecomputeStatistics( bool precompute )
+{
+  precomputeStatistics=precompute;
+}
+
+bool vtkPichonFastMarching::getPrecomputeStatistics( void )
+{
+  return precomputeStatistics;
+}
+
+void vtkPichonFastMarching::setNPointsEvolution( vtkIdType n )
+{
+  nPointsEvolution=n;
+}
+
+void vtkPichonFastMarching::setStatisticsUpdateRate( int n )
+{
+  statisticsUpdateRate=n;
+}
+
+int vtkPichonFastMarching::getStatisticsUpdateRate( void )
+{
+  return statisticsUpdateRate;
+}
+
+void vtkPichonFastMarching::setPriorityQueueType( int type )
+{
+  if( (type!=PriorityQueueBinaryHeap) && (type!=PriorityQueueBucket) )
+    {
+      vtkErrorMacro("Error in vtkPichonFastMarching::setPriorityQueueType(...): invalid type " << type);
+      return;
+    }
+  if( type==priorityQueueType )
+    return;
+  if( !emptyTree() )
+    {
+      vtkErrorMacro("Error in vtkPichonFastMarching::setPriorityQueueType(...): cannot change type while the front is not empty");
+      return;
+    }
+  clearTree();
+  priorityQueueType=type;
+
+  // position in the minheap is only needed if the minheap is used
+  delete[] nodeLeafIndex;
+  nodeLeafIndex = nullptr;
+  if( (priorityQueueType==PriorityQueueBinaryHeap) && (dimXYZ>0) )
+    {
+      nodeLeafIndex = new int[ dimXYZ ];
+      if(nodeLeafIndex==nullptr)
+    {
+      vtkErrorMacro("Error in vtkPichonFastMarching::setPriorityQueueType(...), not enough memory for allocation of 'nodeLeafIndex'");
+      invalidInputs = true;
+    }
+    }
+}
 
-  vtkPichonFastMarchingExecute(this, inData, (short *)inPtr,
-             outData, (short *)(outPtr), outExt);
+int vtkPichonFastMarching::getPriorityQueueType( void )
+{
+  return priorityQueueType;
+}
 
+void vtkPichonFastMarching::setBucketWidth( double width )
+{
+  bucketWidth=width;
 }
 
-void vtkPichonFastMarching::setNPointsEvolution( int n )
+double vtkPichonFastMarching::getBucketWidth( void )
 {
-  nPointsEvolution=n;
+  if( currentBucketWidth>0 )
+    return currentBucketWidth;
+  return bucketWidth;
+}
+
+double vtkPichonFastMarching::memoryBytesPerVoxel( void )
+{
+  double bytes = 0.0;
+  if(nodeT!=nullptr)
+    bytes += sizeof(float);
+  if(nodeStatus!=nullptr)
+    bytes += 0.5; // 4 bits
+  if(nodeLeafIndex!=nullptr)
+    bytes += sizeof(int);
+  if(nodeLabel!=nullptr)
+    bytes += sizeof(unsigned char);
+  if(inhomo!=nullptr)
+    bytes += sizeof(short);
+  if(median!=nullptr)
+    bytes += sizeof(short);
+  if(Internals->InputCopy!=nullptr)
+    bytes += Internals->InputCopy->GetScalarSize();
+  if(!Internals->PreviewOutput.empty())
+    bytes += sizeof(short);
+  return bytes;
 }
 
 void vtkPichonFastMarching::PrintSelf(ostream& os, vtkIndent indent)
@@ -543,18 +1242,101 @@ void vtkPichonFastMarching::PrintSelf(ostream& os, vtkIndent indent)
   os << indent << "dimZ: " << this->dimZ << "\n";
   os << indent << "dimXY: " << this->dimXY << "\n";
   os << indent << "label: " << this->label << "\n";
+  os << indent << "multiLabel: " << this->multiLabel << "\n";
+  os << indent << "number of labels: " << (unsigned int)this->labelValues.size() << "\n";
+  os << indent << "numberOfThreads: " << this->numberOfThreads << "\n";
+  os << indent << "precomputeStatistics: " << this->precomputeStatistics << "\n";
+  os << indent << "statisticsUpdateRate: " << this->statisticsUpdateRate << "\n";
+  os << indent << "copyInput: " << this->copyInput << "\n";
+  os << indent << "priorityQueueType: " << this->priorityQueueType << "\n";
+  os << indent << "bucketWidth: " << this->getBucketWidth() << "\n";
+  os << indent << "number of intensity bin edges: " << (unsigned int)this->intensityBinEdges.size() << "\n";
+  os << indent << "memoryBytesPerVoxel: " << this->memoryBytesPerVoxel() << "\n";
 }
 
 bool vtkPichonFastMarching::emptyTree(void)
 {
+  if( priorityQueueType==PriorityQueueBucket )
+    return (nTrialInBuckets==0);
+
   return (tree.size()==0);
 }
 
+FMindex vtkPichonFastMarching::treeSize(void)
+{
+  if( priorityQueueType==PriorityQueueBucket )
+    return nTrialInBuckets;
+
+  return (FMindex)tree.size();
+}
+
+void vtkPichonFastMarching::clearTree(void)
+{
+  // all the points in the front go back to fmsFAR
+  while(tree.size()>0)
+    {
+      setStatus(tree[tree.size()-1].nodeIndex,fmsFAR);
+      nodeT[ tree[tree.size()-1].nodeIndex ]=(float)INF;
+      tree.pop_back();
+    }
+
+  // buckets may contain outdated entries, only reset nodes still in the front
+  for(unsigned int b=0;b<buckets.size();b++)
+    {
+      for(size_t k=0;k<buckets[b].size();k++)
+    if( getStatus(buckets[b][k].nodeIndex)==fmsTRIAL )
+      {
+        setStatus(buckets[b][k].nodeIndex,fmsFAR);
+        nodeT[ buckets[b][k].nodeIndex ]=(float)INF;
+      }
+      buckets[b].clear();
+    }
+  for(size_t k=0;k<bucketOverflow.size();k++)
+    if( getStatus(bucketOverflow[k].nodeIndex)==fmsTRIAL )
+      {
+    setStatus(bucketOverflow[k].nodeIndex,fmsFAR);
+    nodeT[ bucketOverflow[k].nodeIndex ]=(float)INF;
+      }
+  bucketOverflow.clear();
+  for(size_t k=0;k<bucketEarly.size();k++)
+    if( getStatus(bucketEarly[k].nodeIndex)==fmsTRIAL )
+      {
+    setStatus(bucketEarly[k].nodeIndex,fmsFAR);
+    nodeT[ bucketEarly[k].nodeIndex ]=(float)INF;
+      }
+  bucketEarly.clear();
+
+  currentBucketWidth=bucketWidth;
+  currentBucketKey=0.0;
+  currentBucket=0;
+  nEntriesInBuckets=0;
+  nTrialInBuckets=0;
+}
+
 void vtkPichonFastMarching::insert(const FMleaf leaf) {
 
+  if( priorityQueueType==PriorityQueueBucket )
+    {
+      nTrialInBuckets++;
+      bucketInsert( leaf.nodeIndex );
+      return;
+    }
+
+  // positions in the minheap are stored as int
+  if( tree.size()>=(size_t)INT_MAX )
+    {
+      // the point cannot be queued, stop marching instead of leaving it
+      // TRIAL forever (the front would silently stop growing there)
+      vtkErrorMacro("Error in vtkPichonFastMarching::insert(...): too many points in the minheap, use the bucket priority queue");
+      setStatus(leaf.nodeIndex,fmsFAR);
+      nodeT[ leaf.nodeIndex ]=(float)INF;
+      this->SetAbortExecute(1);
+      return;
+    }
+
   // insert element at the back
   tree.push_back( leaf );
-  node[ leaf.nodeIndex ].leafIndex=(int)(tree.size()-1);
+  nodeLeafIndex[ leaf.nodeIndex ]=(int)(tree.size()-1);
 
   // trickle the element up until everything
   // is sorted again
@@ -568,7 +1350,7 @@ bool vtkPichonFastMarching::minHeapIsSorted( void )
 
   for(k=(N-1);k>=1;k--)
     {
-      if(node[tree[k].nodeIndex].leafIndex!=k)
+      if(nodeLeafIndex[tree[k].nodeIndex]!=k)
     {
       vtkErrorMacro( "Error in vtkPichonFastMarching::minHeapIsSorted(): "
              << "tree[" << k << "] : pb leafIndex/nodeIndex (size="
@@ -577,16 +1359,16 @@ bool vtkPichonFastMarching::minHeapIsSorted( void )
     }
   for(k=(N-1);k>=1;k--)
     {
-      if( vtkMath::IsFinite( node[tree[k].nodeIndex].T)==0 )
+      if( vtkMath::IsFinite( nodeT[tree[k].nodeIndex])==0 )
     vtkErrorMacro( "Error in vtkPichonFastMarching::minHeapIsSorted(): "
-               << "NaN or Inf value in minHeap : " << node[tree[k].nodeIndex].T );
+               << "NaN or Inf value in minHeap : " << nodeT[tree[k].nodeIndex] );
 
-      if( node[tree[k].nodeIndex].T<node[ (int)(tree[(k-1)/2].nodeIndex) ].T )
+      if( nodeT[tree[k].nodeIndex]<nodeT[ tree[(k-1)/2].nodeIndex ] )
     {
       vtkErrorMacro( "Error in vtkPichonFastMarching::minHeapIsSorted(): "
              << "minHeapIsSorted is false! : size=" << (unsigned int)tree.size() << "at leafIndex=" << k
-             << " node[tree[k].nodeIndex].T=" << node[tree[k].nodeIndex].T
-             << "<node[ (int)(tree[(k-1)/2].nodeIndex) ].T=" << node[ (int)(tree[(k-1)/2].nodeIndex) ].T);
+             << " nodeT[tree[k].nodeIndex]=" << nodeT[tree[k].nodeIndex]
+             << "<nodeT[ tree[(k-1)/2].nodeIndex ]=" << nodeT[ tree[(k-1)/2].nodeIndex ]);
 
       return false;
     }
@@ -626,8 +1408,8 @@ void vtkPichonFastMarching::downTree(int index) {
        */
       if (RightChild < (int)tree.size()) {
 
-    if (node[tree[LeftChild].nodeIndex].T>
-        node[tree[RightChild].nodeIndex].T)
+    if (nodeT[tree[LeftChild].nodeIndex]>
+        nodeT[tree[RightChild].nodeIndex])
       MinChild = RightChild;
       }
 
@@ -635,16 +1417,16 @@ void vtkPichonFastMarching::downTree(int index) {
        * If the MinChild has smaller T than the current leaf,
        * swap them, and move the current leaf to the MinChild.
        */
-      if (node[tree[MinChild].nodeIndex].T<
-      node[tree[index].nodeIndex].T)
+      if (nodeT[tree[MinChild].nodeIndex]<
+      nodeT[tree[index].nodeIndex])
     {
       FMleaf tmp=tree[index];
       tree[index]=tree[MinChild];
       tree[MinChild]=tmp;
 
       // make sure pointers remain correct
-      node[ tree[MinChild].nodeIndex ].leafIndex = MinChild;
-      node[ tree[index].nodeIndex ].leafIndex = index;
+      nodeLeafIndex[ tree[MinChild].nodeIndex ] = MinChild;
+      nodeLeafIndex[ tree[index].nodeIndex ] = index;
 
       index = MinChild;
 
@@ -672,8 +1454,8 @@ void vtkPichonFastMarching::upTree(int index) {
     {
       int upIndex = (int) (index-1)/2;
 
-      if( node[tree[index].nodeIndex].T <
-      node[tree[upIndex].nodeIndex].T )
+      if( nodeT[tree[index].nodeIndex] <
+      nodeT[tree[upIndex].nodeIndex] )
     {
       // then swap the 2 nodes
 
@@ -682,8 +1464,8 @@ void vtkPichonFastMarching::upTree(int index) {
       tree[upIndex]=tmp;
 
       // make sure pointers remain correct
-      node[ tree[upIndex].nodeIndex ].leafIndex = upIndex;
-      node[ tree[index].nodeIndex ].leafIndex = index;
+      nodeLeafIndex[ tree[upIndex].nodeIndex ] = upIndex;
+      nodeLeafIndex[ tree[index].nodeIndex ] = index;
 
       index = upIndex;
     }
@@ -694,9 +1476,35 @@ void vtkPichonFastMarching::upTree(int index) {
     }
 }
 
-FMleaf vtkPichonFastMarching::removeSmallest( void ) {
+void vtkPichonFastMarching::updateLeaf(FMindex nodeIndex, float previousT)
+{
+  if( priorityQueueType==PriorityQueueBucket )
+    {
+      // the previous entry becomes outdated, it will be skipped when reached
+      bucketInsert( nodeIndex );
+      return;
+    }
+
+  if( nodeT[nodeIndex]<previousT )
+    upTree( nodeLeafIndex[nodeIndex] );
+  else
+    downTree( nodeLeafIndex[nodeIndex] );
+}
+
+bool vtkPichonFastMarching::removeSmallest( FMleaf &f ) {
+
+  if( priorityQueueType==PriorityQueueBucket )
+    {
+      if( !bucketRemoveSmallest( f ) )
+    {
+      // only points that cannot be reached are left
+      nTrialInBuckets=0;
+      return false;
+    }
+      nTrialInBuckets--;
+      return true;
+    }
 
-  FMleaf f;
   f=tree[0];
 
   /*
@@ -705,7 +1513,7 @@ FMleaf vtkPichonFastMarching::removeSmallest( void ) {
   tree[0]=tree[ tree.size()-1 ];
 
   // make sure pointers remain correct
-  node[ tree[0].nodeIndex ].leafIndex = 0;
+  nodeLeafIndex[ tree[0].nodeIndex ] = 0;
 
   tree.pop_back();
 
@@ -713,7 +1521,195 @@ FMleaf vtkPichonFastMarching::removeSmallest( void ) {
   // is sorted again
   downTree( 0 );
 
-  return f;
+  return true;
+}
+
+/*
+ * Bucket (untidy) priority queue, see Yatziv, Bartesaghi and Sapiro,
+ * "O(N) implementation of the fast marching algorithm", JCP 2006.
+ *
+ * Points are put in the bucket floor(T/currentBucketWidth). Buckets form a
+ * circular array of N_BUCKETS that covers the arrival times following the
+ * current bucket, points beyond that range wait in a minheap (bucketOverflow)
+ * until the current bucket gets close enough. Points in the same bucket are
+ * not sorted, which results in an error of at most one bucket width on the
+ * arrival times.
+ *
+ * Entries are never removed from the middle of a bucket: when the arrival
+ * time of a point changes, a new entry is added and the old one is skipped
+ * when reached (it no longer matches nodeT[] or the point is no longer TRIAL).
+ *
+ * Unlike in the standard algorithm, arrival times are not monotonic: the speed
+ * changes as the statistics of the front are updated, and the first arrival
+ * times around the seeds are computed before these statistics are known (with
+ * a very low speed). Therefore the automatic width is reduced when a faster
+ * crossing is found, and points that arrive more than one bucket before the
+ * current one are ordered exactly in a second minheap (bucketEarly), which is
+ * emptied first. If it gets larger than the circular array, all the points are
+ * put back in bucketOverflow and the circular array restarts at the first one.
+ */
+
+struct FMbucketEntryGreater
+{
+  bool operator()(const FMbucketEntry &a, const FMbucketEntry &b) const
+  {
+    return a.T > b.T;
+  }
+};
+
+double vtkPichonFastMarching::bucketKey(float T)
+{
+  if( currentBucketWidth<=0 )
+    return 0.0;
+  return floor( double(T)/currentBucketWidth );
+}
+
+void vtkPichonFastMarching::bucketInsert(FMindex nodeIndex)
+{
+  FMbucketEntry entry;
+  entry.nodeIndex=nodeIndex;
+  entry.T=nodeT[nodeIndex];
+
+  if( (entry.T>0) && (entry.T<INF)
+    && ( (currentBucketWidth<=0) || ((bucketWidth<=0) && (2.0*entry.T<currentBucketWidth)) ) )
+    {
+      // the arrival time of a point is at least the time needed to cross
+      // one voxel, a bucket covers half of the fastest crossing seen so far
+      currentBucketWidth=0.5*entry.T;
+      bucketRebase();
+    }
+
+  if( (entry.T>=INF) || (bucketKey(entry.T)>=currentBucketKey+N_BUCKETS) )
+    {
+      bucketOverflow.push_back( entry );
+      std::push_heap( bucketOverflow.begin(), bucketOverflow.end(), FMbucketEntryGreater() );
+      return;
+    }
+
+  if( bucketKey(entry.T)<currentBucketKey-1.0 )
+    {
+      // the front got faster
+      bucketEarly.push_back( entry );
+      std::push_heap( bucketEarly.begin(), bucketEarly.end(), FMbucketEntryGreater() );
+      if( (FMindex)bucketEarly.size()>std::max<FMindex>(nEntriesInBuckets, N_BUCKETS) )
+    bucketRebase();
+      return;
+    }
+
+  bucketPushToRing( entry );
+}
+
+void vtkPichonFastMarching::bucketRebase( void )
+{
+  // outdated entries are dropped
+  for(size_t b=0;b<buckets.size();b++)
+    {
+      for(size_t k=0;k<buckets[b].size();k++)
+    if( (getStatus(buckets[b][k].nodeIndex)==fmsTRIAL) && (nodeT[buckets[b][k].nodeIndex]==buckets[b][k].T) )
+      bucketOverflow.push_back( buckets[b][k] );
+      buckets[b].clear();
+    }
+  for(size_t k=0;k<bucketEarly.size();k++)
+    if( (getStatus(bucketEarly[k].nodeIndex)==fmsTRIAL) && (nodeT[bucketEarly[k].nodeIndex]==bucketEarly[k].T) )
+      bucketOverflow.push_back( bucketEarly[k] );
+  bucketEarly.clear();
+  std::make_heap( bucketOverflow.begin(), bucketOverflow.end(), FMbucketEntryGreater() );
+
+  // the circular array restarts at the first point
+  nEntriesInBuckets=0;
+  currentBucket=0;
+  currentBucketKey=0.0;
+  if( (bucketOverflow.size()>0) && (bucketOverflow[0].T<INF) )
+    currentBucketKey=bucketKey( bucketOverflow[0].T );
+}
+
+void vtkPichonFastMarching::bucketPushToRing(const FMbucketEntry &entry)
+{
+  if( buckets.size()!=N_BUCKETS )
+    buckets.resize(N_BUCKETS);
+
+  // points arriving before the current bucket (because of the untidy
+  // ordering) are processed as soon as possible
+  int offset=0;
+  double key=bucketKey(entry.T);
+  if( key>currentBucketKey )
+    offset=(int)std::min( key-currentBucketKey, double(N_BUCKETS-1) );
+
+  buckets[ (currentBucket+offset)%N_BUCKETS ].push_back( entry );
+  nEntriesInBuckets++;
+}
+
+bool vtkPichonFastMarching::bucketRemoveSmallest(FMleaf &leaf)
+{
+  // points that arrive before the current bucket
+  while( bucketEarly.size()>0 )
+    {
+      std::pop_heap( bucketEarly.begin(), bucketEarly.end(), FMbucketEntryGreater() );
+      FMbucketEntry entry=bucketEarly[bucketEarly.size()-1];
+      bucketEarly.pop_back();
+      if( (getStatus(entry.nodeIndex)==fmsTRIAL) && (nodeT[entry.nodeIndex]==entry.T) )
+    {
+      leaf.nodeIndex=entry.nodeIndex;
+      return true;
+    }
+    }
+
+  while( (nEntriesInBuckets>0) || (bucketOverflow.size()>0) )
+    {
+      if( nEntriesInBuckets==0 )
+    {
+      if( bucketOverflow[0].T>=INF )
+        {
+          // Only points with infinite arrival time are left (put back by show()
+          // or not computable), the front cannot reach them. They become fmsFAR,
+          // so that they can still be reached from a new neighbor later.
+          for(size_t k=0;k<bucketOverflow.size();k++)
+        if( getStatus(bucketOverflow[k].nodeIndex)==fmsTRIAL )
+          {
+            setStatus(bucketOverflow[k].nodeIndex,fmsFAR);
+            nodeT[ bucketOverflow[k].nodeIndex ]=(float)INF;
+          }
+          bucketOverflow.clear();
+          return false;
+        }
+
+      // nothing left in the circular array, jump to the first overflow point
+      double key=bucketKey( bucketOverflow[0].T );
+      if( key>currentBucketKey )
+        currentBucketKey=key;
+    }
+
+      // move the overflow points that are now in range to the circular array
+      // (points with infinite arrival time are never moved)
+      while( (bucketOverflow.size()>0) && (bucketOverflow[0].T<INF)
+         && ( (nEntriesInBuckets==0) || (bucketKey(bucketOverflow[0].T)<currentBucketKey+N_BUCKETS) ) )
+    {
+      std::pop_heap( bucketOverflow.begin(), bucketOverflow.end(), FMbucketEntryGreater() );
+      FMbucketEntry entry=bucketOverflow[bucketOverflow.size()-1];
+      bucketOverflow.pop_back();
+      bucketPushToRing( entry );
+    }
+
+      VecFMbucketEntry &bucket=buckets[currentBucket];
+      while( bucket.size()>0 )
+    {
+      FMbucketEntry entry=bucket[bucket.size()-1];
+      bucket.pop_back();
+      nEntriesInBuckets--;
+
+      if( (getStatus(entry.nodeIndex)==fmsTRIAL) && (nodeT[entry.nodeIndex]==entry.T) )
+        {
+          leaf.nodeIndex=entry.nodeIndex;
+          return true;
+        }
+    }
+
+      // current bucket is empty, go to the next one
+      currentBucket=(currentBucket+1)%N_BUCKETS;
+      currentBucketKey+=1.0;
+    }
+
+  return false;
 }
 
 ///////////////////////////////////////////////////////////////////////
@@ -724,12 +1720,49 @@ vtkPichonFastMarching::vtkPichonFastMarching()
   initialized=false;
   invalidInputs=true;
 
-  node = nullptr;
+  Internals = new vtkInternals;
+
+  numberOfThreads=0;
+  precomputeStatistics=true;
+
+  statisticsUpdateRate=0;
+
+  previewInterval=0;
+  copyInput=true;
+
+  leakDetectionRatio=0.0;
+  leakOnsetPoints=0;
+
+  priorityQueueType=PriorityQueueBinaryHeap;
+  bucketWidth=0.0;
+  currentBucketWidth=0.0;
+  currentBucketKey=0.0;
+  currentBucket=0;
+  nEntriesInBuckets=0;
+  nTrialInBuckets=0;
+
+  indata = nullptr;
+  indataScalarType = VTK_SHORT;
+
+  showModifiedExtent[0]=showModifiedExtent[2]=showModifiedExtent[4]=0;
+  showModifiedExtent[1]=showModifiedExtent[3]=showModifiedExtent[5]=-1;
+  outdata = nullptr;
+
+  nodeT = nullptr;
+  nodeStatus = nullptr;
+  nodeLeafIndex = nullptr;
+  nodeLabel = nullptr;
   inhomo = nullptr;
   median = nullptr;
 
-  pdfIntensityIn = nullptr;
-  pdfInhomoIn = nullptr;
+  dimXYZ = 0;
+
+  nKnownSeedPoints = 0;
+  nEmptyTreeSteps = 0;
+
+  label = 0;
+  multiLabel = false;
+  seedLabelIndex = 0;
 }
 
 void vtkPichonFastMarching::init(int _dimX, int _dimY, int _dimZ, double _depth, double _dx, double _dy, double _dz)
@@ -749,12 +1782,27 @@ void vtkPichonFastMarching::init(int _dimX, int _dimY, int _dimZ, double _depth,
   //and A==0 when 26
 
   nEvolutions=-1;
+  nEmptyTreeSteps=0;
+
+  if( (double)_dimX*_dimY*_dimZ > (double)std::numeric_limits<FMindex>::max() )
+    {
+      vtkErrorMacro("Error in void vtkPichonFastMarching::init(), the image has too many voxels for the voxel index type ("
+                    << sizeof(FMindex)*8 << " bits)");
+      return;
+    }
 
   this->dimX=_dimX;
   this->dimY=_dimY;
   this->dimZ=_dimZ;
-  this->dimXY=dimX*dimY;
-  this->dimXYZ=dimX*dimY*dimZ;
+  this->dimXY=(FMindex)dimX*dimY;
+  this->dimXYZ=dimXY*dimZ;
+
+  imageExtent[0]=0;
+  imageExtent[1]=dimX-1;
+  imageExtent[2]=0;
+  imageExtent[3]=dimY-1;
+  imageExtent[4]=0;
+  imageExtent[5]=dimZ-1;
 
   arrayShiftNeighbor[0] = 0; // neighbor 0 is the node itself
   arrayDistanceNeighbor[0] = 0.0;
@@ -815,17 +1863,59 @@ void vtkPichonFastMarching::init(int _dimX, int _dimY, int _dimZ, double _depth,
   arrayDistanceNeighbor[26] = sqrt( dx*dx + dy*dy + dz*dz );
 
   this->depth = (int) _depth;
+  if( depth>SHRT_MAX )
+    {
+      vtkErrorMacro("Error in void vtkPichonFastMarching::init(), depth=" << depth << " is larger than " << SHRT_MAX);
+      return;
+    }
+
+  delete[] nodeT;
+  nodeT = new float[ dimXYZ ];
+  if(nodeT==nullptr)
+    {
+      vtkErrorMacro("Error in void vtkPichonFastMarching::init(), not enough memory for allocation of 'nodeT'");
+      return;
+    }
+
+  delete[] nodeStatus;
+  nodeStatus = new unsigned char[ (dimXYZ+1)/2 ];
+  if(nodeStatus==nullptr)
+    {
+      vtkErrorMacro("Error in void vtkPichonFastMarching::init(), not enough memory for allocation of 'nodeStatus'");
+      return;
+    }
+
+  // position in the minheap is only needed if the minheap is used
+  delete[] nodeLeafIndex;
+  nodeLeafIndex = nullptr;
+  if( priorityQueueType==PriorityQueueBinaryHeap )
+    {
+      nodeLeafIndex = new int[ dimXYZ ];
+      if(nodeLeafIndex==nullptr)
+    {
+      vtkErrorMacro("Error in void vtkPichonFastMarching::init(), not enough memory for allocation of 'nodeLeafIndex'");
+      return;
+    }
+    }
 
-  delete[] node;
-  node = new FMnode[ dimX*dimY*dimZ ];
-  if(node==nullptr)
+  // front of each point is only needed in multi-label mode
+  delete[] nodeLabel;
+  nodeLabel = nullptr;
+  if( multiLabel )
+    {
+      nodeLabel = new unsigned char[ dimXYZ ];
+      if(nodeLabel==nullptr)
     {
-      vtkErrorMacro("Error in void vtkPichonFastMarching::init(), not enough memory for allocation of 'node'");
+      vtkErrorMacro("Error in void vtkPichonFastMarching::init(), not enough memory for allocation of 'nodeLabel'");
       return;
     }
+      memset( nodeLabel, 0, dimXYZ );
+    }
+  labelValues.clear();
+  seedLabelIndex=0;
 
   delete[] inhomo;
-  inhomo = new int[ dimX*dimY*dimZ ];
+  inhomo = new short[ dimXYZ ];
   if(inhomo==nullptr)
     {
       vtkErrorMacro("Error in void vtkPichonFastMarching::init(), not enough memory for allocation of 'inhomo'");
@@ -833,40 +1923,172 @@ void vtkPichonFastMarching::init(int _dimX, int _dimY, int _dimZ, double _depth,
     }
 
   delete[] median;
-  median = new int[ dimX*dimY*dimZ ];
+  median = new short[ dimXYZ ];
   if(median==nullptr)
     {
       vtkErrorMacro("Error in void vtkPichonFastMarching::init(), not enough memory for allocation of 'median'");
       return;
     }
 
-  delete pdfIntensityIn;
-  pdfIntensityIn = new PichonFastMarchingPDF( (int) _depth );
-  if(pdfIntensityIn==nullptr)
+  // statistics of the first front, in multi-label mode the statistics
+  // of the other fronts are created when their seeds are added
+  deletePDFs();
+  pdfIntensityIn.push_back( new PichonFastMarchingPDF( (int) _depth ) );
+  pdfInhomoIn.push_back( new PichonFastMarchingPDF( (int) _depth ) );
+
+  tree.clear();
+  buckets.clear();
+  bucketOverflow.clear();
+  bucketEarly.clear();
+  currentBucketWidth=bucketWidth;
+  currentBucketKey=0.0;
+  currentBucket=0;
+  nEntriesInBuckets=0;
+  nTrialInBuckets=0;
+
+  initialized=false; // we will need one pass in the execute
+  // function before we are properly initialized
+
+  firstCall = true;
+
+  invalidInputs = false; // so far so good
+}
+
+void vtkPichonFastMarching::setStatisticsImage(vtkImageData* image)
+{
+  if( (image!=nullptr)
+    && ( (image->GetScalarType()!=VTK_SHORT) || (image->GetNumberOfScalarComponents()!=2) ) )
     {
-      vtkErrorMacro("Error in void vtkPichonFastMarching::init(), not enough memory for allocation of 'pdfIntensityIn'");
+      vtkErrorMacro("Error in vtkPichonFastMarching::setStatisticsImage(...): image must have 2 components of type SHORT");
       return;
     }
+  statisticsImage=image;
+}
 
-  delete pdfInhomoIn;
-  pdfInhomoIn = new PichonFastMarchingPDF( (int) _depth );
-  if(pdfInhomoIn==nullptr)
+void vtkPichonFastMarching::setMaskImage(vtkImageData* image)
+{
+  if( (image!=nullptr) && (image->GetScalarType()!=VTK_UNSIGNED_CHAR) )
     {
-      vtkErrorMacro("Error in void vtkPichonFastMarching::init(), not enough memory for allocation of 'pdfInhomoIn'");
+      vtkErrorMacro("Error in vtkPichonFastMarching::setMaskImage(...): image must be of type UNSIGNED CHAR");
       return;
     }
+  maskImage=image;
+}
+
+void vtkPichonFastMarching::applyMaskImage( void )
+{
+  if( (maskImage==nullptr) || invalidInputs )
+    return;
+
+  int extent[6];
+  maskImage->GetExtent(extent);
+  vtkIdType inc[3];
+  maskImage->GetIncrements(inc);
+  unsigned char* mask = static_cast<unsigned char*>(maskImage->GetScalarPointer());
+
+  // two voxels share a status byte, so this is not done in parallel
+  for(int k=std::max(extent[4],imageExtent[4]);k<=std::min(extent[5],imageExtent[5]);k++)
+    for(int j=std::max(extent[2],imageExtent[2]);j<=std::min(extent[3],imageExtent[3]);j++)
+      for(int i=std::max(extent[0],imageExtent[0]);i<=std::min(extent[1],imageExtent[1]);i++)
+    {
+      if( mask[(k-extent[4])*inc[2]+(j-extent[2])*inc[1]+(i-extent[0])*inc[0]]==0 )
+        continue;
+      FMindex index=(i-imageExtent[0])+(FMindex)(j-imageExtent[2])*dimX+(k-imageExtent[4])*dimXY;
+      if( getStatus(index)==fmsFAR )
+        setStatus(index,fmsOUT);
+    }
+}
 
-  initialized=false; // we will need one pass in the execute
-  // function before we are properly initialized
+vtkImageData* vtkPichonFastMarching::getStatisticsImage( void )
+{
+  return statisticsImage;
+}
 
-  firstCall = true;
+void vtkPichonFastMarching::setIntensityBinEdges(vtkDoubleArray* edges)
+{
+  intensityBinEdges.clear();
+  if( edges==nullptr )
+    return;
 
-  invalidInputs = false; // so far so good
+  for(vtkIdType k=0;k<edges->GetNumberOfTuples();k++)
+    intensityBinEdges.push_back( edges->GetValue(k) );
+
+  if( !std::is_sorted( intensityBinEdges.begin(), intensityBinEdges.end() ) )
+    {
+      vtkErrorMacro("Error in vtkPichonFastMarching::setIntensityBinEdges(...): edges must be in increasing order");
+      intensityBinEdges.clear();
+    }
+}
+
+void vtkPichonFastMarching::readStatisticsImage( void )
+{
+  if( (statisticsImage==nullptr) || invalidInputs )
+    return;
+
+  int extent[6];
+  statisticsImage->GetExtent(extent);
+  vtkIdType inc[3];
+  statisticsImage->GetIncrements(inc);
+  short* statistics = static_cast<short*>(statisticsImage->GetScalarPointer());
+
+  // slices are processed in parallel
+  vtkPichonFastMarchingParallelFor(numberOfThreads,
+    std::max(extent[4],imageExtent[4]), std::min(extent[5],imageExtent[5])+1,
+    [&](vtkIdType beginK, vtkIdType endK)
+    {
+  for(int k=(int)beginK;k<(int)endK;k++)
+    for(int j=std::max(extent[2],imageExtent[2]);j<=std::min(extent[3],imageExtent[3]);j++)
+      for(int i=std::max(extent[0],imageExtent[0]);i<=std::min(extent[1],imageExtent[1]);i++)
+    {
+      FMindex index=(i-imageExtent[0])+(FMindex)(j-imageExtent[2])*dimX+(k-imageExtent[4])*dimXY;
+      // values at the image boundary are not computed from the neighborhood
+      if( getStatus(index)==fmsOUT )
+        continue;
+      short* s=statistics+(k-extent[4])*inc[2]+(j-extent[2])*inc[1]+(i-extent[0])*inc[0];
+      if( s[1]!=-1 )
+        {
+          median[index]=s[0];
+          inhomo[index]=s[1];
+        }
+    }
+    });
+}
+
+void vtkPichonFastMarching::writeStatisticsImage( void )
+{
+  if( (statisticsImage==nullptr) || invalidInputs )
+    return;
+
+  int extent[6];
+  statisticsImage->GetExtent(extent);
+  vtkIdType inc[3];
+  statisticsImage->GetIncrements(inc);
+  short* statistics = static_cast<short*>(statisticsImage->GetScalarPointer());
+
+  // slices are processed in parallel
+  vtkPichonFastMarchingParallelFor(numberOfThreads,
+    std::max(extent[4],imageExtent[4]), std::min(extent[5],imageExtent[5])+1,
+    [&](vtkIdType beginK, vtkIdType endK)
+    {
+  for(int k=(int)beginK;k<(int)endK;k++)
+    for(int j=std::max(extent[2],imageExtent[2]);j<=std::min(extent[3],imageExtent[3]);j++)
+      for(int i=std::max(extent[0],imageExtent[0]);i<=std::min(extent[1],imageExtent[1]);i++)
+    {
+      FMindex index=(i-imageExtent[0])+(FMindex)(j-imageExtent[2])*dimX+(k-imageExtent[4])*dimXY;
+      if( (getStatus(index)==fmsOUT) || (inhomo[index]==-1) )
+        continue;
+      short* s=statistics+(k-extent[4])*inc[2]+(j-extent[2])*inc[1]+(i-extent[0])*inc[0];
+      s[0]=median[index];
+      s[1]=inhomo[index];
+    }
+    });
+  statisticsImage->Modified();
 }
 
 void vtkPichonFastMarching::setInData(short* data)
 {
   indata=data;
+  indataScalarType=VTK_SHORT;
 }
 
 void vtkPichonFastMarching::setOutData(short* data)
@@ -876,20 +2098,30 @@ void vtkPichonFastMarching::setOutData(short* data)
 
 vtkPichonFastMarching::~vtkPichonFastMarching()
 {
-  delete[] node;
-  node = nullptr;
+  // stop processing before deleting the buffers
+  this->SetAbortExecute(1);
+  waitForBackgroundUpdate();
+
+  delete[] nodeT;
+  nodeT = nullptr;
+  delete[] nodeStatus;
+  nodeStatus = nullptr;
+  delete[] nodeLeafIndex;
+  nodeLeafIndex = nullptr;
   delete[] inhomo;
   inhomo = nullptr;
   delete[] median;
   median = nullptr;
 
-  delete pdfIntensityIn;
-  pdfIntensityIn = nullptr;
-  delete pdfInhomoIn;
-  pdfInhomoIn = nullptr;
+  delete[] nodeLabel;
+  nodeLabel = nullptr;
+
+  deletePDFs();
+
+  delete Internals;
 }
 
-inline int vtkPichonFastMarching::shiftNeighbor(int n)
+inline FMindex vtkPichonFastMarching::shiftNeighbor(int n)
 {
   //assert(initialized);
   //assert(n>=0 && n<=nNeighbors);
@@ -905,19 +2137,19 @@ inline double vtkPichonFastMarching::distanceNeighbor(int n)
   return arrayDistanceNeighbor[n];
 }
 
-int vtkPichonFastMarching::indexFather(int n )
+FMindex vtkPichonFastMarching::indexFather(FMindex n )
 {
   float Tmin = (float)INF;
-  int index, indexMin = 0;
+  FMindex index, indexMin = 0;
 
   // note: has to be 6 or else topology not consistent and
   // we get weird path to parents using the diagonals
   for(int k=1;k<=6;k++)
   {
     index = n+shiftNeighbor(k);
-    if( node[index].T<Tmin )
+    if( nodeT[index]<Tmin )
     {
-      Tmin = node[index].T;
+      Tmin = nodeT[index];
       indexMin = index;
     }
   }
@@ -933,7 +2165,7 @@ float vtkPichonFastMarching::step( void )
   if(invalidInputs)
     return (float)INF;
 
-  int indexN;
+  FMindex indexN;
   int n;
 
   FMleaf min;
@@ -941,22 +2173,23 @@ float vtkPichonFastMarching::step( void )
   /* find point in fmsTRIAL with smallest T, remove it from fmsTRIAL and put
      it in fmsKNOWN */
 
-  static int emptyTreeCnt;
   if( emptyTree() )
     {
-      if(emptyTreeCnt == 0)
+      // all the voxels that are not masked may have been reached
+      if( (nEmptyTreeSteps == 0) && (maskImage==nullptr) )
         {
         vtkErrorMacro( "vtkPichonFastMarching::step empty tree!" << endl );
         }
-      emptyTreeCnt++;
+      nEmptyTreeSteps++;
       return (float)INF;
     }
 
-  min=removeSmallest();
+  if( !removeSmallest(min) )
+    return (float)INF;
 
-  if( node[min.nodeIndex].T>=INF )
+  if( nodeT[min.nodeIndex]>=INF )
     {
-      vtkErrorMacro( " node[min.nodeIndex].T>=INF " << endl );
+      vtkErrorMacro( " nodeT[min.nodeIndex]>=INF " << endl );
 
       // this would happen if the only points left were artificially put back
       // by the user playing with the slider
@@ -968,10 +2201,11 @@ float vtkPichonFastMarching::step( void )
   int I, H;
   getMedianInhomo( min.nodeIndex, I, H );
 
-  pdfIntensityIn->addRealization( I );
-  pdfInhomoIn->addRealization( H );
+  int minLabelIndex=labelIndex(min.nodeIndex);
+  pdfIntensityIn[minLabelIndex]->addRealization( I );
+  pdfInhomoIn[minLabelIndex]->addRealization( H );
 
-  node[min.nodeIndex].status=fmsKNOWN;
+  setStatus(min.nodeIndex,fmsKNOWN);
   knownPoints.push_back(min.nodeIndex);
 
   /* then we consider all the neighbors */
@@ -989,37 +2223,49 @@ float vtkPichonFastMarching::step( void )
        * If they are fmsFAR, recompute their crossing times, and move
        * them into fmsTRIAL.
        */
-      if( node[indexN].status==fmsFAR )
+      if( getStatus(indexN)==fmsFAR )
     {
       FMleaf f;
-      node[indexN].T=computeT(indexN);
+      if(nodeLabel!=nullptr)
+        nodeLabel[indexN]=(unsigned char)minLabelIndex;
+      nodeT[indexN]=computeT(indexN);
       f.nodeIndex=indexN;
 
       insert( f );
 
-      node[indexN].status=fmsTRIAL;
+      setStatus(indexN,fmsTRIAL);
     }
-      else if( node[indexN].status==fmsTRIAL )
+      else if( getStatus(indexN)==fmsTRIAL )
     {
-      float t1,  t2;
-      t1 = node[indexN].T;
+      float t1;
+      t1 = nodeT[indexN];
 
-      node[indexN].T=computeT(indexN);
-
-      t2 = node[indexN].T;
+      if( (nodeLabel!=nullptr) && (nodeLabel[indexN]!=minLabelIndex) )
+        {
+          // competing fronts: the point belongs to the front that arrives first
+          unsigned char previousLabelIndex=nodeLabel[indexN];
+          nodeLabel[indexN]=(unsigned char)minLabelIndex;
+          float t2=computeT(indexN);
+          if( t2<t1 )
+        {
+          nodeT[indexN]=t2;
+          updateLeaf( indexN, t1 );
+        }
+          else
+        nodeLabel[indexN]=previousLabelIndex;
+          continue;
+        }
 
-      if( t2<t1 )
-          upTree( node[indexN].leafIndex );
-      else
-          downTree( node[indexN].leafIndex );
+      nodeT[indexN]=computeT(indexN);
 
+      updateLeaf( indexN, t1 );
     }
     }
 
-  return node[min.nodeIndex].T;
+  return nodeT[min.nodeIndex];
 }
 
-float vtkPichonFastMarching::computeT(int index )
+float vtkPichonFastMarching::computeT(FMindex index )
 {
   double A, B, C, Discr;
 
@@ -1041,16 +2287,16 @@ float vtkPichonFastMarching::computeT(int index )
 
   double Tij, Txm, Txp, Tym, Typ, Tzm, Tzp, TijNew;
 
-  Tij = node[index].T;
+  Tij = nodeT[index];
 
   /* we know that all neighbors are defined
      because this node is not fmsOUT */
-  Txm = node[index+shiftNeighbor(4)].T;
-  Txp = node[index+shiftNeighbor(2)].T;
-  Tym = node[index+shiftNeighbor(1)].T;
-  Typ = node[index+shiftNeighbor(3)].T;
-  Tzm = node[index+shiftNeighbor(5)].T;
-  Tzp = node[index+shiftNeighbor(6)].T;
+  Txm = neighborT(index, index+shiftNeighbor(4));
+  Txp = neighborT(index, index+shiftNeighbor(2));
+  Tym = neighborT(index, index+shiftNeighbor(1));
+  Typ = neighborT(index, index+shiftNeighbor(3));
+  Tzm = neighborT(index, index+shiftNeighbor(5));
+  Tzp = neighborT(index, index+shiftNeighbor(6));
 
   double Dxm, Dxp, Dym, Dyp, Dzm, Dzp;
 
@@ -1106,17 +2352,17 @@ float vtkPichonFastMarching::computeT(int index )
 
   // cases when the quadratic equation is singular
   if ((A==0) || (Discr < 0.0)) {
-    int candidateIndex;
+    FMindex candidateIndex;
     double candidateT;
     Tij=INF;
     s=speed(index);
     for(int n=1;n<=nNeighbors;n++)
       {
     candidateIndex = index + shiftNeighbor(n);
-    if( (node[candidateIndex].status==fmsTRIAL)
-        || (node[candidateIndex].status==fmsKNOWN) )
+    if( (getStatus(candidateIndex)==fmsTRIAL)
+        || (getStatus(candidateIndex)==fmsKNOWN) )
       {
-        candidateT = node[candidateIndex].T + distanceNeighbor(n)/s;
+        candidateT = neighborT(index, candidateIndex) + distanceNeighbor(n)/s;
 
         if( candidateT<Tij )
           Tij=candidateT;
@@ -1188,11 +2434,18 @@ int vtkPichonFastMarching::addSeed( float r, float a, float s )
        &&  (J>=1) && (J<(dimY-1))
        &&  (K>=1) && (K<(dimZ-1)) )
     {
-      seedPoints.push_back( I+J*dimX+K*dimXY );
+      if( (nodeLabel!=nullptr) && labelValues.empty() )
+        // seeds that are not added from a label image get the active label
+        seedLabelIndex=addLabelValue( (short)label );
+
+      FMindex index=I+(FMindex)J*dimX+K*dimXY;
+      seedPoints.push_back( index );
+      if(nodeLabel!=nullptr)
+        nodeLabel[ index ]=(unsigned char)seedLabelIndex;
 
       // use neighbors to create statistics
       for(int n=0;n<=26;n++)
-    collectInfoSeed( I+J*dimX+K*dimXY+shiftNeighbor(n) );
+    collectInfoSeed( index+shiftNeighbor(n), seedLabelIndex );
 
       // note: the neighbors will be put in TRIAL by setseed
 
@@ -1216,11 +2469,18 @@ int vtkPichonFastMarching::addSeedIJK( int I, int J, int K )
        &&  (J>=1) && (J<(dimY-1))
        &&  (K>=1) && (K<(dimZ-1)) )
     {
-      seedPoints.push_back( I+J*dimX+K*dimXY );
+      if( (nodeLabel!=nullptr) && labelValues.empty() )
+        // seeds that are not added from a label image get the active label
+        seedLabelIndex=addLabelValue( (short)label );
+
+      FMindex index=I+(FMindex)J*dimX+K*dimXY;
+      seedPoints.push_back( index );
+      if(nodeLabel!=nullptr)
+        nodeLabel[ index ]=(unsigned char)seedLabelIndex;
 
       // use neighbors to create statistics
       for(int n=0;n<=26;n++)
-        collectInfoSeed( I+J*dimX+K*dimXY+shiftNeighbor(n) );
+        collectInfoSeed( index+shiftNeighbor(n), seedLabelIndex );
 
       // note: the neighbors will be put in TRIAL by setseed
 
@@ -1241,21 +2501,57 @@ int vtkPichonFastMarching::addSeedsFromImage(vtkImageData* label)
   int scalarType = label->GetScalarType();
   if(scalarType == VTK_SHORT || scalarType == VTK_UNSIGNED_SHORT)
   {
+    // The label image and the input image may have different extents,
+    // seeds are matched by voxel position (extents may not start at 0).
+    if(this->GetNumberOfInputConnections(0) > 0)
+    {
+      this->UpdateInformation();
+      int inputExtent[6];
+      this->GetInputInformation()->Get(vtkStreamingDemandDrivenPipeline::WHOLE_EXTENT(), inputExtent);
+      if( (inputExtent[1]-inputExtent[0]+1!=dimX)
+        || (inputExtent[3]-inputExtent[2]+1!=dimY)
+        || (inputExtent[5]-inputExtent[4]+1!=dimZ) )
+      {
+        vtkErrorMacro("vtkPichonFastMarching::addSeedsFromImage failed: input extent does not match dimensions set in init()");
+        return 0;
+      }
+      for(int n=0;n<6;n++)
+        imageExtent[n]=inputExtent[n];
+    }
+
     short* bufferPointer = (short*) label->GetPointData()->GetScalars()->GetVoidPointer(0);
     vtkIdType inc[3];
     label->GetIncrements(inc);
     int extent[6];
     label->GetExtent(extent);
 
-    for(int k=0;k<extent[5]+1;k++)
+    // only visit the part of the label image that overlaps with the input
+    int loopExtent[6];
+    for(int n=0;n<3;n++)
     {
-      for(int j=0;j<extent[3]+1;j++)
+      loopExtent[2*n] = std::max(extent[2*n], imageExtent[2*n]);
+      loopExtent[2*n+1] = std::min(extent[2*n+1], imageExtent[2*n+1]);
+    }
+
+    for(int k=loopExtent[4];k<=loopExtent[5];k++)
+    {
+      for(int j=loopExtent[2];j<=loopExtent[3];j++)
       {
-        for(int i=0;i<extent[1]+1;i++)
+        for(int i=loopExtent[0];i<=loopExtent[1];i++)
         {
-          if(bufferPointer[k*inc[2]+j*inc[1]+i])
+          short value = bufferPointer[(k-extent[4])*inc[2]+(j-extent[2])*inc[1]+(i-extent[0])];
+          if(value)
           {
-            this->addSeedIJK(i,j,k);
+            if(nodeLabel!=nullptr)
+            {
+              seedLabelIndex = this->addLabelValue(value);
+              if(seedLabelIndex<0)
+              {
+                seedLabelIndex = 0;
+                return nSeeds;
+              }
+            }
+            this->addSeedIJK(i-imageExtent[0],j-imageExtent[2],k-imageExtent[4]);
             nSeeds++;
           }
         }
@@ -1271,6 +2567,81 @@ int vtkPichonFastMarching::addSeedsFromImage(vtkImageData* label)
   return nSeeds;
 }
 
+void vtkPichonFastMarching::getKnownPointsExtent(int extent[6])
+{
+  // empty extent
+  extent[0]=extent[2]=extent[4]=0;
+  extent[1]=extent[3]=extent[5]=-1;
+
+  if(invalidInputs)
+    return;
+
+  for(size_t n=0;n<knownPoints.size();n++)
+    expandExtent( knownPoints[n], extent );
+}
+
+void vtkPichonFastMarching::expandExtent(FMindex index, int extent[6])
+{
+  bool empty=(extent[1]<extent[0]);
+  int ijk[3];
+  ijk[2]=(int)(index/dimXY);
+  ijk[1]=(int)((index%dimXY)/dimX);
+  ijk[0]=(int)(index%dimX);
+  for(int a=0;a<3;a++)
+    {
+      int position=ijk[a]+imageExtent[2*a];
+      if( empty || (position<extent[2*a]) )
+    extent[2*a]=position;
+      if( empty || (position>extent[2*a+1]) )
+    extent[2*a+1]=position;
+    }
+}
+
+void vtkPichonFastMarching::getArrivalTimeImage(vtkImageData* image)
+{
+  if(invalidInputs || image==nullptr)
+    {
+      vtkErrorMacro("vtkPichonFastMarching::getArrivalTimeImage failed: no valid inputs specified");
+      return;
+    }
+
+  image->SetExtent(imageExtent);
+  if(this->GetInput())
+    {
+      image->SetOrigin(this->GetInput()->GetOrigin());
+      image->SetSpacing(this->GetInput()->GetSpacing());
+    }
+  image->AllocateScalars(VTK_FLOAT, 1);
+
+  float* arrivalTime = static_cast<float*>(image->GetScalarPointer());
+  std::fill(arrivalTime, arrivalTime+dimXYZ, (float)INF);
+  for(size_t n=0;n<knownPoints.size();n++)
+    arrivalTime[ knownPoints[n] ] = nodeT[ knownPoints[n] ];
+}
+
+void vtkPichonFastMarching::getArrivalRankImage(vtkImageData* image)
+{
+  if(invalidInputs || image==nullptr)
+    {
+      vtkErrorMacro("vtkPichonFastMarching::getArrivalRankImage failed: no valid inputs specified");
+      return;
+    }
+
+  image->SetExtent(imageExtent);
+  if(this->GetInput())
+    {
+      image->SetOrigin(this->GetInput()->GetOrigin());
+      image->SetSpacing(this->GetInput()->GetSpacing());
+    }
+  // 64-bit ranks, the number of known points may exceed 2^32
+  image->AllocateScalars(VTK_ID_TYPE, 1);
+
+  vtkIdType* arrivalRank = static_cast<vtkIdType*>(image->GetScalarPointer());
+  std::fill(arrivalRank, arrivalRank+dimXYZ, 0);
+  for(size_t n=0;n<knownPoints.size();n++)
+    arrivalRank[ knownPoints[n] ] = (vtkIdType)(n+1);
+}
+
 char *vtkPichonFastMarching::cxxVersionString(void)
 {
     char *text = new char[100];
@@ -1288,8 +2659,11 @@ void vtkPichonFastMarching::tweak(char *name, double value)
 {
   if( strcmp( name, "sigma2SmoothPDF" )==0 )
     {
-      pdfIntensityIn->sigma2SmoothPDF=value;
-      pdfInhomoIn->sigma2SmoothPDF=value;
+      for(unsigned int l=0;l<pdfIntensityIn.size();l++)
+    {
+      pdfIntensityIn[l]->sigma2SmoothPDF=value;
+      pdfInhomoIn[l]->sigma2SmoothPDF=value;
+    }
       return;
     }
 
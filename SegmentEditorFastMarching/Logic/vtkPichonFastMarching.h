@@ -14,6 +14,7 @@
 // VTK includes
 #include <vtkImageData.h>
 #include <vtkImageAlgorithm.h>
+#include <vtkSmartPointer.h>
 #include <vtkVersion.h>
 
 // STD includes
@@ -35,27 +36,59 @@
 
 #define GRANULARITY_PROGRESS 20
 
+/// number of buckets in the circular array of the bucket priority queue
+#define N_BUCKETS 1024
+
+/// maximum number of competing fronts in multi-label mode
+#define N_MAX_LABELS 255
+
+/// leak detection: the median arrival time of windows of nPointsEvolution/LEAK_WINDOWS
+/// points (at least LEAK_MIN_WINDOW_SIZE points) is compared to the largest median of
+/// the LEAK_HISTORY_WINDOWS previous windows. A leak is detected if it is high for
+/// LEAK_CONFIRM_WINDOWS of LEAK_CONFIRM_SPAN consecutive windows (the statistics of the
+/// front adapt after the jump, so T can go down before it jumps again), but only after
+/// LEAK_MIN_WINDOWS windows (must not be less than LEAK_HISTORY_WINDOWS).
+#define LEAK_WINDOWS 200
+#define LEAK_MIN_WINDOW_SIZE 50
+#define LEAK_HISTORY_WINDOWS 5
+#define LEAK_CONFIRM_WINDOWS 2
+#define LEAK_CONFIRM_SPAN 5
+#define LEAK_MIN_WINDOWS 8
+
 ///////////////////////////////////////////////////////////////////////
 ///////////////////////////////////////////////////////////////////////
 
 typedef enum fmstatus { fmsDONE, fmsKNOWN, fmsTRIAL, fmsFAR, fmsOUT } FMstatus;
 #define MASK_BIT 256
 
-struct FMnode {
-  FMstatus status;
-  float T;
-  int leafIndex;
-};
+/// index of a voxel in the image arrays
+/// 64-bit by default so that images with more than 2^31 voxels can be processed,
+/// define FASTMARCHING_32BIT_INDEX to use int indices (less memory for the
+/// front and the list of known points)
+#ifdef FASTMARCHING_32BIT_INDEX
+typedef int FMindex;
+#else
+typedef vtkIdType FMindex;
+#endif
 
 struct FMleaf {
-  int nodeIndex;
+  FMindex nodeIndex;
+};
+
+/// entry of the bucket priority queue, T is the arrival time at insertion
+/// (the entry is outdated if the arrival time of the node changed since)
+struct FMbucketEntry {
+  FMindex nodeIndex;
+  float T;
 };
 
 /// these typedef are for tclwrapper...
 typedef std::vector<FMleaf> VecFMleaf;
-typedef std::vector<int> VecInt;
+typedef std::vector<FMbucketEntry> VecFMbucketEntry;
+typedef std::vector<FMindex> VecFMindex;
 
 class PichonFastMarchingPDF;
+class vtkDoubleArray;
 
 ///////////////////////////////////////////////////////////////////////
 ///////////////////////////////////////////////////////////////////////
@@ -67,16 +100,97 @@ public:
   vtkTypeMacro(vtkPichonFastMarching,vtkImageAlgorithm);
   void PrintSelf(ostream& os, vtkIndent indent) override;
 
+  enum
+  {
+    PriorityQueueBinaryHeap = 0, /// exact ordering, O(log N) insert and pop
+    PriorityQueueBucket = 1 /// untidy ordering, amortized O(1) insert and pop
+  };
+
   void init(int dimX, int dimY, int dimZ, double depth, double dx, double dy, double dz);
 
   void setActiveLabel(int label);
 
-  void initNewExpansion( void );
+  /// Multi-label mode: each non-zero value of the image passed to
+  /// addSeedsFromImage starts a separate front that carries that label.
+  /// All fronts grow in one pass, each voxel is assigned to the front that
+  /// reaches it first. Intensity statistics are collected separately for
+  /// each front. The active label is not used in multi-label mode.
+  void setMultiLabel( bool multiLabel );
+  bool getMultiLabel( void );
 
-  int nValidSeeds( void );
-  int nKnownPoints(void);
+  void initNewExpansion( void );
 
-  void setNPointsEvolution( int n );
+  vtkIdType nValidSeeds( void );
+  vtkIdType nKnownPoints(void);
+  /// Number of known points that are seeds. Seeds that are reached by the front
+  /// of neighboring seeds before they are planted are not included, they are
+  /// points of the evolution.
+  vtkIdType nKnownSeeds(void);
+
+  /// Maximum number of points reached by the front.
+  void setNPointsEvolution( vtkIdType n );
+
+  /// Number of points reached by the front between updates of the intensity
+  /// statistics of the front (the interval is then adapted to how fast the
+  /// statistics change). If <=0 (default) then it is 1% of the number of points
+  /// of each evolution. Set it to a fixed value to make continued evolutions
+  /// reach the same points as a single evolution to the total number of points.
+  void setStatisticsUpdateRate( int n );
+  int getStatisticsUpdateRate( void );
+
+  /// Select the priority queue that orders the front.
+  /// Can only be changed while there are no points in the front.
+  void setPriorityQueueType( int type );
+  int getPriorityQueueType( void );
+
+  /// Arrival time range covered by one bucket in PriorityQueueBucket mode.
+  /// Ordering within a bucket is arbitrary. If <=0 (default) then the width
+  /// is half of the smallest arrival time computed so far, which is the time
+  /// needed to cross one voxel around the seeds.
+  void setBucketWidth( double width );
+  double getBucketWidth( void );
+
+  /// Maximum number of threads used by the passes that process the whole
+  /// image (initialization, statistics image transfer).
+  /// 0 (default) uses the default of the SMP backend, which is always the
+  /// case with VTK older than 9.2.
+  void setNumberOfThreads( int n );
+  int getNumberOfThreads( void );
+
+  /// Compute the median and inhomogeneity of all the voxels that the front can
+  /// reach in a parallel pass of the initialization (default), instead of
+  /// computing them one by one when the front reaches the voxels. The values
+  /// read from the statistics image are not computed again.
+  void setPrecomputeStatistics( bool precompute );
+  bool getPrecomputeStatistics( void );
+
+  /// Memory used by the per-voxel arrays of the filter (arrival time,
+  /// status, minheap position, median and inhomogeneity, copy of the input
+  /// made by startBackgroundUpdate and preview image), in bytes per voxel.
+  /// The output image is not included.
+  double memoryBytesPerVoxel( void );
+
+  /// Median and inhomogeneity of the input computed by a previous filter,
+  /// as a 2-component short image (median, inhomogeneity), inhomogeneity
+  /// is -1 where it has not been computed yet. The image may have a different
+  /// extent than the input. Values are read in the initialization pass and
+  /// values computed during the evolution are written back, so that the image
+  /// can be reused by other filters that process the same input.
+  void setStatisticsImage(vtkImageData* image);
+  vtkImageData* getStatisticsImage( void );
+
+  /// Voxels where this unsigned char image is non-zero are never reached by
+  /// the front (for example voxels that the segment editor does not allow to edit).
+  /// The image may have a different extent than the input, voxels outside of it
+  /// are not masked. Seeds must not be masked. Applied in the first evolution.
+  void setMaskImage(vtkImageData* image);
+
+  /// Upper bounds of the intensity bins, in increasing order. The bin of an
+  /// input intensity is the number of edges that are smaller than or equal to
+  /// it, so depth should be set to the number of edges. The input can then be
+  /// of any scalar type, no conversion to short is needed.
+  /// If no edges are set (default), the input must be short with values in [0,depth].
+  void setIntensityBinEdges(vtkDoubleArray* edges);
 
   void setInData(short* data);
   void setOutData(short* data);
@@ -88,9 +202,79 @@ public:
 
   int addSeed( float r, float a, float s );
   int addSeedIJK( int, int, int );
+  /// Add all non-zero voxels of the label image as seeds.
+  /// The label image may have a different extent than the input image,
+  /// voxels outside the input extent are ignored.
+  /// In multi-label mode, the voxel value is the label of the front.
   int addSeedsFromImage(vtkImageData*);
 
+  /// Bounding box of the points reached by the front (in the extent of the
+  /// input image). Used for detecting if the front is limited by the image boundary.
+  void getKnownPointsExtent(int extent[6]);
+
+  /// Arrival time (T) of all the points reached by the front,
+  /// as a float image with the extent of the input image.
+  /// Voxels that were not reached are set to INF.
+  void getArrivalTimeImage(vtkImageData* image);
+
+  /// Order in which the front reached the points, as a vtkIdType image
+  /// with the extent of the input image. Seeds are 1, voxels that were not
+  /// reached are set to 0. Voxels with rank <= N are the first N points
+  /// of the evolution.
+  void getArrivalRankImage(vtkImageData* image);
+
   void show(float r);
+  /// Bounding box of the output voxels that were changed by the last show()
+  /// (in the extent of the input image), empty if no voxels were changed.
+  /// Used for updating only the modified part of the segment.
+  void getShowModifiedExtent(int extent[6]);
+
+  /// Write the points reached by the front to the output and to the preview
+  /// image after every n evolution steps, so that the result can be displayed
+  /// while the filter is running in the background. Output voxels are only set
+  /// (never cleared) during the evolution. 0 (default) means the output is only
+  /// updated by show().
+  void setPreviewInterval( int n );
+  int getPreviewInterval( void );
+  /// Number of known points written to the preview image so far.
+  /// Can be called while the filter is running in the background.
+  vtkIdType nPreviewedPoints( void );
+  /// Copy of the output at the last preview (see setPreviewInterval), as a short
+  /// image with the extent of the input image. Can be called while the filter
+  /// is running in the background, unlike GetOutput().
+  void getPreviewImage(vtkImageData* image);
+
+  /// Stop the evolution when the front starts to leak out of the structure.
+  /// While the front fills a structure, the arrival time (T) of the added points
+  /// grows slowly. When the front reaches the boundary, the front speed suddenly
+  /// drops and T jumps, and the points reached after that are leakage.
+  /// The evolution is stopped if T grows by more than this ratio compared to
+  /// the preceding part of the front. 0 (default) disables leak detection.
+  void setLeakDetectionRatio( double ratio );
+  double getLeakDetectionRatio( void );
+  /// Number of known points (including the seeds) before the leak started,
+  /// 0 if no leak was detected in the last evolution.
+  vtkIdType getLeakOnsetPoints( void );
+
+  /// Execute the filter (same as Update()) in a background thread.
+  /// The filter processes a private copy of the input (see setCopyInput()), so the
+  /// input image can be modified while the filter is running. Progress can be queried by
+  /// getBackgroundUpdateProgress(), the points reached so far by getPreviewImage(),
+  /// and processing can be stopped by SetAbortExecute(1). Other methods of the filter
+  /// (including GetOutput() and show()) must not be used until isBackgroundUpdateRunning()
+  /// returns false.
+  void startBackgroundUpdate( void );
+  bool isBackgroundUpdateRunning( void );
+  /// Whether startBackgroundUpdate() makes a private copy of the input (default: true).
+  /// It can be disabled if the input is not used by anything else than the filter
+  /// (for example a cropped copy of an image), which saves the memory and the time of the copy.
+  void setCopyInput( bool copy );
+  bool getCopyInput( void );
+  /// Progress of the current update, between 0 and 1.
+  /// Can be called while the filter is running in the background.
+  double getBackgroundUpdateProgress( void );
+  /// Blocks until the background update is completed.
+  void waitForBackgroundUpdate( void );
 
   char * cxxVersionString(void);
   int cxxMajorVersion(void);
@@ -100,11 +284,12 @@ protected:
   vtkPichonFastMarching();
   ~vtkPichonFastMarching() override;
 
+  int RequestInformation(vtkInformation *, vtkInformationVector **, vtkInformationVector *) override;
   void ExecuteDataWithInformation(vtkDataObject *, vtkInformation *) override;
 
 
   friend void vtkPichonFastMarchingExecute(vtkPichonFastMarching *self,
-                     vtkImageData *inData, short *inPtr,
+                     vtkImageData *inData, void *inPtr,
                      vtkImageData *outData, short *outPtr,
                      int outExt[6]);
 
@@ -117,10 +302,8 @@ private:
   double powerSpeed;
 
   int nNeighbors; /// =6 pb wrap, cannot be defined as constant
-  int arrayShiftNeighbor[27];
+  FMindex arrayShiftNeighbor[27];
   double arrayDistanceNeighbor[27];
-  int tmpNeighborhood[125]; /// allocate it here so that we do not have to
-  /// allocate it over and over in getMedianInhomo
 
   float dx;
   float dy;
@@ -133,19 +316,38 @@ private:
   bool initialized;
   bool firstCall;
 
-  FMnode *node;  /// arrival time and status for all voxels
-  int *inhomo; /// inhomogeneity
-  int *median; /// medican intensity
+  int numberOfThreads;
+
+  /// arrival time, status and minheap position for all voxels
+  /// (stored in separate arrays to keep memory usage low)
+  float *nodeT;
+  unsigned char *nodeStatus; /// 4 bits per voxel, use getStatus/setStatus
+  int *nodeLeafIndex; /// only allocated if the minheap is used (the minheap is limited to 2^31 points)
+  unsigned char *nodeLabel; /// front of the point (index in labelValues), only allocated in multi-label mode
+
+  short *inhomo; /// inhomogeneity
+  short *median; /// medican intensity
+
+  /// median and inhomogeneity shared between filters (optional)
+  vtkSmartPointer<vtkImageData> statisticsImage;
+  vtkSmartPointer<vtkImageData> maskImage;
 
   short* outdata; /// output
-  short* indata;  /// input
+  void* indata;  /// input
+  int indataScalarType;
+  /// upper bounds of the intensity bins, empty if the input is used directly
+  std::vector<double> intensityBinEdges;
 
   /// size of the indata (=size outdata, node, inhomo)
   int dimX;
   int dimY;
   int dimZ;
-  int dimXY; /// dimX*dimY
-  int dimXYZ; /// dimX*dimY*dimZ
+  FMindex dimXY; /// dimX*dimY
+  FMindex dimXYZ; /// dimX*dimY*dimZ
+  /// extent of the input image (may not start at 0)
+  int imageExtent[6];
+  /// bounding box of the voxels changed by the last show()
+  int showModifiedExtent[6];
   /// coeficients of the RAS2IJK matrix
   float m11;
   float m12;
@@ -170,46 +372,149 @@ private:
   int label;
   int depth;
 
-  int nPointsEvolution;
-  int nPointsBeforeLeakEvolution;
+  bool multiLabel;
+  /// label value of each front (multi-label mode)
+  std::vector<short> labelValues;
+  /// index in labelValues of the seeds that are currently added
+  int seedLabelIndex;
+
+  FMindex nPointsEvolution;
+  int statisticsUpdateRate;
+  FMindex nPointsBeforeLeakEvolution;
   int nEvolutions;
+  /// number of steps of the current expansion that found the front empty
+  int nEmptyTreeSteps;
 
-  VecInt knownPoints;
-  /// vector<int> knownPoints
+  VecFMindex knownPoints;
+  /// vector<FMindex> knownPoints
 
-  VecInt seedPoints;
-  /// vector<int> seedPoints
+  VecFMindex seedPoints;
+  /// vector<FMindex> seedPoints
+  FMindex nKnownSeedPoints;
 
   /// minheap used by the fast marching algorithm
   VecFMleaf tree;
   ///  vector<FMleaf> tree;
 
-  PichonFastMarchingPDF *pdfIntensityIn;
-  PichonFastMarchingPDF *pdfInhomoIn;
+  int priorityQueueType;
+
+  /// bucket queue used by the fast marching algorithm if
+  /// priorityQueueType==PriorityQueueBucket
+  std::vector<VecFMbucketEntry> buckets;
+  /// entries beyond the range of the circular bucket array (minheap on T)
+  VecFMbucketEntry bucketOverflow;
+  /// entries arriving before the current bucket (minheap on T)
+  VecFMbucketEntry bucketEarly;
+  double bucketWidth; /// requested width, <=0 means automatic
+  double currentBucketWidth;
+  double currentBucketKey; /// floor(T/currentBucketWidth) of the current bucket
+  int currentBucket;
+  FMindex nEntriesInBuckets; /// including outdated entries
+  FMindex nTrialInBuckets;
+
+  /// statistics of each front (a single one if not in multi-label mode)
+  std::vector<PichonFastMarchingPDF*> pdfIntensityIn;
+  std::vector<PichonFastMarchingPDF*> pdfInhomoIn;
+
+  /// background update thread, private copy of the input and preview image
+  /// (kept out of the header, which is wrapped)
+  class vtkInternals;
+  vtkInternals* Internals;
+
+  int previewInterval;
+  bool copyInput;
+  bool precomputeStatistics;
+
+  double leakDetectionRatio;
+  FMindex leakOnsetPoints;
 
   bool firstPassThroughShow;
 
-  /// minheap methods
+  FMstatus getStatus(FMindex index)
+  {
+    return (FMstatus)( (nodeStatus[index>>1] >> ((index&1)<<2)) & 0x0F );
+  }
+  void setStatus(FMindex index, FMstatus status)
+  {
+    int shift = (int)(index&1)<<2;
+    nodeStatus[index>>1] = (unsigned char)( (nodeStatus[index>>1] & ~(0x0F<<shift)) | (status<<shift) );
+  }
+
+  int labelIndex(FMindex index)
+  {
+    return (nodeLabel!=nullptr) ? nodeLabel[index] : 0;
+  }
+  /// arrival time of a neighbor, INF if it belongs to a different front
+  float neighborT(FMindex index, FMindex indexN)
+  {
+    if( (nodeLabel!=nullptr) && (nodeLabel[indexN]!=nodeLabel[index]) )
+      return (float)INF;
+    return nodeT[indexN];
+  }
+  /// value written to the output for a known point
+  short outputLabel(FMindex index)
+  {
+    return (nodeLabel!=nullptr) ? labelValues[ nodeLabel[index] ] : (short)label;
+  }
+  int addLabelValue(short value);
+  /// expand the extent (may be empty) to include the voxel
+  void expandExtent(FMindex index, int extent[6]);
+  void deletePDFs(void);
+  /// UpdateProgress() that can also be read by getBackgroundUpdateProgress()
+  void reportProgress(double amount);
+  /// copy the output to the preview image (at the start of an evolution)
+  void initPreviewImage(void);
+  /// write the known points from beginPoint on to the output and the preview image
+  void previewKnownPoints(FMindex beginPoint);
+
+  /// priority queue methods (dispatch to minheap or buckets)
   bool emptyTree(void);
+  FMindex treeSize(void);
   void insert(const FMleaf leaf);
-  FMleaf removeSmallest( void );
+  /// Removes the point of the front with the smallest arrival time.
+  /// Returns false if no point of the front can be reached anymore.
+  bool removeSmallest( FMleaf &leaf );
+  void updateLeaf(FMindex nodeIndex, float previousT);
+  void clearTree(void);
+
+  /// minheap methods
   void downTree(int index);
   void upTree(int index);
 
-  int indexFather(int index );
+  /// bucket queue methods
+  double bucketKey(float T);
+  void bucketInsert(FMindex nodeIndex);
+  void bucketPushToRing(const FMbucketEntry &entry);
+  /// put all the entries in bucketOverflow and restart the circular array
+  void bucketRebase( void );
+  bool bucketRemoveSmallest(FMleaf &leaf);
+
+  FMindex indexFather(FMindex index );
 
-  void getMedianInhomo(int index, int &median, int &inhomo );
+  void getMedianInhomo(FMindex index, int &median, int &inhomo );
+  /// compute median and inhomogeneity in the slices [beginK,endK) with a
+  /// sliding histogram of the intensity bins, except at the image boundary
+  void computeMedianInhomo(int beginK, int endK);
+  int intensityBin(double value);
 
-  int shiftNeighbor(int n);
+  FMindex shiftNeighbor(int n);
   double distanceNeighbor(int n);
-  float computeT(int index );
+  float computeT(FMindex index );
+
+  void setSeed(FMindex index );
+
+  void collectInfoSeed(FMindex index, int labelIndex=0 );
 
-  void setSeed(int index );
+  /// initialize arrival time, status and statistics of voxels [beginIndex,endIndex)
+  void initNodes(FMindex beginIndex, FMindex endIndex);
 
-  void collectInfoSeed(int index );
-  void collectInfoAll( void );
+  /// copy median and inhomogeneity between statisticsImage and the internal arrays
+  void readStatisticsImage( void );
+  void writeStatisticsImage( void );
+  /// set the voxels of maskImage to fmsOUT
+  void applyMaskImage( void );
 
-  float speed(int index );
+  float speed(FMindex index );
 
   bool minHeapIsSorted( void );
 
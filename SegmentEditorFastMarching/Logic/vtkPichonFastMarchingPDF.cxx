@@ -35,6 +35,11 @@
 // VTK includes
 #include <vtkMath.h>
 
+// STD includes
+#include <algorithm>
+#include <climits>
+#include <cmath>
+
 PichonFastMarchingPDF::PichonFastMarchingPDF( int _realizationMax )
 {
   sigma2SmoothPDF=0.25;
@@ -59,11 +64,21 @@ PichonFastMarchingPDF::PichonFastMarchingPDF( int _realizationMax )
     vtkGenericWarningMacro("Error in vtkFastMarching, PichonFastMarchingPDF::PichonFastMarchingPDF(...), not enough memory for allocation of 'bins'");
     }
 
+  coefSum = new double[realizationMax+1];
+  convolvedFrom = new int[realizationMax+1];
+  convolvedBins = new double[realizationMax+1];
+  removedMass = new double[realizationMax+1];
+  if(coefSum==nullptr || convolvedFrom==nullptr || convolvedBins==nullptr || removedMass==nullptr)
+    {
+    vtkGenericWarningMacro("Error in vtkFastMarching, PichonFastMarchingPDF::PichonFastMarchingPDF(...), not enough memory for allocation of 'convolvedBins'");
+    }
+
   reset();
 
   // default values
   memorySize=10000;
   updateRate=1000;
+  updateInterval=updateRate;
 }
 
 PichonFastMarchingPDF::~PichonFastMarchingPDF()
@@ -73,6 +88,10 @@ PichonFastMarchingPDF::~PichonFastMarchingPDF()
   delete [] bins;
   delete [] smoothedBins;
   delete [] coefGauss;
+  delete [] coefSum;
+  delete [] convolvedFrom;
+  delete [] convolvedBins;
+  delete [] removedMass;
 }
 
 void PichonFastMarchingPDF::reset( void )
@@ -89,6 +108,11 @@ void PichonFastMarchingPDF::reset( void )
     bins[k]=0;
 
   nRealInBins=0;
+  nAddedSinceUpdate=0;
+
+  // the smoothing is recomputed at the next update
+  kernelSigma2=0.0;
+  kernelRadius=realizationMax;
 }
 
 bool PichonFastMarchingPDF::willUseGaussian( void )
@@ -166,39 +190,99 @@ void PichonFastMarchingPDF::update( void )
     }
 
 
+  double previousMean=mean;
+  double previousSigma2=sigma2;
+
   // update moments
   mean=m1/double(nRealInBins);
   sigma2=m2/double(nRealInBins)-mean*mean;
 
-  // create smoothed histogram
-  double sigma2Smooth=sigma2SmoothPDF*sigma2;
+  nAddedSinceUpdate=0;
+  if( (updateRate!=-1) && (previousSigma2>0) && (sigma2>0) )
+    adaptUpdateInterval(previousMean, previousSigma2);
 
-  // create lookup table for smoothing
-  for(int k=0;k<=realizationMax;k++)
-    coefGauss[k]=exp(-0.5*double(k*k)/sigma2Smooth);
+  // the smoothed histogram is not used until there are enough points
+  if( !willUseGaussian() )
+    updateSmoothedBins();
+}
 
-  {
+void PichonFastMarchingPDF::adaptUpdateInterval( double previousMean, double previousSigma2 )
+{
+  // change of the distribution since the last update, relative to its width
+  double change=fabs(mean-previousMean)/sqrt(sigma2)+fabs(sigma2-previousSigma2)/sigma2;
+
+  if( change<PDF_STABLE_CHANGE )
+    updateInterval=(int)std::min<long long>(2LL*updateInterval, (long long)updateRate*PDF_UPDATE_INTERVAL_RANGE);
+  else if( change>PDF_UNSTABLE_CHANGE )
+    updateInterval=std::max(updateInterval/2, std::max(updateRate/PDF_UPDATE_INTERVAL_RANGE, 10));
+}
+
+void PichonFastMarchingPDF::updateSmoothedBins( void )
+{
+  double sigma2Smooth=sigma2SmoothPDF*sigma2;
+
+  if( !(kernelSigma2>0) || fabs(sigma2Smooth-kernelSigma2)>PDF_KERNEL_TOLERANCE*kernelSigma2 )
+    {
+    // create lookup table for smoothing and smooth the whole histogram
+    kernelSigma2=sigma2Smooth;
+    for(int k=0;k<=realizationMax;k++)
+      coefGauss[k]=exp(-0.5*double(k*k)/sigma2Smooth);
 
-    double val;
-    double nval;
-    double coef;
+    // coefficients underflow to 0 far from the center, those bins are skipped
+    kernelRadius=realizationMax;
+    while( (kernelRadius>0) && (coefGauss[kernelRadius]==0.0) )
+      kernelRadius--;
 
     for(int k=0;k<=realizationMax;k++)
       {
-    val=0.0;
-    nval=0.0;
+      double nval=0.0;
+      for(int j=std::max(k-kernelRadius,0);j<=std::min(k+kernelRadius,realizationMax);j++)
+        nval+=coefGauss[abs(k-j)];
+      coefSum[k]=nval;
+      }
 
+    for(int k=0;k<=realizationMax;k++)
+      convolvedFrom[k]=bins[k];
+    for(int k=0;k<=realizationMax;k++)
+      computeConvolvedBin(k);
+    }
+  else
+    {
+    // only add the bins that changed since the last smoothing
     for(int j=0;j<=realizationMax;j++)
       {
-        coef=coefGauss[abs(k-j)];
-
-        val+=coef*double(bins[j]);
-        nval+=coef;
+      int delta=bins[j]-convolvedFrom[j];
+      if(delta==0)
+        continue;
+      convolvedFrom[j]=bins[j];
+
+      int kMin=std::max(j-kernelRadius,0);
+      int kMax=std::min(j+kernelRadius,realizationMax);
+      for(int k=kMin;k<=kMax;k++)
+        convolvedBins[k]+=double(delta)*coefGauss[abs(k-j)];
+      if(delta<0)
+        for(int k=kMin;k<=kMax;k++)
+          removedMass[k]-=double(delta)*coefGauss[abs(k-j)];
       }
 
-    smoothedBins[k]=val/nval/double(nRealInBins);
-      }
-  }
+    // bins far from the points that remain in the histogram are mostly
+    // rounding error after a removal, those are computed again
+    for(int k=0;k<=realizationMax;k++)
+      if( removedMass[k]>PDF_MAX_CANCELLATION*convolvedBins[k] )
+        computeConvolvedBin(k);
+    }
+
+  for(int k=0;k<=realizationMax;k++)
+    smoothedBins[k]=convolvedBins[k]/coefSum[k]/double(nRealInBins);
+}
+
+void PichonFastMarchingPDF::computeConvolvedBin( int k )
+{
+  double val=0.0;
+  for(int j=std::max(k-kernelRadius,0);j<=std::min(k+kernelRadius,realizationMax);j++)
+    val+=coefGauss[abs(k-j)]*double(convolvedFrom[j]);
+  convolvedBins[k]=val;
+  removedMass[k]=0.0;
 }
 
 void PichonFastMarchingPDF::addRealization( int k )
@@ -213,13 +297,14 @@ void PichonFastMarchingPDF::addRealization( int k )
   toBeAdded.push_front(k);
 
   counter++;
+  nAddedSinceUpdate++;
 
   // update if (either or) :
-  // - we have not been updated for updateRate rounds
+  // - we have not been updated for updateInterval rounds
   // - the number of points waiting to be taken into
   //   consideration  is more than half of our memory
   if( (updateRate!=-1) &&
-      ( (counter%updateRate)==0
+      ( nAddedSinceUpdate>=updateInterval
     || ((memorySize!=-1) && (toBeAdded.size()>((unsigned int)(memorySize/2)))) ) )
     update();
 }
@@ -256,10 +341,15 @@ void PichonFastMarchingPDF::setMemory( int mem )
 
 void PichonFastMarchingPDF::setUpdateRate( int rate )
 {
-  updateRate=rate;
+  if( (rate!=-1) && (rate<10) )
+    rate=10;
+
+  if( rate==updateRate )
+    // keep the adapted interval, for example when the evolution is continued
+    return;
 
-  if( (updateRate!=-1) && (updateRate<10) )
-    updateRate=10;
+  updateRate=rate;
+  updateInterval=updateRate;
 }
 
 
@@ -16,9 +16,27 @@ of Intensity and Inhomogeneity
 
 */
 
+#include "vtkSlicerSegmentEditorFastMarchingModuleLogicExport.h"
+
 #include <deque>
 
-class PichonFastMarchingPDF
+/// the smoothing kernel is only recomputed if the variance changed by more than this ratio,
+/// otherwise the smoothed histogram is updated with the changed bins only
+#define PDF_KERNEL_TOLERANCE 0.01
+
+/// a smoothed bin is recomputed if more than this many times its current value
+/// was removed from it since it was last computed (to limit the rounding error)
+#define PDF_MAX_CANCELLATION 1e6
+
+/// the update interval is adapted between updateRate/PDF_UPDATE_INTERVAL_RANGE and
+/// updateRate*PDF_UPDATE_INTERVAL_RANGE: it is doubled if the mean and variance changed by
+/// less than PDF_STABLE_CHANGE since the last update and halved if more than PDF_UNSTABLE_CHANGE
+/// (change of the mean relative to the standard deviation plus relative change of the variance)
+#define PDF_UPDATE_INTERVAL_RANGE 8
+#define PDF_STABLE_CHANGE 0.01
+#define PDF_UNSTABLE_CHANGE 0.1
+
+class VTK_SLICER_FASTMARCHING_MODULE_LOGIC_EXPORT PichonFastMarchingPDF
 {
 public:
 
@@ -55,6 +73,9 @@ public:
   int counter;
   int memorySize; /// -1=don't ever forget anything
   int updateRate;
+  /// current update interval, adapted to how fast the distribution changes
+  int updateInterval;
+  int nAddedSinceUpdate;
 
   /// the histogram
   int *bins;
@@ -63,6 +84,17 @@ public:
   double *smoothedBins;
 
   double * coefGauss;
+  /// sigma2 of coefGauss (0 if not computed yet)
+  double kernelSigma2;
+  /// coefGauss is 0 beyond this distance
+  int kernelRadius;
+  /// sum of the coefficients used for each bin
+  double *coefSum;
+  /// histogram that was smoothed last (convolvedBins is convolvedFrom convolved with coefGauss)
+  int *convolvedFrom;
+  double *convolvedBins;
+  /// contributions removed from each convolved bin since it was last computed
+  double *removedMass;
 
   std::deque<int> inBins;
   std::deque<int> toBeAdded;
@@ -78,6 +110,10 @@ public:
   double valueHisto( int k );
   double valueGauss( int k );
 
+  void adaptUpdateInterval( double previousMean, double previousSigma2 );
+  void updateSmoothedBins( void );
+  void computeConvolvedBin( int k );
+
 };
 
 #endif
@@ -28,3 +28,502 @@ class SegmentEditorFastMarching(ScriptedLoadableModule):
     effectFilename = os.path.join(os.path.dirname(__file__), self.__class__.__name__+'Lib/SegmentEditorEffect.py')
     instance.setPythonSource(effectFilename.replace('\\','/'))
     instance.self().register()
+
+class SegmentEditorFastMarchingTest(ScriptedLoadableModuleTest):
+  """
+  This is the test case for your scripted module.
+  Uses ScriptedLoadableModuleTest base class, available at:
+  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  """
+
+  def setUp(self):
+    """ Do whatever is needed to reset the state - typically a scene clear will be enough.
+    """
+    slicer.mrmlScene.Clear(0)
+
+  def runTest(self):
+    """Run as few or as many tests as needed here.
+    """
+    self.setUp()
+    self.test_IntensityBinEdges()
+    self.test_SeedRegionGrowth()
+    self.test_ContinueMarching()
+    self.test_ExportArrivalMap()
+    self.test_StoredArrivalRank()
+    self.test_LivePreview()
+    self.test_ModifiedExtentUpdate()
+    self.test_CompetingSegments()
+    self.test_SessionCache()
+    self.test_PreparedInputCache()
+
+  def getEffect(self):
+    """Returns the Fast Marching effect of a new segment editor widget"""
+    self.segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
+    self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
+    return self.segmentEditorWidget.effectByName("Fast Marching").self()
+
+  def createImage(self, values, scalarType):
+    """Image of a single row of voxels"""
+    from vtk.util import numpy_support
+    image = vtk.vtkImageData()
+    image.SetDimensions(len(values), 1, 1)
+    image.AllocateScalars(scalarType, 1)
+    numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())[:] = values
+    return image
+
+  def setUpSegmentation(self, volumeArray, seedArrays):
+    """Creates a source volume from volumeArray and a segment from each seed array (in k, j, i order).
+    Returns the Fast Marching effect, activated with the first segment selected, and the segment IDs.
+    """
+    self.sourceVolumeNode = slicer.util.addVolumeFromArray(volumeArray)
+    self.segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+    self.segmentationNode.CreateDefaultDisplayNodes()
+    self.segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(self.sourceVolumeNode)
+    segmentIds = []
+    for seedArray in seedArrays:
+      segmentId = self.segmentationNode.GetSegmentation().AddEmptySegment()
+      slicer.util.updateSegmentBinaryLabelmapFromArray(seedArray, self.segmentationNode, segmentId, self.sourceVolumeNode)
+      segmentIds.append(segmentId)
+
+    self.getEffect()
+    segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
+    self.segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
+    self.segmentEditorWidget.setSegmentationNode(self.segmentationNode)
+    self.segmentEditorWidget.setSourceVolumeNode(self.sourceVolumeNode)
+    self.segmentEditorWidget.setCurrentSegmentID(segmentIds[0])
+    self.segmentEditorWidget.setActiveEffectByName("Fast Marching")
+    return self.segmentEditorWidget.activeEffect().self(), segmentIds
+
+  def runMarching(self, effect, percentMax):
+    """Grow the segments up to percentMax of the source volume, as the Initialize button does"""
+    for _ in effect.marchingSteps(percentMax):
+      # the filter is running in the background
+      effect.fm.waitForBackgroundUpdate()
+
+  def getSegmentArray(self, segmentId):
+    return slicer.util.arrayFromSegmentBinaryLabelmap(self.segmentationNode, segmentId, self.sourceVolumeNode)
+
+  def createBarVolume(self):
+    """Bright bar along the i axis in a noisy dark volume, and a seed in the bar"""
+    import numpy
+    volumeArray = numpy.random.RandomState(1).normal(30, 5, (40, 40, 128)).astype(numpy.int16)
+    volumeArray[20:24, 20:24, 40:90] += 100
+    seedArray = numpy.zeros(volumeArray.shape, dtype=numpy.uint8)
+    seedArray[21:23, 21:23, 60:62] = 1
+    return volumeArray, seedArray
+
+  def test_IntensityBinEdges(self):
+    """Integer images with a small range get one bin per intensity value,
+    other images get bins that contain about the same number of voxels.
+    """
+    self.delayDisplay("Starting test_IntensityBinEdges")
+    import numpy
+    from vtk.util import numpy_support
+    effect = self.getEffect()
+
+    image = self.createImage(numpy.arange(-10, 90), vtk.VTK_SHORT)
+    edges = numpy_support.vtk_to_numpy(effect.getIntensityBinEdges(image))
+    numpy.testing.assert_array_equal(edges, numpy.arange(-10, 90) + 0.5)
+
+    # 16-bit range: percentile bins
+    values = numpy.random.RandomState(1).randint(0, 60000, 30000)
+    for scalarType in [vtk.VTK_UNSIGNED_SHORT, vtk.VTK_FLOAT]:
+      image = self.createImage(values, scalarType)
+      edges = numpy_support.vtk_to_numpy(effect.getIntensityBinEdges(image))
+      self.assertLessEqual(len(edges), 299)
+      self.assertGreater(len(edges), 290)
+      self.assertTrue(numpy.all(numpy.diff(edges) > 0))
+      # the bin of a voxel is the number of edges at or below its intensity
+      binSizes = numpy.bincount(numpy.searchsorted(edges, values, side='right'))
+      self.assertGreater(binSizes.min(), 0.8 * len(values) / 300)
+      self.assertLess(binSizes.max(), 1.2 * len(values) / 300)
+
+    # floating-point image with a small range is not binned by integer values
+    values = numpy.linspace(0.0, 1.0, 3000)
+    image = self.createImage(values, vtk.VTK_FLOAT)
+    edges = numpy_support.vtk_to_numpy(effect.getIntensityBinEdges(image))
+    self.assertEqual(len(edges), 299)
+    self.assertTrue(numpy.all((edges > 0.0) & (edges < 1.0)))
+
+    # constant image has a single edge
+    image = self.createImage(numpy.full(1000, 5.0), vtk.VTK_FLOAT)
+    edges = numpy_support.vtk_to_numpy(effect.getIntensityBinEdges(image))
+    numpy.testing.assert_array_equal(edges, [5.0])
+
+    self.delayDisplay("Test passed")
+
+  def test_SeedRegionGrowth(self):
+    """The region around the seeds is grown while the front reaches its boundary, so the segment
+    is the same as when the whole volume is processed, even though the region extent does not start at 0.
+    """
+    self.delayDisplay("Starting test_SeedRegionGrowth")
+    import numpy
+    volumeArray, seedArray = self.createBarVolume()
+    effect, segmentIds = self.setUpSegmentation(volumeArray, [seedArray])
+    sourceExtent = list(self.sourceVolumeNode.GetImageData().GetExtent())
+
+    # the whole volume is processed by default
+    self.assertEqual(effect.scriptedEffect.integerParameter("SeedRegionOnly"), 0)
+    percentMax = 0.35
+    self.runMarching(effect, percentMax)
+    self.assertEqual(effect.marchingExtent, sourceExtent)
+    wholeVolumeSegment = self.getSegmentArray(segmentIds[0])
+    # the front fills the bar on both sides of the seed
+    filledColumns = numpy.nonzero(wholeVolumeSegment.any(axis=(0, 1)))[0]
+    self.assertLess(filledColumns[0], 50)
+    self.assertGreater(filledColumns[-1], 75)
+
+    effect.scriptedEffect.setParameter("SeedRegionOnly", 1)
+    self.runMarching(effect, percentMax)
+    regionExtent = effect.marchingExtent
+    # first region: cube root of the maximum volume and a margin of 4 voxels around the seeds
+    npoints = int(volumeArray.size*percentMax/100.)
+    margin = int(npoints**(1./3.)) + 4
+    self.assertLess(regionExtent[0], 60 - margin)
+    self.assertGreater(regionExtent[1], 61 + margin)
+    # the region is still smaller than the volume
+    self.assertGreater(regionExtent[0], sourceExtent[0])
+    self.assertLess(regionExtent[1], sourceExtent[1])
+    numpy.testing.assert_array_equal(self.getSegmentArray(segmentIds[0]), wholeVolumeSegment)
+
+    self.delayDisplay("Test passed")
+
+  def test_ContinueMarching(self):
+    """Increasing the maximum volume continues the evolution of the front,
+    which gives the same segment as marching to the larger maximum volume at once.
+    """
+    self.delayDisplay("Starting test_ContinueMarching")
+    import numpy
+    volumeArray, seedArray = self.createBarVolume()
+    effect, segmentIds = self.setUpSegmentation(volumeArray, [seedArray])
+
+    self.runMarching(effect, 0.1)
+    fm = effect.fm
+    smallSegment = self.getSegmentArray(segmentIds[0])
+    self.runMarching(effect, 0.35)
+    self.assertIs(effect.fm, fm)
+    continuedSegment = self.getSegmentArray(segmentIds[0])
+    # seeds are not counted in the maximum volume
+    self.assertGreater(numpy.count_nonzero(continuedSegment), int(volumeArray.size*0.35/100.))
+    self.assertTrue(numpy.all(continuedSegment[smallSegment != 0]))
+
+    # the front cannot be continued to the same volume, it is grown again from the seeds
+    self.runMarching(effect, 0.35)
+    self.assertIsNot(effect.fm, fm)
+    numpy.testing.assert_array_equal(self.getSegmentArray(segmentIds[0]), continuedSegment)
+
+    self.delayDisplay("Test passed")
+
+  def test_ExportArrivalMap(self):
+    """The exported arrival rank numbers the voxels of the front in the order they were reached,
+    the exported arrival time is only finite for these voxels. Both are in the geometry of the source volume.
+    """
+    self.delayDisplay("Starting test_ExportArrivalMap")
+    import numpy
+    volumeArray, seedArray = self.createBarVolume()
+    effect, segmentIds = self.setUpSegmentation(volumeArray, [seedArray])
+    self.runMarching(effect, 0.35)
+    segmentArray = self.getSegmentArray(segmentIds[0])
+    sourceIjkToRas = vtk.vtkMatrix4x4()
+    self.sourceVolumeNode.GetIJKToRASMatrix(sourceIjkToRas)
+
+    segmentName = self.segmentationNode.GetSegmentation().GetSegment(segmentIds[0]).GetName()
+    exportedVolumeNodes = {}
+    for arrivalMapType in ["Arrival rank", "Arrival time"]:
+      volumeNode = effect.exportArrivalMap(arrivalMapType)
+      self.assertTrue(volumeNode.GetName().startswith(segmentName + " " + arrivalMapType.lower()))
+      ijkToRas = vtk.vtkMatrix4x4()
+      volumeNode.GetIJKToRASMatrix(ijkToRas)
+      for row in range(4):
+        for column in range(4):
+          self.assertAlmostEqual(ijkToRas.GetElement(row, column), sourceIjkToRas.GetElement(row, column))
+      exportedVolumeNodes[arrivalMapType] = volumeNode
+
+    ranks = slicer.util.arrayFromVolume(exportedVolumeNodes["Arrival rank"])
+    self.assertEqual(ranks.shape, volumeArray.shape)
+    numpy.testing.assert_array_equal(ranks != 0, segmentArray != 0)
+    numpy.testing.assert_array_equal(numpy.sort(ranks[ranks != 0]), numpy.arange(1, numpy.count_nonzero(ranks) + 1))
+    self.assertEqual(ranks[seedArray != 0].min(), 1)
+
+    times = slicer.util.arrayFromVolume(exportedVolumeNodes["Arrival time"])
+    # voxels that were not reached have an infinite arrival time (1e20)
+    numpy.testing.assert_array_equal(times < 1e20, ranks != 0)
+    self.assertEqual(times[ranks == 1][0], 0.0)
+
+    self.delayDisplay("Test passed")
+
+  def test_LivePreview(self):
+    """Live preview is disabled by default. When it is enabled, the segment is updated while the front
+    is growing, and the final segment is the same.
+    """
+    self.delayDisplay("Starting test_LivePreview")
+    import numpy
+    volumeArray, seedArray = self.createBarVolume()
+    effect, segmentIds = self.setUpSegmentation(volumeArray, [seedArray])
+    percentMax = 0.35
+    npoints = int(volumeArray.size*percentMax/100.)
+
+    self.assertEqual(effect.scriptedEffect.integerParameter("LivePreview"), 0)
+    self.assertEqual(effect.getPreviewInterval(npoints), 0)
+    self.runMarching(effect, percentMax)
+    self.assertEqual(effect.fm.getPreviewInterval(), 0)
+    self.assertEqual(effect.fm.nPreviewedPoints(), 0)
+    segmentWithoutPreview = self.getSegmentArray(segmentIds[0])
+
+    effect.scriptedEffect.setParameter("LivePreview", 1)
+    self.assertGreater(effect.getPreviewInterval(npoints), 0)
+    self.runMarching(effect, percentMax)
+    self.assertGreater(effect.fm.getPreviewInterval(), 0)
+    self.assertGreater(effect.fm.nPreviewedPoints(), 0)
+    numpy.testing.assert_array_equal(self.getSegmentArray(segmentIds[0]), segmentWithoutPreview)
+
+    self.delayDisplay("Test passed")
+
+  def test_ModifiedExtentUpdate(self):
+    """Moving the volume slider only writes the region of the segment changed by the new volume,
+    which gives the same segment as writing the whole output of the filter.
+    """
+    self.delayDisplay("Starting test_ModifiedExtentUpdate")
+    import numpy
+    from vtk.util import numpy_support
+    volumeArray, seedArray = self.createBarVolume()
+    effect, segmentIds = self.setUpSegmentation(volumeArray, [seedArray])
+    self.runMarching(effect, 0.35)
+    fullSegment = self.getSegmentArray(segmentIds[0])
+
+    previousValue = 1.0
+    for value in [0.5, 0.5, 0.2, 0.9, 1.0]:
+      effect.updateLabel(value, modifiedExtentOnly=True)
+      modifiedExtent = [0, -1, 0, -1, 0, -1]
+      effect.fm.getShowModifiedExtent(modifiedExtent)
+      outputArray = numpy_support.vtk_to_numpy(effect.fm.GetOutput().GetPointData().GetScalars()).reshape(volumeArray.shape)
+      numpy.testing.assert_array_equal(self.getSegmentArray(segmentIds[0]) != 0, outputArray != 0)
+      if value == previousValue:
+        # nothing to write
+        self.assertGreater(modifiedExtent[0], modifiedExtent[1])
+      else:
+        # the front stays in the bar, so the modified region is much smaller than the volume
+        self.assertGreaterEqual(modifiedExtent[2], 18)
+        self.assertLessEqual(modifiedExtent[3], 25)
+        self.assertGreaterEqual(modifiedExtent[4], 18)
+        self.assertLessEqual(modifiedExtent[5], 25)
+      previousValue = value
+    numpy.testing.assert_array_equal(self.getSegmentArray(segmentIds[0]), fullSegment)
+
+    self.delayDisplay("Test passed")
+
+  def test_StoredArrivalRank(self):
+    """The arrival rank of an applied segment is stored in a volume that only covers the voxels reached by its
+    front. It is restored when the effect is selected again, unless the segment was modified since.
+    """
+    self.delayDisplay("Starting test_StoredArrivalRank")
+    import numpy
+    import sys
+    volumeArray, seedArray = self.createBarVolume()
+    effect, segmentIds = self.setUpSegmentation(volumeArray, [seedArray])
+    self.runMarching(effect, 0.35)
+    numberOfPoints = effect.fm.nKnownPoints()
+    appliedSegment = self.getSegmentArray(segmentIds[0])
+    effect.onApply()
+
+    effectModule = sys.modules[type(effect).__module__]
+    volumeNode = self.segmentationNode.GetNodeReference(effectModule.ARRIVAL_RANK_REFERENCE_ROLE + segmentIds[0])
+    self.assertEqual(volumeNode.GetImageData().GetScalarType(), vtk.VTK_UNSIGNED_INT)
+    ranks = slicer.util.arrayFromVolume(volumeNode)
+    # cropped to the bounding box of the segment
+    segmentBoxShape = [indices.max() - indices.min() + 1 for indices in numpy.nonzero(appliedSegment)]
+    self.assertEqual(list(ranks.shape), segmentBoxShape)
+    numpy.testing.assert_array_equal(numpy.sort(ranks[ranks != 0]), numpy.arange(1, numpy.count_nonzero(appliedSegment) + 1))
+
+    # selecting the effect again restores the arrival rank, the segment volume can be adjusted without marching
+    self.segmentEditorWidget.setActiveEffectByName("Fast Marching")
+    effect = self.segmentEditorWidget.activeEffect().self()
+    self.assertIsNone(effect.fm)
+    self.assertIsNotNone(effect.storedArrivalRank)
+    self.assertFalse(effect.isSegmentModifiedSinceArrivalRankStored(segmentIds[0], effect.storedArrivalRank, numberOfPoints, 1.0))
+    effect.updateLabel(0.5)
+    halfSegment = self.getSegmentArray(segmentIds[0])
+    self.assertEqual(numpy.count_nonzero(halfSegment), numpy.count_nonzero((ranks >= 1) & (ranks <= int((numberOfPoints-1)*0.5) + 1)))
+    self.assertTrue(numpy.all(appliedSegment[halfSegment != 0]))
+    effect.updateLabel(1.0)
+    numpy.testing.assert_array_equal(self.getSegmentArray(segmentIds[0]), appliedSegment)
+    storedArrivalRank = effect.storedArrivalRank
+    effect.onCancel()
+
+    # a voxel removed from the segment or added outside of the stored volume
+    for modifiedIndex, modifiedValue in [(numpy.argwhere(seedArray)[0], 0), ((5, 5, 5), 1)]:
+      modifiedSegment = appliedSegment.copy()
+      modifiedSegment[tuple(modifiedIndex)] = modifiedValue
+      slicer.util.updateSegmentBinaryLabelmapFromArray(modifiedSegment, self.segmentationNode, segmentIds[0], self.sourceVolumeNode)
+      self.assertTrue(effect.isSegmentModifiedSinceArrivalRankStored(segmentIds[0], storedArrivalRank, numberOfPoints, 1.0))
+
+    # the arrival rank of the modified segment is not restored
+    self.segmentEditorWidget.setActiveEffectByName("")
+    self.segmentEditorWidget.setActiveEffectByName("Fast Marching")
+    effect = self.segmentEditorWidget.activeEffect().self()
+    self.assertIsNone(effect.storedArrivalRank)
+
+    self.delayDisplay("Test passed")
+
+  def test_SessionCache(self):
+    """The marching session of a segment is kept when another segment is selected and continued when
+    the segment is selected again. Least recently used sessions are removed when the cache is full.
+    """
+    self.delayDisplay("Starting test_SessionCache")
+    import numpy
+    import sys
+    from unittest import mock
+    volumeArray, _ = self.createBarVolume()
+    seedArrays = [numpy.zeros(volumeArray.shape, dtype=numpy.uint8) for _ in range(3)]
+    for seedArray, column in zip(seedArrays, [45, 62, 80]):
+      seedArray[21:23, 21:23, column:column+2] = 1
+    effect, segmentIds = self.setUpSegmentation(volumeArray, seedArrays)
+    sourceImageMTime = effect.scriptedEffect.sourceVolumeImageData().GetMTime()
+
+    self.runMarching(effect, 0.2)
+    firstFm = effect.fm
+    firstSegment = self.getSegmentArray(segmentIds[0])
+
+    # the session is kept for the segment and the source image it was grown in, the segment keeps the result
+    self.segmentEditorWidget.setCurrentSegmentID(segmentIds[1])
+    self.assertIsNone(effect.fm)
+    self.assertEqual(list(effect.sessionCache.keys()), [(segmentIds[0], sourceImageMTime)])
+    self.assertIs(effect.sessionCache[(segmentIds[0], sourceImageMTime)]["fm"], firstFm)
+    numpy.testing.assert_array_equal(self.getSegmentArray(segmentIds[0]), firstSegment)
+    self.runMarching(effect, 0.2)
+    secondFm = effect.fm
+    secondSegment = self.getSegmentArray(segmentIds[1])
+
+    # the cache only has room for one session, the least recently used one is removed
+    effectModule = sys.modules[type(effect).__module__]
+    firstSessionSizeMB = effect.getSessionMemorySizeKB(effect.sessionCache[(segmentIds[0], sourceImageMTime)]) / 1024
+    with mock.patch.object(effectModule, "MARCHING_SESSION_CACHE_SIZE_MB", firstSessionSizeMB * 1.5):
+      self.segmentEditorWidget.setCurrentSegmentID(segmentIds[2])
+    self.assertEqual(list(effect.sessionCache.keys()), [(segmentIds[1], sourceImageMTime)])
+    numpy.testing.assert_array_equal(self.getSegmentArray(segmentIds[0]), firstSegment)
+
+    # continuing the session can be undone
+    self.segmentEditorWidget.setCurrentSegmentID(segmentIds[1])
+    self.assertIs(effect.fm, secondFm)
+    self.assertEqual(len(effect.sessionCache), 0)
+    self.runMarching(effect, 0.35)
+    self.assertIs(effect.fm, secondFm)
+    self.assertGreater(numpy.count_nonzero(self.getSegmentArray(segmentIds[1])), numpy.count_nonzero(secondSegment))
+    self.segmentEditorWidget.undo()
+    numpy.testing.assert_array_equal(self.getSegmentArray(segmentIds[1]), secondSegment)
+
+    # the removed session cannot be continued
+    self.segmentEditorWidget.setCurrentSegmentID(segmentIds[0])
+    self.assertIsNone(effect.fm)
+
+    self.delayDisplay("Test passed")
+
+  def test_CompetingSegments(self):
+    """Segments grown at once compete for the voxels: each segment keeps the voxels reached by its own front.
+    Marching is refused if there are more segments than the fronts supported by the filter.
+    """
+    self.delayDisplay("Starting test_CompetingSegments")
+    import numpy
+    import sys
+    from unittest import mock
+    volumeArray, _ = self.createBarVolume()
+    # a seed near each end of the bar, the fronts meet in the middle
+    seedArrays = [numpy.zeros(volumeArray.shape, dtype=numpy.uint8) for _ in range(2)]
+    seedArrays[0][21:23, 21:23, 45:47] = 1
+    seedArrays[1][21:23, 21:23, 83:85] = 1
+    effect, segmentIds = self.setUpSegmentation(volumeArray, seedArrays)
+    effect.scriptedEffect.setParameter("AllVisibleSegments", 1)
+
+    self.runMarching(effect, 0.35)
+    self.assertEqual(effect.segmentIds, segmentIds)
+    segmentArrays = [self.getSegmentArray(segmentId) for segmentId in segmentIds]
+    for seedArray, segmentArray in zip(seedArrays, segmentArrays):
+      self.assertTrue(numpy.all(segmentArray[seedArray != 0]))
+      # the front stays in the bar
+      self.assertEqual(numpy.count_nonzero(segmentArray[:18, :, :]) + numpy.count_nonzero(segmentArray[26:, :, :]), 0)
+    self.assertFalse(numpy.any((segmentArrays[0] != 0) & (segmentArrays[1] != 0)))
+    # the fronts do not pass each other
+    columns = [numpy.nonzero(segmentArray.any(axis=(0, 1)))[0] for segmentArray in segmentArrays]
+    self.assertLess(columns[0][-1], columns[1][0])
+    # together the fronts fill most of the bar
+    self.assertGreater(columns[0][-1] - columns[0][0] + columns[1][-1] - columns[1][0], 35)
+
+    effectModule = sys.modules[type(effect).__module__]
+    with mock.patch.object(effectModule, "MAX_GROWN_SEGMENT_COUNT", 1):
+      # smaller volume, so that marching is restarted from the seeds
+      self.runMarching(effect, 0.2)
+    self.assertIsNone(effect.fm)
+    # segments are restored to their seeds
+    for seedArray, segmentId in zip(seedArrays, segmentIds):
+      numpy.testing.assert_array_equal(self.getSegmentArray(segmentId) != 0, seedArray != 0)
+
+    self.delayDisplay("Test passed")
+
+  def test_PreparedInputCache(self):
+    """The intensity bins and the statistics image of the source volume are reused until the volume is modified.
+    The statistics image grows with the marched region and keeps the values computed by the previous filters.
+    """
+    self.delayDisplay("Starting test_PreparedInputCache")
+    import numpy
+    import sys
+    from unittest import mock
+    from vtk.util import numpy_support
+    volumeArray, seedArray = self.createBarVolume()
+    effect, segmentIds = self.setUpSegmentation(volumeArray, [seedArray])
+    sourceImageData = effect.scriptedEffect.sourceVolumeImageData()
+    sourceExtent = list(sourceImageData.GetExtent())
+
+    def getStatistics(statisticsImage):
+      """Median and inhomogeneity arrays (inhomogeneity is -1 where nothing has been computed)"""
+      statistics = numpy_support.vtk_to_numpy(statisticsImage.GetPointData().GetScalars())
+      return statistics[:, 0].copy(), statistics[:, 1].copy()
+
+    # the statistics image only covers the region marched around the seeds
+    effect.scriptedEffect.setParameter("SeedRegionOnly", 1)
+    self.runMarching(effect, 0.35)
+    segmentArray = self.getSegmentArray(segmentIds[0])
+    self.assertEqual(len(effect.preparedInputCache), 1)
+    _, intensityBinEdges, statisticsImage = effect.getPreparedInput(sourceImageData)
+    regionExtent = effect.marchingExtent
+    self.assertEqual(list(statisticsImage.GetExtent()), regionExtent)
+    regionMedian, regionInhomogeneity = getStatistics(statisticsImage)
+    self.assertTrue(numpy.any(regionInhomogeneity != -1))
+
+    # cache hit: the whole volume is marched with the same bins, the statistics image is extended in place
+    effect.scriptedEffect.setParameter("SeedRegionOnly", 0)
+    self.runMarching(effect, 0.35)
+    self.assertEqual(len(effect.preparedInputCache), 1)
+    _, cachedIntensityBinEdges, cachedStatisticsImage = effect.getPreparedInput(sourceImageData)
+    self.assertIs(cachedIntensityBinEdges, intensityBinEdges)
+    self.assertIs(cachedStatisticsImage, statisticsImage)
+    self.assertEqual(list(statisticsImage.GetExtent()), sourceExtent)
+    median, inhomogeneity = getStatistics(statisticsImage)
+    dims = [sourceExtent[axis*2+1] - sourceExtent[axis*2] + 1 for axis in range(3)]
+    regionSlices = tuple(slice(regionExtent[axis*2] - sourceExtent[axis*2], regionExtent[axis*2+1] - sourceExtent[axis*2] + 1)
+      for axis in reversed(range(3)))
+    computedInRegion = regionInhomogeneity != -1
+    numpy.testing.assert_array_equal(median.reshape(dims[::-1])[regionSlices].ravel()[computedInRegion],
+      regionMedian[computedInRegion])
+    numpy.testing.assert_array_equal(inhomogeneity.reshape(dims[::-1])[regionSlices].ravel()[computedInRegion],
+      regionInhomogeneity[computedInRegion])
+    # same segment as with the statistics computed from scratch
+    numpy.testing.assert_array_equal(self.getSegmentArray(segmentIds[0]), segmentArray)
+
+    # cache miss: a modified source image is prepared again, the previous input is kept while the cache is not full
+    modifiedImageData = vtk.vtkImageData()
+    modifiedImageData.DeepCopy(sourceImageData)
+    self.assertGreater(modifiedImageData.GetMTime(), sourceImageData.GetMTime())
+    _, newIntensityBinEdges, newStatisticsImage = effect.getPreparedInput(modifiedImageData)
+    self.assertIsNot(newStatisticsImage, statisticsImage)
+    self.assertEqual(len(effect.preparedInputCache), 2)
+
+    # least recently used inputs are removed when the cache is full, the current input is kept
+    effectModule = sys.modules[type(effect).__module__]
+    with mock.patch.object(effectModule, "PREPARED_INPUT_CACHE_SIZE_MB", 0):
+      effect.shrinkPreparedInputCache()
+    self.assertEqual(len(effect.preparedInputCache), 1)
+    _, cachedIntensityBinEdges, cachedStatisticsImage = effect.getPreparedInput(modifiedImageData)
+    self.assertIs(cachedIntensityBinEdges, newIntensityBinEdges)
+    self.assertIs(cachedStatisticsImage, newStatisticsImage)
+
+    self.delayDisplay("Test passed")
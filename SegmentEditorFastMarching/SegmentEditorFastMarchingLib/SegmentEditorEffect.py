@@ -1,8 +1,53 @@
 import os
 import vtk, qt, ctk, slicer
 import logging
+from collections import OrderedDict
 from SegmentEditorEffects import *
 
+# The front cannot get closer to the image boundary than this many voxels
+# (BAND_OUT in vtkPichonFastMarching.h, plus one voxel).
+FRONT_BOUNDARY_MARGIN = 4
+
+# Number of times the segment is updated while the front is growing (if live preview is enabled)
+LIVE_PREVIEW_UPDATE_COUNT = 50
+
+# The intensity statistics of the front are updated each time the front reaches this fraction of the
+# source volume (the filter then adapts the interval). It does not depend on the maximum volume, so that
+# continuing the evolution reaches the same voxels as marching to the larger maximum volume at once.
+STATISTICS_UPDATE_FRACTION = 0.001
+
+# Minimum time between segment updates while the segment volume slider is moved (in milliseconds)
+SEGMENT_VOLUME_UPDATE_INTERVAL_MS = 30
+
+# Marching is stopped at a leak if the arrival time of the front grows by this ratio
+# (see vtkPichonFastMarching::setLeakDetectionRatio)
+LEAK_DETECTION_RATIO = 10.0
+
+# Maximum number of segments that can be grown at once. The filter stores the front
+# of each voxel in 8 bits (N_MAX_LABELS in vtkPichonFastMarching.h).
+MAX_GROWN_SEGMENT_COUNT = 255
+
+# Maximum memory used for keeping prepared inputs of previous marchings (in megabytes)
+PREPARED_INPUT_CACHE_SIZE_MB = 2048
+
+# Maximum memory used for keeping the marching sessions of segments that are not selected (in megabytes)
+MARCHING_SESSION_CACHE_SIZE_MB = 1024
+
+# Maximum number of intensity bins used by the filter. This is more or less arbitrary;
+# large values will bring the algorithm to the knees.
+INTENSITY_BIN_COUNT = 300
+
+# Number of voxels used for estimating the intensity percentiles that define the bins
+INTENSITY_BINNING_SAMPLE_SIZE = 1000000
+
+ARRIVAL_MAP_RANK = "Arrival rank"
+ARRIVAL_MAP_TIME = "Arrival time"
+
+# Arrival rank of the applied front is stored in a hidden volume node that the segmentation node
+# refers to with this role + segment ID, so that the segment volume can be adjusted without re-marching.
+# The volume nodes are saved with the scene. Volumes of removed segments are deleted when the effect is activated.
+ARRIVAL_RANK_REFERENCE_ROLE = "FastMarching.ArrivalRank."
+
 class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
   """This effect uses FastMarching algorithm to partition the input volume"""
 
@@ -12,10 +57,53 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
     AbstractScriptedSegmentEditorEffect.__init__(self, scriptedEffect)
     self.originalSelectedSegmentLabelmap = None
     self.selectedSegmentId = None
+    # Segments grown by the current front. Label value of a segment
+    # in the output of the filter is its position in the list + 1.
+    self.segmentIds = []
+    # Original labelmap of the grown segments other than the selected segment
+    self.originalOtherSegmentLabelmaps = {}
     self.fm = None
+    self.fmInputs = None
+    self.marchingExtent = None
+    # Largest region that the front can reach: the source volume extent, cropped to the editable region
+    self.marchingBoundsExtent = None
     self.totalNumberOfVoxels = 0
+    # Known points of the filter that are not counted in the front volume (the planted seeds,
+    # except the inside of the coarse segments in coarse-to-fine mode)
+    self.numberOfSeedPoints = 0
     self.voxelVolume = 0
 
+    # Arrival rank restored from a previously applied front (used instead of the filter
+    # if the effect is re-entered) and the number of points of that front
+    self.storedArrivalRank = None
+    self.storedNumberOfPoints = 0
+
+    # Intensity bins of source volumes, with the median and inhomogeneity computed so far
+    # (source volume ID, image MTime) -> (intensityBinEdges, statisticsImage).
+    # Least recently used item is the first.
+    self.preparedInputCache = OrderedDict()
+
+    # Marching sessions of previously selected segments, so that their segment volume
+    # can still be adjusted when they are selected again.
+    # (segment ID, source image MTime) -> session (see getSession).
+    # Least recently used item is the first.
+    self.sessionCache = OrderedDict()
+    # Selected segment when the sessions were last switched
+    self.sessionSelectedSegmentId = None
+
+    # Marching runs in a background thread, this timer checks if it is completed
+    self.marchingTask = None
+    self.previewedPoints = 0
+    self.marchingTimer = qt.QTimer()
+    self.marchingTimer.setInterval(100)
+    self.marchingTimer.connect('timeout()', self.onMarchingTimer)
+
+    # Segment volume slider events are coalesced, the segment is updated with the latest value
+    self.marcherUpdateTimer = qt.QTimer()
+    self.marcherUpdateTimer.setSingleShot(True)
+    self.marcherUpdateTimer.setInterval(SEGMENT_VOLUME_UPDATE_INTERVAL_MS)
+    self.marcherUpdateTimer.connect('timeout()', self.onMarcherUpdateTimer)
+
   def clone(self):
     # It should not be necessary to modify this method
     import qSlicerSegmentationsEditorEffectsPythonQt as effects
@@ -33,6 +121,18 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
   def helpText(self):
     return """<html>Expand the selected segment<br> to regions that have similar intensity.<p>
 Only the selected segment is expanded. No background segment is needed.
+If <i>Grow all visible segments</i> is enabled then all visible segments are expanded at once,
+each voxel is added to the segment that reaches it first.
+<i>Coarse-to-fine</i> marching grows the segments on a downsampled volume first and then only refines
+a band around their boundary at full resolution, which is much faster for large volumes.
+The arrival order of the applied front is saved with the segmentation, so when the effect is selected again
+the <i>Segment volume</i> of the segment can be adjusted without marching again, unless the segment was modified since.
+The arrival order is stored in hidden volumes, which are saved with the scene.
+Previewed segments keep their front when another segment is selected, so the segment volume of each of them
+can be adjusted after selecting it again, until the result is applied or cancelled.
+If <i>Stop at leak</i> is enabled then marching stops when the front starts to leak out of the structure
+and the segment volume is set to the detected stop volume.
+Masking settings are taken into account: the front never grows into voxels that cannot be edited.
 The effect uses <a href="http://www.spl.harvard.edu/publications/item/view/193">fast marching method</a>.
 <p></html>"""
 
@@ -49,6 +149,56 @@ The effect uses <a href="http://www.spl.harvard.edu/publications/item/view/193">
     self.percentMax.connect('valueChanged(double)', self.percentMaxChanged)
     self.scriptedEffect.addLabeledOptionsWidget("Maximum volume:", self.percentMax)
 
+    self.bucketQueueCheckBox = qt.QCheckBox()
+    self.bucketQueueCheckBox.setToolTip('Use bucket queue for ordering the front instead of an exact heap.'
+      ' Marching is faster on large volumes, but voxels that arrive at almost the same time may be added in slightly different order.')
+    self.bucketQueueCheckBox.connect('toggled(bool)', self.percentMaxChanged)
+    self.scriptedEffect.addLabeledOptionsWidget("Fast approximate ordering:", self.bucketQueueCheckBox)
+
+    self.seedRegionOnlyCheckBox = qt.QCheckBox()
+    self.seedRegionOnlyCheckBox.setToolTip('Only process the region around the seeds that the maximum volume can fill.'
+      ' The region is automatically grown if the segment reaches its boundary. Makes segmentation of small structures in large volumes much faster.')
+    self.seedRegionOnlyCheckBox.connect('toggled(bool)', self.percentMaxChanged)
+    self.scriptedEffect.addLabeledOptionsWidget("Process region around seeds only:", self.seedRegionOnlyCheckBox)
+
+    self.allVisibleSegmentsCheckBox = qt.QCheckBox()
+    self.allVisibleSegmentsCheckBox.setToolTip('Grow all visible segments at once, in a single marching.'
+      ' Each voxel is added to the segment whose front reaches it first. Maximum volume is the total volume of all the segments.')
+    self.allVisibleSegmentsCheckBox.connect('toggled(bool)', self.percentMaxChanged)
+    self.scriptedEffect.addLabeledOptionsWidget("Grow all visible segments:", self.allVisibleSegmentsCheckBox)
+
+    self.livePreviewCheckBox = qt.QCheckBox()
+    self.livePreviewCheckBox.setToolTip('Update the segment while the front is growing.'
+      ' Marching can be stopped as soon as the segment looks right, keeping the result that has been computed so far.')
+    self.livePreviewCheckBox.connect('toggled(bool)', self.percentMaxChanged)
+    self.scriptedEffect.addLabeledOptionsWidget("Live preview:", self.livePreviewCheckBox)
+
+    self.stopAtLeakCheckBox = qt.QCheckBox()
+    self.stopAtLeakCheckBox.setToolTip('Stop marching when the front starts to leak out of the structure (its arrival time suddenly jumps),'
+      ' instead of always growing the segment to the maximum volume. The segment volume is set to the detected stop volume.')
+    self.stopAtLeakCheckBox.connect('toggled(bool)', self.percentMaxChanged)
+    self.scriptedEffect.addLabeledOptionsWidget("Stop at leak:", self.stopAtLeakCheckBox)
+
+    self.coarseToFineFactorSelector = qt.QComboBox()
+    self.coarseToFineFactorSelector.addItem("Off", 1)
+    self.coarseToFineFactorSelector.addItem("2x", 2)
+    self.coarseToFineFactorSelector.addItem("4x", 4)
+    self.coarseToFineFactorSelector.setToolTip('Grow the segments on a volume downsampled by this factor first,'
+      ' then only march in a band around the boundary of the coarse segments at full resolution.'
+      ' Makes segmentation of large structures in large volumes much faster and uses less memory.')
+    self.coarseToFineFactorSelector.connect("currentIndexChanged(int)", self.percentMaxChanged)
+    self.coarseToFineBandWidthSpinBox = qt.QSpinBox()
+    self.coarseToFineBandWidthSpinBox.minimum = 1
+    self.coarseToFineBandWidthSpinBox.maximum = 10
+    self.coarseToFineBandWidthSpinBox.suffix = ' voxels'
+    self.coarseToFineBandWidthSpinBox.setToolTip('Width of the band around the boundary of the coarse segments that is marched at full resolution,'
+      ' in downsampled voxels. Larger values give results closer to marching at full resolution.')
+    self.coarseToFineBandWidthSpinBox.connect('valueChanged(int)', self.percentMaxChanged)
+    coarseToFineFrame = qt.QHBoxLayout()
+    coarseToFineFrame.addWidget(self.coarseToFineFactorSelector)
+    coarseToFineFrame.addWidget(self.coarseToFineBandWidthSpinBox)
+    self.scriptedEffect.addLabeledOptionsWidget("Coarse-to-fine:", coarseToFineFrame)
+
     self.march = qt.QPushButton("Initialize")
     self.march.setToolTip("Perform the Marching operation into the current label map")
     self.scriptedEffect.addOptionsWidget(self.march)
@@ -64,6 +214,21 @@ The effect uses <a href="http://www.spl.harvard.edu/publications/item/view/193">
     self.marcher.connect('valueChanged(double)',self.onMarcherChanged)
     self.percentVolume = self.scriptedEffect.addLabeledOptionsWidget("Segment volume:", self.marcher)
 
+    self.arrivalMapTypeSelector = qt.QComboBox()
+    self.arrivalMapTypeSelector.addItem(ARRIVAL_MAP_RANK)
+    self.arrivalMapTypeSelector.addItem(ARRIVAL_MAP_TIME)
+    self.arrivalMapTypeSelector.setToolTip('Arrival rank: order in which the front reached each voxel (unsigned int, 0 where not reached).'
+      ' Arrival time: fast marching arrival time of each voxel (float).')
+    self.arrivalMapTypeSelector.connect("currentIndexChanged(int)", self.updateMRMLFromGUI)
+    self.exportArrivalMapButton = qt.QPushButton("Export")
+    self.exportArrivalMapButton.setToolTip("Export arrival map of the front to a new volume."
+      " Thresholding the arrival rank volume gives the segment for any volume without marching again.")
+    self.exportArrivalMapButton.connect('clicked()', self.onExportArrivalMap)
+    arrivalMapFrame = qt.QHBoxLayout()
+    arrivalMapFrame.addWidget(self.arrivalMapTypeSelector)
+    arrivalMapFrame.addWidget(self.exportArrivalMapButton)
+    self.scriptedEffect.addLabeledOptionsWidget("Arrival map:", arrivalMapFrame)
+
     self.cancelButton = qt.QPushButton("Cancel")
     self.cancelButton.objectName = self.__class__.__name__ + 'Cancel'
     self.cancelButton.setToolTip("Clear preview and cancel")
@@ -80,51 +245,289 @@ The effect uses <a href="http://www.spl.harvard.edu/publications/item/view/193">
     self.cancelButton.connect('clicked()', self.onCancel)
     self.applyButton.connect('clicked()', self.onApply)
 
+  def activate(self):
+    self.removeUnusedArrivalRanks()
+    self.switchSession()
+    if not self.fm and not self.marchingTask and self.storedArrivalRank is None:
+      self.restoreArrivalRank()
+
+  def deactivate(self):
+    self.marcherUpdateTimer.stop()
+    self.cancelMarching()
+    # previewed segments of cached sessions could not be applied or cancelled anymore
+    self.resetCachedSessions()
+
   def createCursor(self, widget):
     # Turn off effect-specific cursor for this effect
     return slicer.util.mainWindow().cursor
 
   def setMRMLDefaults(self):
     self.scriptedEffect.setParameterDefault("PercentMax", 10)
+    self.scriptedEffect.setParameterDefault("BucketQueue", 0)
+    self.scriptedEffect.setParameterDefault("SeedRegionOnly", 0)
+    self.scriptedEffect.setParameterDefault("AllVisibleSegments", 0)
+    self.scriptedEffect.setParameterDefault("LivePreview", 0)
+    self.scriptedEffect.setParameterDefault("StopAtLeak", 0)
+    self.scriptedEffect.setParameterDefault("CoarseToFineFactor", 1)
+    self.scriptedEffect.setParameterDefault("CoarseToFineBandWidth", 2)
+    self.scriptedEffect.setParameterDefault("ArrivalMapType", ARRIVAL_MAP_RANK)
 
   def updateGUIFromMRML(self):
+    self.switchSession()
     percentMax = self.scriptedEffect.doubleParameter("PercentMax")
     wasBlocked = self.percentMax.blockSignals(True)
     self.percentMax.value = abs(percentMax)
     self.percentMax.blockSignals(wasBlocked)
-    enableApplyCancel = self.fm is not None
+    wasBlocked = self.bucketQueueCheckBox.blockSignals(True)
+    self.bucketQueueCheckBox.checked = (self.scriptedEffect.integerParameter("BucketQueue") != 0)
+    self.bucketQueueCheckBox.blockSignals(wasBlocked)
+    wasBlocked = self.seedRegionOnlyCheckBox.blockSignals(True)
+    self.seedRegionOnlyCheckBox.checked = (self.scriptedEffect.integerParameter("SeedRegionOnly") != 0)
+    self.seedRegionOnlyCheckBox.blockSignals(wasBlocked)
+    wasBlocked = self.allVisibleSegmentsCheckBox.blockSignals(True)
+    self.allVisibleSegmentsCheckBox.checked = (self.scriptedEffect.integerParameter("AllVisibleSegments") != 0)
+    self.allVisibleSegmentsCheckBox.blockSignals(wasBlocked)
+    wasBlocked = self.livePreviewCheckBox.blockSignals(True)
+    self.livePreviewCheckBox.checked = (self.scriptedEffect.integerParameter("LivePreview") != 0)
+    self.livePreviewCheckBox.blockSignals(wasBlocked)
+    wasBlocked = self.stopAtLeakCheckBox.blockSignals(True)
+    self.stopAtLeakCheckBox.checked = (self.scriptedEffect.integerParameter("StopAtLeak") != 0)
+    self.stopAtLeakCheckBox.blockSignals(wasBlocked)
+    coarseToFineFactor = self.scriptedEffect.integerParameter("CoarseToFineFactor")
+    wasBlocked = self.coarseToFineFactorSelector.blockSignals(True)
+    self.coarseToFineFactorSelector.setCurrentIndex(max(0, self.coarseToFineFactorSelector.findData(coarseToFineFactor)))
+    self.coarseToFineFactorSelector.blockSignals(wasBlocked)
+    wasBlocked = self.coarseToFineBandWidthSpinBox.blockSignals(True)
+    self.coarseToFineBandWidthSpinBox.value = self.scriptedEffect.integerParameter("CoarseToFineBandWidth")
+    self.coarseToFineBandWidthSpinBox.blockSignals(wasBlocked)
+    self.coarseToFineBandWidthSpinBox.enabled = (coarseToFineFactor > 1)
+    wasBlocked = self.arrivalMapTypeSelector.blockSignals(True)
+    self.arrivalMapTypeSelector.setCurrentText(self.scriptedEffect.parameter("ArrivalMapType"))
+    self.arrivalMapTypeSelector.blockSignals(wasBlocked)
+    enableApplyCancel = (self.fm is not None or self.storedArrivalRank is not None) and self.marchingTask is None
     self.applyButton.enabled = enableApplyCancel
     self.cancelButton.enabled = enableApplyCancel
     self.marcher.enabled = enableApplyCancel
+    self.exportArrivalMapButton.enabled = self.fm is not None and self.marchingTask is None
 
   def updateMRMLFromGUI(self):
     self.scriptedEffect.setParameter("PercentMax", self.percentMax.value)
+    self.scriptedEffect.setParameter("BucketQueue", 1 if self.bucketQueueCheckBox.checked else 0)
+    self.scriptedEffect.setParameter("SeedRegionOnly", 1 if self.seedRegionOnlyCheckBox.checked else 0)
+    self.scriptedEffect.setParameter("AllVisibleSegments", 1 if self.allVisibleSegmentsCheckBox.checked else 0)
+    self.scriptedEffect.setParameter("LivePreview", 1 if self.livePreviewCheckBox.checked else 0)
+    self.scriptedEffect.setParameter("StopAtLeak", 1 if self.stopAtLeakCheckBox.checked else 0)
+    self.scriptedEffect.setParameter("CoarseToFineFactor", self.coarseToFineFactorSelector.currentData)
+    self.scriptedEffect.setParameter("CoarseToFineBandWidth", self.coarseToFineBandWidthSpinBox.value)
+    self.scriptedEffect.setParameter("ArrivalMapType", self.arrivalMapTypeSelector.currentText)
 
   def onMarch(self):
-    # This can be a long operation - indicate it to the user
-    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
-    try:
+    if self.marchingTask:
+      # the button acts as a stop/cancel button while marching is in progress
+      if self.scriptedEffect.integerParameter("LivePreview") != 0:
+        self.stopMarching()
+      else:
+        self.cancelMarching()
+      return
+
+    # This can be a long operation - it runs in the background and can be cancelled
+    self.marchingTask = self.marchingSteps(self.percentMax.value)
+    self.previewedPoints = 0
+    if self.scriptedEffect.integerParameter("LivePreview") != 0:
+      self.march.text = "Stop"
+      self.march.setToolTip("Stop the Marching operation and keep the segment that has been grown so far")
+    else:
+      self.march.text = "Cancel"
+      self.march.setToolTip("Stop the Marching operation")
+    self.updateGUIFromMRML()
+    self.marchingTimer.start()
+
+  def marchingSteps(self, percentMax):
+    """Performs marching. Yields while the filter is running in the background."""
+    slicer.util.showStatusMessage('Running FastMarching...')
+    continued = yield from self.continueMarching(percentMax)
+    if not continued:
       self.reset() # restore initial seeds in the labelmap
-      slicer.util.showStatusMessage('Running FastMarching...', 2000)
       self.scriptedEffect.saveStateForUndo()
-      self.fastMarching(self.percentMax.value)
-      slicer.util.showStatusMessage('FastMarching finished', 2000)
-      self.marcher.value = 100
-      if self.totalNumberOfVoxels>0:
-        self.marcher.enabled = True
-    finally:
-      qt.QApplication.restoreOverrideCursor()
+      yield from self.fastMarching(percentMax)
+      if not self.fm:
+        # marching could not be started, keep the error message
+        return
+    leakOnsetPoints = self.fm.getLeakOnsetPoints() if self.fm else 0
+    if leakOnsetPoints > 0:
+      # show the segment before the leak, the points reached after that can still be shown by the slider
+      stopVolumeMl = leakOnsetPoints * self.voxelVolume / 1000.
+      slicer.util.showStatusMessage('FastMarching stopped at leak, segment volume: {0:.2f} ml'.format(stopVolumeMl), 5000)
+      logging.info('FastMarching detected leak at {0} voxels ({1:.2f} ml)'.format(leakOnsetPoints, stopVolumeMl))
+      self.marcher.value = 100. * (leakOnsetPoints - 1) / max(1, self.fm.nKnownPoints() - 1)
+      return
+    slicer.util.showStatusMessage('FastMarching finished', 2000)
+    self.marcher.value = 100
+
+  def onMarchingTimer(self):
+    if self.fm and self.fm.isBackgroundUpdateRunning():
+      slicer.util.showStatusMessage('Running FastMarching... {0:.0f}%'.format(self.fm.getBackgroundUpdateProgress()*100))
+      previewedPoints = self.fm.nPreviewedPoints()
+      if previewedPoints != self.previewedPoints and self.fm.getPreviewInterval() > 0:
+        self.previewedPoints = previewedPoints
+        self.updateLabel()
+      return
+    try:
+      next(self.marchingTask)
+    except StopIteration:
+      self.stopMarchingTask()
+    except:
+      self.stopMarchingTask()
+      raise
+
+  def stopMarchingTask(self):
+    self.marchingTimer.stop()
+    self.marchingTask = None
+    self.march.text = "Initialize"
+    self.march.setToolTip("Perform the Marching operation into the current label map")
     self.updateGUIFromMRML()
 
+  def cancelMarching(self):
+    """Stop marching that is in progress and restore the original segment"""
+    if not self.marchingTask:
+      return
+    if self.fm:
+      self.fm.SetAbortExecute(1)
+      self.fm.waitForBackgroundUpdate()
+    self.marchingTask.close()
+    self.stopMarchingTask()
+    self.reset()
+    slicer.util.showStatusMessage('FastMarching cancelled', 2000)
+
+  def stopMarching(self):
+    """Stop marching that is in progress and keep the segment that has been grown so far"""
+    if not self.marchingTask:
+      return
+    if not self.fm or self.fm.nPreviewedPoints() == 0:
+      # the front has not started to grow yet, there is nothing to keep
+      self.cancelMarching()
+      return
+    self.fm.SetAbortExecute(1)
+    self.fm.waitForBackgroundUpdate()
+    self.marchingTask.close()
+    self.stopMarchingTask()
+    self.marcher.value = 100
+    self.updateLabel(1.0)
+    slicer.util.showStatusMessage('FastMarching stopped', 2000)
+
+  def getPreviewInterval(self, npoints):
+    """Number of evolution steps between live preview updates (0 if live preview is disabled)"""
+    if self.scriptedEffect.integerParameter("LivePreview") == 0:
+      return 0
+    return max(1, npoints // LIVE_PREVIEW_UPDATE_COUNT)
+
+  def getLeakDetectionRatio(self):
+    """Ratio of arrival time increase that stops marching (0 if marching is not stopped at leaks)"""
+    if self.scriptedEffect.integerParameter("StopAtLeak") == 0:
+      return 0
+    return LEAK_DETECTION_RATIO
+
+  def updateFilterInBackground(self):
+    """Updates the filter in a background thread. Yields until the update is completed."""
+    self.fm.Modified()
+    self.fm.startBackgroundUpdate()
+    while self.fm.isBackgroundUpdateRunning():
+      yield
+    self.fm.waitForBackgroundUpdate()
+
   def onMarcherChanged(self,value):
-    self.updateLabel(value/self.marcher.maximum)
+    if not self.marcherUpdateTimer.isActive():
+      self.marcherUpdateTimer.start()
+
+  def onMarcherUpdateTimer(self):
+    if self.marchingTask:
+      # the filter is in use, the segment is updated when marching is completed
+      return
+    self.updateLabel(self.marcher.value/self.marcher.maximum, modifiedExtentOnly=True)
 
   def percentMaxChanged(self, val):
     self.updateMRMLFromGUI()
 
+  def getMarchingInputs(self):
+    """Parameters that the current marching result depends on (except maximum volume)"""
+    parameterSetNode = self.scriptedEffect.parameterSetNode()
+    sourceVolumeNode = parameterSetNode.GetSourceVolumeNode()
+    sourceImageData = self.scriptedEffect.sourceVolumeImageData()
+    return (sourceVolumeNode.GetID() if sourceVolumeNode else None,
+      sourceImageData.GetMTime() if sourceImageData else 0,
+      tuple(self.getGrownSegmentIds()),
+      parameterSetNode.GetMaskMode(),
+      parameterSetNode.GetMaskSegmentID(),
+      parameterSetNode.GetSourceVolumeIntensityMask(),
+      tuple(parameterSetNode.GetSourceVolumeIntensityMaskRange()),
+      self.scriptedEffect.integerParameter("BucketQueue"),
+      self.scriptedEffect.integerParameter("SeedRegionOnly"),
+      self.scriptedEffect.integerParameter("CoarseToFineFactor"),
+      self.scriptedEffect.integerParameter("CoarseToFineBandWidth"))
+
+  def getGrownSegmentIds(self):
+    """Segments to grow: the selected segment and, if enabled, all the other visible segments"""
+    parameterSetNode = self.scriptedEffect.parameterSetNode()
+    selectedSegmentId = parameterSetNode.GetSelectedSegmentID()
+    segmentIds = [selectedSegmentId]
+    if self.scriptedEffect.integerParameter("AllVisibleSegments") == 0:
+      return segmentIds
+    displayNode = parameterSetNode.GetSegmentationNode().GetDisplayNode()
+    if not displayNode:
+      return segmentIds
+    visibleSegmentIds = vtk.vtkStringArray()
+    displayNode.GetVisibleSegmentIDs(visibleSegmentIds)
+    for index in range(visibleSegmentIds.GetNumberOfValues()):
+      segmentId = visibleSegmentIds.GetValue(index)
+      if segmentId != selectedSegmentId:
+        segmentIds.append(segmentId)
+    return segmentIds
+
+  def continueMarching(self, percentMax):
+    """Continue the evolution of the current front until the new maximum volume is reached.
+    Returns False if marching has to be restarted from the seeds. Yields while the filter is running in the background.
+    """
+    if not self.fm or self.totalNumberOfVoxels <= 0 or self.fmInputs != self.getMarchingInputs():
+      return False
+    dim = self.scriptedEffect.sourceVolumeImageData().GetDimensions()
+    npoints = int(dim[0]*dim[1]*dim[2]*percentMax/100.)
+    npointsMarched = self.fm.nKnownPoints() - self.numberOfSeedPoints
+    if npoints <= npointsMarched:
+      # evolution would be different with a smaller target volume
+      return False
+
+    # Continue from the complete front, not just from the currently displayed part
+    self.fm.show(1)
+    self.fm.setNPointsEvolution(npoints - npointsMarched)
+    self.fm.setPreviewInterval(self.getPreviewInterval(npoints - npointsMarched))
+    self.fm.setLeakDetectionRatio(self.getLeakDetectionRatio())
+    yield from self.updateFilterInBackground()
+    self.totalNumberOfVoxels = npoints
+
+    sourceExtent = self.marchingBoundsExtent
+    if self.marchingExtent != sourceExtent and self.isFrontAtRegionBoundary(self.marchingExtent, sourceExtent):
+      # processed region is too small for the new maximum volume
+      return False
+
+    self.scriptedEffect.saveStateForUndo()
+    self.updateLabel(self.marcher.value/self.marcher.maximum)
+    logging.info('FastMarching march continued')
+    return True
+
   def fastMarching(self,percentMax):
+    """Grow the selected segment from its seeds. Yields while the filter is running in the background."""
 
     self.fm = None
+    self.fmInputs = self.getMarchingInputs()
+
+    segmentIds = self.getGrownSegmentIds()
+    if len(segmentIds) > MAX_GROWN_SEGMENT_COUNT:
+      message = 'FastMarching cannot grow more than {0} segments at once ({1} visible segments)'.format(
+        MAX_GROWN_SEGMENT_COUNT, len(segmentIds))
+      logging.error(message)
+      slicer.util.showStatusMessage(message, 5000)
+      self.totalNumberOfVoxels = 0
+      return
 
     # Get source volume image data
     import vtkSegmentationCorePython as vtkSegmentationCore
@@ -132,18 +535,6 @@ The effect uses <a href="http://www.spl.harvard.edu/publications/item/view/193">
     # Get segmentation
     segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
 
-    # Cast source image if not short
-    if sourceImageData.GetScalarType() != vtk.VTK_SHORT:
-      imageCast = vtk.vtkImageCast()
-      imageCast.SetInputData(sourceImageData)
-      imageCast.SetOutputScalarTypeToShort()
-      imageCast.ClampOverflowOn()
-      imageCast.Update()
-      sourceImageDataShort = vtkSegmentationCore.vtkOrientedImageData()
-      sourceImageDataShort.ShallowCopy(imageCast.GetOutput()) # Copy image data
-      sourceImageDataShort.CopyDirections(sourceImageData) # Copy geometry
-      sourceImageData = sourceImageDataShort
-
     if not self.originalSelectedSegmentLabelmap:
       segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
       segmentationNode.GetSegmentation().SeparateSegmentLabelmap(self.scriptedEffect.parameterSetNode().GetSelectedSegmentID())
@@ -155,115 +546,843 @@ The effect uses <a href="http://www.spl.harvard.edu/publications/item/view/193">
       self.originalSelectedSegmentLabelmap.DeepCopy(selectedSegmentLabelmap)
       self.selectedSegmentId = self.scriptedEffect.parameterSetNode().GetSelectedSegmentID()
 
-    # We need to know exactly the value of the segment voxels, apply threshold to make force the selected label value
+    # Seeds of all the grown segments are merged into one labelmap, where
+    # the label value of each segment is its position in the list + 1.
+    self.segmentIds = segmentIds
+    if len(self.segmentIds) > 1:
+      segmentIdsArray = vtk.vtkStringArray()
+      for segmentId in self.segmentIds:
+        segmentIdsArray.InsertNextValue(segmentId)
+        if segmentId == self.selectedSegmentId or segmentId in self.originalOtherSegmentLabelmaps:
+          continue
+        segmentationNode.GetSegmentation().SeparateSegmentLabelmap(segmentId)
+        originalLabelmap = vtkSegmentationCore.vtkOrientedImageData()
+        segmentationNode.GetBinaryLabelmapRepresentation(segmentId, originalLabelmap)
+        self.originalOtherSegmentLabelmaps[segmentId] = originalLabelmap
+      seedLabelmap = vtkSegmentationCore.vtkOrientedImageData()
+      segmentationNode.GenerateMergedLabelmapForAllSegments(seedLabelmap,
+        vtkSegmentationCore.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY, sourceImageData, segmentIdsArray)
+    else:
+      seedLabelmap = selectedSegmentLabelmap
+
+    dim = sourceImageData.GetDimensions()
+    npoints = int(dim[0]*dim[1]*dim[2]*percentMax/100.)
+
+    spacing = self.originalSelectedSegmentLabelmap.GetSpacing()
+    self.voxelVolume = spacing[0] * spacing[1] * spacing[2]
+    self.totalNumberOfVoxels = npoints
+
+    preparedInput = self.getPreparedInput(sourceImageData)
+
+    # Voxels that cannot be edited are never reached by the front
+    editMask = self.getEditMask(sourceImageData, seedLabelmap)
+
+    # Number of points added by the front (not counting the seeds)
+    npointsEvolution = npoints
+    numberOfSeedVoxels = 0
+    coarseToFineFactor = self.scriptedEffect.integerParameter("CoarseToFineFactor")
+    if coarseToFineFactor > 1:
+      # The approximate region is found at low resolution, the inside of the coarse
+      # segments is used as seed and only the band around it is marched at full resolution.
+      refinedSeeds = yield from self.coarseMarching(preparedInput, seedLabelmap, npoints, coarseToFineFactor, editMask)
+      if refinedSeeds is None:
+        self.totalNumberOfVoxels = 0
+        return
+      seedLabelmap, numberOfSeedVoxels = refinedSeeds
+      npointsEvolution = max(0, npoints - numberOfSeedVoxels)
+
+    sourceExtent = list(sourceImageData.GetExtent())
+    if editMask:
+      sourceExtent = self.getEditableExtent(editMask, sourceExtent)
+    self.marchingBoundsExtent = sourceExtent
+    roiExtent = sourceExtent
+    seedRegionOnly = (self.scriptedEffect.integerParameter("SeedRegionOnly") != 0) or coarseToFineFactor > 1
+    if seedRegionOnly:
+      seedExtent = [0, -1, 0, -1, 0, -1]
+      vtkSegmentationCore.vtkOrientedImageDataResample.CalculateEffectiveExtent(seedLabelmap, seedExtent)
+      if seedExtent[0] > seedExtent[1] or seedExtent[2] > seedExtent[3] or seedExtent[4] > seedExtent[5]:
+        # no seeds, nothing to crop to
+        seedRegionOnly = False
+      elif coarseToFineFactor > 1:
+        # The front only has to fill the band around the inside of the coarse segments.
+        # If the front still reaches the region boundary then the region is grown.
+        margin = 2 * self.scriptedEffect.integerParameter("CoarseToFineBandWidth") * coarseToFineFactor + FRONT_BOUNDARY_MARGIN
+      else:
+        # Region that could be filled by the target volume in all directions around the seeds.
+        # If the front still reaches the region boundary then the region is grown.
+        margin = int(npoints**(1./3.)) + FRONT_BOUNDARY_MARGIN
+
+    while True:
+      if seedRegionOnly:
+        roiExtent = []
+        for axis in range(3):
+          roiExtent.append(max(seedExtent[axis*2] - margin, sourceExtent[axis*2]))
+          roiExtent.append(min(seedExtent[axis*2+1] + margin, sourceExtent[axis*2+1]))
+
+      self.marchingExtent = roiExtent
+      nSeeds = yield from self.fastMarchingInExtent(preparedInput, seedLabelmap, roiExtent, npointsEvolution, maskImage=editMask)
+      if nSeeds == 0:
+        self.totalNumberOfVoxels = 0
+        return
+      if coarseToFineFactor > 1:
+        # the inside of the coarse segments is counted in the front volume
+        self.numberOfSeedPoints = nSeeds - numberOfSeedVoxels
+      else:
+        # Seeds that were reached by the front of neighboring seeds before they were planted
+        # are counted in the front volume, same as when the evolution is continued
+        self.numberOfSeedPoints = self.fm.nKnownSeeds()
+
+      if roiExtent == sourceExtent or not self.isFrontAtRegionBoundary(roiExtent, sourceExtent):
+        break
+
+      margin *= 2
+      logging.info('FastMarching front reached the region boundary, growing region by {0} voxels'.format(margin))
+
+    self.updateLabel(self.marcher.value/self.marcher.maximum)
+
+    logging.info('FastMarching march update completed')
+
+  def getEditMask(self, sourceImageData, seedLabelmap):
+    """Returns an unsigned char image in the extent of the source image that is non-zero where the front must not go,
+    according to the masking settings of the segment editor. Seeds are never masked.
+    Returns None if all voxels can be edited.
+    """
+    parameterSetNode = self.scriptedEffect.parameterSetNode()
+    intensityBasedMasking = parameterSetNode.GetSourceVolumeIntensityMask()
+    if parameterSetNode.GetMaskMode() == slicer.vtkMRMLSegmentationNode.EditAllowedEverywhere and not intensityBasedMasking:
+      return None
+
+    import vtkSegmentationCorePython as vtkSegmentationCore
+    from vtk.util import numpy_support
+    maskImageData = vtkSegmentationCore.vtkOrientedImageData()
+    segmentationNode = parameterSetNode.GetSegmentationNode()
+    success = segmentationNode.GenerateEditMask(maskImageData,
+      parameterSetNode.GetMaskMode(),
+      sourceImageData, # reference geometry
+      parameterSetNode.GetSelectedSegmentID(),
+      parameterSetNode.GetMaskSegmentID() if parameterSetNode.GetMaskSegmentID() else "",
+      sourceImageData if intensityBasedMasking else None,
+      parameterSetNode.GetSourceVolumeIntensityMaskRange() if intensityBasedMasking else None)
+    if not success:
+      logging.error("Failed to create edit mask")
+      return None
+
+    # Seeds of the other grown segments may be masked (for example if editing is only allowed outside all segments)
+    seedPad = vtk.vtkImageConstantPad()
+    seedPad.SetInputData(seedLabelmap)
+    seedPad.SetOutputWholeExtent(maskImageData.GetExtent())
+    seedPad.SetConstant(0)
+    seedPad.Update()
+    mask = numpy_support.vtk_to_numpy(maskImageData.GetPointData().GetScalars())
+    seeds = numpy_support.vtk_to_numpy(seedPad.GetOutput().GetPointData().GetScalars())
+    mask[seeds != 0] = 0
+    maskImageData.Modified()
+    return maskImageData
+
+  def getEditableExtent(self, editMask, sourceExtent):
+    """Extent of the voxels that are not masked, with enough margin that the front can reach all of them"""
+    import numpy
+    from vtk.util import numpy_support
+    maskExtent = editMask.GetExtent()
+    dims = [maskExtent[axis*2+1] - maskExtent[axis*2] + 1 for axis in range(3)]
+    mask = numpy_support.vtk_to_numpy(editMask.GetPointData().GetScalars()).reshape(dims[2], dims[1], dims[0])
+    if mask.all():
+      # nothing can be edited, the front will not grow anyway
+      return sourceExtent
+    editableExtent = []
+    for axis in range(3):
+      # numpy array axes are in k, j, i order
+      editable = numpy.nonzero((mask == 0).any(axis=tuple(a for a in range(3) if a != 2-axis)))[0]
+      editableExtent.append(max(maskExtent[axis*2] + int(editable[0]) - FRONT_BOUNDARY_MARGIN, sourceExtent[axis*2]))
+      editableExtent.append(min(maskExtent[axis*2] + int(editable[-1]) + FRONT_BOUNDARY_MARGIN, sourceExtent[axis*2+1]))
+    return editableExtent
+
+  def getPreparedInput(self, sourceImageData):
+    """Returns the source image, the upper bounds of the intensity bins used by the filter (at most
+    INTENSITY_BIN_COUNT bins), and an image that stores the median and inhomogeneity computed by the
+    filters so far. The statistics image only covers the regions that were marched (see extendStatisticsImage).
+    The filter reads the source image directly, there is no conversion to short.
+    Results are cached, as they do not depend on the seeds.
+    """
+    sourceVolumeNode = self.scriptedEffect.parameterSetNode().GetSourceVolumeNode()
+    key = (sourceVolumeNode.GetID() if sourceVolumeNode else None, sourceImageData.GetMTime())
+    if key in self.preparedInputCache:
+      self.preparedInputCache.move_to_end(key)
+      return (sourceImageData,) + self.preparedInputCache[key]
+
+    intensityBinEdges = self.getIntensityBinEdges(sourceImageData)
+
+    # median and inhomogeneity computed by a filter are reused by the next ones,
+    # the image is allocated when a region is marched
+    statisticsImage = vtk.vtkImageData()
+    statisticsImage.SetExtent(0, -1, 0, -1, 0, -1)
+
+    self.preparedInputCache[key] = (intensityBinEdges, statisticsImage)
+    self.shrinkPreparedInputCache()
+
+    return (sourceImageData, intensityBinEdges, statisticsImage)
+
+  def getIntensityBinEdges(self, sourceImageData):
+    """Returns the upper bounds of the intensity bins (at most INTENSITY_BIN_COUNT bins) as a vtkDoubleArray.
+    Intensity bins are determined from the whole volume so that the result does not depend on the size
+    of the processed region.
+    """
+    import numpy
+    from vtk.util import numpy_support
+    scalarRange = sourceImageData.GetScalarRange()
+    if (sourceImageData.GetScalarType() not in [vtk.VTK_FLOAT, vtk.VTK_DOUBLE]
+      and scalarRange[1]-scalarRange[0] < INTENSITY_BIN_COUNT):
+      # one bin per intensity value
+      edges = numpy.arange(scalarRange[0], scalarRange[1]+1) + 0.5
+    else:
+      # bins with equal number of voxels, which keeps the details of images with
+      # large or floating-point intensity range (such as 16-bit microscopy or MR maps)
+      scalars = numpy_support.vtk_to_numpy(sourceImageData.GetPointData().GetScalars())
+      step = max(1, scalars.size // INTENSITY_BINNING_SAMPLE_SIZE)
+      percentiles = numpy.linspace(0, 100, INTENSITY_BIN_COUNT+1)[1:-1]
+      edges = numpy.unique(numpy.nanpercentile(scalars[::step], percentiles))
+    return numpy_support.numpy_to_vtk(edges.astype(numpy.float64), deep=True)
+
+  def shrinkPreparedInputCache(self):
+    """Remove least recently used inputs if the cache is too large (the current input is always kept)"""
+    def memorySizeKB(cachedInput):
+      return cachedInput[0].GetActualMemorySize() + cachedInput[1].GetActualMemorySize()
+    while (len(self.preparedInputCache) > 1
+      and sum([memorySizeKB(cachedInput) for cachedInput in self.preparedInputCache.values()]) > PREPARED_INPUT_CACHE_SIZE_MB*1024):
+      self.preparedInputCache.popitem(last=False)
+
+  def extendStatisticsImage(self, statisticsImage, extent):
+    """Make the statistics image of a prepared input cover extent, so that it is only allocated
+    for the marched regions and not for the whole source image. Values computed so far are kept.
+    """
+    currentExtent = statisticsImage.GetExtent()
+    isEmpty = currentExtent[0] > currentExtent[1] or currentExtent[2] > currentExtent[3] or currentExtent[4] > currentExtent[5]
+    if not isEmpty and all(currentExtent[axis*2] <= extent[axis*2] and extent[axis*2+1] <= currentExtent[axis*2+1] for axis in range(3)):
+      return
+
+    import numpy
+    from vtk.util import numpy_support
+    newExtent = list(extent)
+    if not isEmpty:
+      for axis in range(3):
+        newExtent[axis*2] = min(newExtent[axis*2], currentExtent[axis*2])
+        newExtent[axis*2+1] = max(newExtent[axis*2+1], currentExtent[axis*2+1])
+    extendedImage = vtk.vtkImageData()
+    extendedImage.SetExtent(newExtent)
+    extendedImage.AllocateScalars(vtk.VTK_SHORT, 2)
+    extendedImage.GetPointData().GetScalars().FillComponent(0, 0)
+    extendedImage.GetPointData().GetScalars().FillComponent(1, -1)
+
+    if not isEmpty:
+      # numpy array axes are in k, j, i, component order
+      def statisticsArray(image, imageExtent):
+        dims = [imageExtent[axis*2+1] - imageExtent[axis*2] + 1 for axis in range(3)]
+        return numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(dims[2], dims[1], dims[0], 2)
+      offset = [currentExtent[axis*2] - newExtent[axis*2] for axis in range(3)]
+      currentArray = statisticsArray(statisticsImage, currentExtent)
+      statisticsArray(extendedImage, newExtent)[
+        offset[2]:offset[2]+currentArray.shape[0],
+        offset[1]:offset[1]+currentArray.shape[1],
+        offset[0]:offset[0]+currentArray.shape[2]] = currentArray
+
+    # the cached object is updated in place
+    statisticsImage.ShallowCopy(extendedImage)
+    self.shrinkPreparedInputCache()
+
+  def coarseMarching(self, preparedInput, seedLabelmap, npoints, factor, editMask=None):
+    """Grow the segments on the source and seed images downsampled by factor.
+    Coarse voxels are masked if all their voxels are masked in editMask (if specified).
+    Returns the seed labelmap for marching at full resolution, which contains the original seeds and the inside
+    of the coarse segments (farther than the band width from their boundary), and its number of seed voxels.
+    Returns None if there are no seeds. Yields while the filter is running in the background.
+    """
+    import numpy
+    from vtk.util import numpy_support
+    import vtkSegmentationCorePython as vtkSegmentationCore
+    sourceImageData, intensityBinEdges, statisticsImage = preparedInput
+    sourceExtent = sourceImageData.GetExtent()
+
+    # Seeds in the extent of the source image
+    seedPad = vtk.vtkImageConstantPad()
+    seedPad.SetInputData(seedLabelmap)
+    seedPad.SetOutputWholeExtent(sourceExtent)
+    seedPad.SetConstant(0)
+    seedPad.Update()
+    fineSeeds = seedPad.GetOutput()
+
+    # Intensities are averaged, a coarse voxel is a seed if any of its voxels is a seed
+    sourceShrink = vtk.vtkImageShrink3D()
+    sourceShrink.SetInputData(sourceImageData)
+    sourceShrink.SetShrinkFactors(factor, factor, factor)
+    sourceShrink.AveragingOn()
+    sourceShrink.Update()
+    seedShrink = vtk.vtkImageShrink3D()
+    seedShrink.SetInputData(fineSeeds)
+    seedShrink.SetShrinkFactors(factor, factor, factor)
+    seedShrink.MaximumOn()
+    seedShrink.Update()
+
+    coarseMask = None
+    if editMask:
+      maskShrink = vtk.vtkImageShrink3D()
+      maskShrink.SetInputData(editMask)
+      maskShrink.SetShrinkFactors(factor, factor, factor)
+      maskShrink.MinimumOn()
+      maskShrink.Update()
+      coarseMask = maskShrink.GetOutput()
+
+    # Statistics computed on the coarse image cannot be reused at full resolution
+    coarseSource = sourceShrink.GetOutput()
+    nSeeds = yield from self.fastMarchingInExtent((coarseSource, intensityBinEdges, None), seedShrink.GetOutput(),
+      list(coarseSource.GetExtent()), npoints // factor**3, livePreview=False, maskImage=coarseMask, copySource=False)
+    if nSeeds == 0:
+      return None
+    coarseLabels = self.fm.GetOutput()
+
+    # Inside of the coarse segments: voxels that only have voxels of the same segment within the band width
+    kernelSize = 2 * self.scriptedEffect.integerParameter("CoarseToFineBandWidth") + 1
+    erode = vtk.vtkImageContinuousErode3D()
+    erode.SetInputData(coarseLabels)
+    erode.SetKernelSize(kernelSize, kernelSize, kernelSize)
+    erode.Update()
+    dilate = vtk.vtkImageContinuousDilate3D()
+    dilate.SetInputData(coarseLabels)
+    dilate.SetKernelSize(kernelSize, kernelSize, kernelSize)
+    dilate.Update()
+    erodedLabels = numpy_support.vtk_to_numpy(erode.GetOutput().GetPointData().GetScalars())
+    dilatedLabels = numpy_support.vtk_to_numpy(dilate.GetOutput().GetPointData().GetScalars())
+    coarseInside = vtk.vtkImageData()
+    coarseInside.CopyStructure(coarseLabels)
+    coarseInside.AllocateScalars(vtk.VTK_SHORT, 1)
+    numpy_support.vtk_to_numpy(coarseInside.GetPointData().GetScalars())[:] = numpy.where(
+      erodedLabels == dilatedLabels, erodedLabels, 0)
+
+    # vtkImageShrink3D keeps the origin, which would place each coarse voxel on the first voxel
+    # of its bin and shift the upsampled segments by half a coarse voxel. Coarse voxels are
+    # placed at the center of their bin instead.
+    sourceOrigin = sourceImageData.GetOrigin()
+    sourceSpacing = sourceImageData.GetSpacing()
+    coarseInside.SetOrigin([sourceOrigin[axis] + (factor-1)/2.*sourceSpacing[axis] for axis in range(3)])
+    coarseInside.SetSpacing([sourceSpacing[axis]*factor for axis in range(3)])
+
+    upsample = vtk.vtkImageReslice()
+    upsample.SetInputData(coarseInside)
+    upsample.SetOutputOrigin(sourceImageData.GetOrigin())
+    upsample.SetOutputSpacing(sourceImageData.GetSpacing())
+    upsample.SetOutputExtent(sourceExtent)
+    upsample.SetInterpolationModeToNearestNeighbor()
+    upsample.Update()
+
+    # Original seeds are kept as they are
+    refinedSeeds = vtkSegmentationCore.vtkOrientedImageData()
+    refinedSeeds.CopyStructure(fineSeeds)
+    refinedSeeds.AllocateScalars(vtk.VTK_SHORT, 1)
+    seedLabels = numpy_support.vtk_to_numpy(fineSeeds.GetPointData().GetScalars())
+    insideLabels = numpy_support.vtk_to_numpy(upsample.GetOutput().GetPointData().GetScalars())
+    refinedLabels = numpy_support.vtk_to_numpy(refinedSeeds.GetPointData().GetScalars())
+    refinedLabels[:] = numpy.where(seedLabels != 0, seedLabels, insideLabels)
+    if editMask:
+      # the inside of coarse voxels that are partially masked
+      refinedLabels[numpy_support.vtk_to_numpy(editMask.GetPointData().GetScalars()) != 0] = 0
+    return (refinedSeeds, int(numpy.count_nonzero(refinedLabels)))
+
+  def fastMarchingInExtent(self, preparedInput, seedLabelmap, extent, npoints, livePreview=True, maskImage=None,
+    copySource=True):
+    """Run fast marching from the seeds in the seed labelmap, only within the specified extent.
+    The front is grown by npoints voxels. The segment is updated while the front is growing
+    only if livePreview is enabled (and the LivePreview parameter is set).
+    The front does not go into voxels where maskImage (if specified) is non-zero.
+    The filter runs on a copy of the source image, so that the source volume can be modified meanwhile,
+    unless copySource is False (the source image is only used by the filter) or the image is cropped.
+    Returns the number of seeds. Yields while the filter is running in the background.
+    """
+
+    self.fm = None
+    sourceImageData, intensityBinEdges, statisticsImage = preparedInput
+    sourceDim = sourceImageData.GetDimensions()
+    statisticsUpdateRate = max(1, int(sourceDim[0]*sourceDim[1]*sourceDim[2]*STATISTICS_UPDATE_FRACTION))
+
+    # Crop source and seed image. Extent of the cropped images does not start at 0,
+    # which is handled by the filter.
+    if list(sourceImageData.GetExtent()) != extent:
+      sourceClip = vtk.vtkImageClip()
+      sourceClip.SetInputData(sourceImageData)
+      sourceClip.SetOutputWholeExtent(extent)
+      sourceClip.ClipDataOn()
+      sourceClip.Update()
+      sourceImageData = sourceClip.GetOutput()
+      # the cropped image is only used by the filter, it does not need to be copied
+      copySource = False
+
+    if list(seedLabelmap.GetExtent()) != extent:
+      labelClip = vtk.vtkImageClip()
+      labelClip.SetInputData(seedLabelmap)
+      labelClip.SetOutputWholeExtent(extent)
+      labelClip.ClipDataOn()
+      labelClip.Update()
+      seedLabelmap = labelClip.GetOutput()
+
     labelValue = 1
-    backgroundValue = 0
-    thresh = vtk.vtkImageThreshold()
-    thresh.SetInputData(selectedSegmentLabelmap)
-    thresh.ThresholdByLower(0)
-    thresh.SetInValue(backgroundValue)
-    thresh.SetOutValue(labelValue)
-    thresh.SetOutputScalarType(vtk.VTK_UNSIGNED_SHORT)
-    thresh.Update()
-    labelImage = thresh.GetOutput()
+    multiLabel = len(self.segmentIds) > 1
+    if multiLabel:
+      # merged labelmap already contains the label value of each segment
+      labelImage = seedLabelmap
+    else:
+      # We need to know exactly the value of the segment voxels, apply threshold to make force the selected label value
+      backgroundValue = 0
+      thresh = vtk.vtkImageThreshold()
+      thresh.SetInputData(seedLabelmap)
+      thresh.ThresholdByLower(0)
+      thresh.SetInValue(backgroundValue)
+      thresh.SetOutValue(labelValue)
+      thresh.SetOutputScalarType(vtk.VTK_UNSIGNED_SHORT)
+      thresh.Update()
+      labelImage = thresh.GetOutput()
 
     # collect seeds
     dim = sourceImageData.GetDimensions()
     # initialize the filter
     import vtkSlicerSegmentEditorFastMarchingModuleLogicPython
     self.fm = vtkSlicerSegmentEditorFastMarchingModuleLogicPython.vtkPichonFastMarching()
-    scalarRange = sourceImageData.GetScalarRange()
-    depth = scalarRange[1]-scalarRange[0]
-
-    # this is more or less arbitrary; large depth values will bring the
-    # algorithm to the knees
-    scaleValue = 0
-    shiftValue = 0
-
-    if depth>300:
-      scaleValue = 300./depth
-    if scalarRange[0] < 0:
-      shiftValue = scalarRange[0]*-1
-
-    if scaleValue or shiftValue:
-      rescale = vtk.vtkImageShiftScale()
-      rescale.SetInputData(sourceImageData)
-      rescale.SetScale(scaleValue)
-      rescale.SetShift(shiftValue)
-      rescale.Update()
-      sourceImageData = rescale.GetOutput()
-      scalarRange = sourceImageData.GetScalarRange()
-      depth = scalarRange[1]-scalarRange[0]
-
-    self.fm.init(dim[0], dim[1], dim[2], depth, 1, 1, 1)
-
-    caster = vtk.vtkImageCast()
-    caster.SetOutputScalarTypeToShort()
-    caster.SetInputData(sourceImageData)
-    self.fm.SetInputConnection(caster.GetOutputPort())
+    if self.scriptedEffect.integerParameter("BucketQueue") != 0:
+      self.fm.setPriorityQueueType(self.fm.PriorityQueueBucket)
+    self.fm.setMultiLabel(multiLabel)
 
-    # self.fm.SetOutput(labelImage)
+    # intensity bins are numbered from 0 to the number of edges
+    self.fm.init(dim[0], dim[1], dim[2], intensityBinEdges.GetNumberOfTuples(), 1, 1, 1)
 
-    npoints = int(dim[0]*dim[1]*dim[2]*percentMax/100.)
+    # source image is read directly, intensities are binned by the filter
+    self.fm.setIntensityBinEdges(intensityBinEdges)
+    self.fm.SetInputData(sourceImageData)
+    self.fm.setCopyInput(copySource)
+    if statisticsImage is not None:
+      self.extendStatisticsImage(statisticsImage, extent)
+    self.fm.setStatisticsImage(statisticsImage)
+    self.fm.setMaskImage(maskImage)
+
+    # self.fm.SetOutput(labelImage)
 
     self.fm.setNPointsEvolution(npoints)
+    self.fm.setStatisticsUpdateRate(statisticsUpdateRate)
+    self.fm.setPreviewInterval(self.getPreviewInterval(npoints) if livePreview else 0)
+    self.fm.setLeakDetectionRatio(self.getLeakDetectionRatio())
     self.fm.setActiveLabel(labelValue)
 
-    spacing = self.originalSelectedSegmentLabelmap.GetSpacing()
-    self.voxelVolume = spacing[0] * spacing[1] * spacing[2]
-    self.totalNumberOfVoxels = npoints
-
     nSeeds = self.fm.addSeedsFromImage(labelImage)
     if nSeeds == 0:
-      self.totalNumberOfVoxels = 0
-      return
+      return 0
 
-    self.fm.Modified()
-    self.fm.Update()
+    yield from self.updateFilterInBackground()
 
     # Need to call show() twice for data to be updated.
     # There are many other issues with the vtkPichonFastMarching filter
-    # (expects extents to start at 0, crashes in debug mode, etc).
+    # (crashes in debug mode, etc).
     self.fm.show(1)
-    self.fm.Modified()
-    self.fm.Update()
+    yield from self.updateFilterInBackground()
 
-    self.updateLabel(self.marcher.value/self.marcher.maximum)
+    return nSeeds
 
-    logging.info('FastMarching march update completed')
+  def isFrontAtRegionBoundary(self, extent, sourceExtent):
+    """Returns True if the front reached a side of the extent that is not a side of the source volume"""
+    knownPointsExtent = [0, -1, 0, -1, 0, -1]
+    self.fm.getKnownPointsExtent(knownPointsExtent)
+    for axis in range(3):
+      if extent[axis*2] > sourceExtent[axis*2] and knownPointsExtent[axis*2] <= extent[axis*2] + FRONT_BOUNDARY_MARGIN:
+        return True
+      if extent[axis*2+1] < sourceExtent[axis*2+1] and knownPointsExtent[axis*2+1] >= extent[axis*2+1] - FRONT_BOUNDARY_MARGIN:
+        return True
+    return False
 
-  def updateLabel(self,value):
+  def updateLabel(self,value=None,modifiedExtentOnly=False):
+    """Update the segment from the front. If value is not specified then the current output
+    of the filter is used as is (or the last preview, while the filter is running in the background).
+    If modifiedExtentOnly is True then only the region changed by this value is written to the segment,
+    which is much faster for small changes, but requires that the segment was up to date before.
+    """
     if not self.fm:
+      if self.storedArrivalRank is not None and value is not None:
+        self.updateLabelFromStoredArrivalRank(value)
       return
 
-    self.fm.show(value)
-    self.fm.Modified()
-    self.fm.Update()
+    if value is not None:
+      self.fm.show(value)
+      self.fm.Modified()
+      self.fm.Update()
+
+    if value is None and self.fm.isBackgroundUpdateRunning():
+      # the output must not be accessed while the filter is running
+      outputLabelmap = vtk.vtkImageData()
+      self.fm.getPreviewImage(outputLabelmap)
+    else:
+      outputLabelmap = self.fm.GetOutput()
+    if value is not None and modifiedExtentOnly:
+      modifiedExtent = [0, -1, 0, -1, 0, -1]
+      self.fm.getShowModifiedExtent(modifiedExtent)
+      if modifiedExtent[0] > modifiedExtent[1]:
+        # no voxels changed
+        return
+      clip = vtk.vtkImageClip()
+      clip.SetInputData(outputLabelmap)
+      clip.SetOutputWholeExtent(modifiedExtent)
+      clip.ClipDataOn()
+      clip.Update()
+      outputLabelmap = clip.GetOutput()
 
     import vtkSegmentationCorePython as vtkSegmentationCore
     newSegmentLabelmap = vtkSegmentationCore.vtkOrientedImageData()
-    newSegmentLabelmap.ShallowCopy(self.fm.GetOutput())
+    newSegmentLabelmap.ShallowCopy(outputLabelmap)
     newSegmentLabelmap.CopyDirections(self.originalSelectedSegmentLabelmap)
 
     segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
-    slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(newSegmentLabelmap, segmentationNode, self.selectedSegmentId, slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, newSegmentLabelmap.GetExtent())
+    if len(self.segmentIds) <= 1:
+      slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(newSegmentLabelmap, segmentationNode, self.selectedSegmentId, slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, newSegmentLabelmap.GetExtent())
+      return
 
-  def reset(self):
+    # Each front is written to its own segment
+    thresh = vtk.vtkImageThreshold()
+    thresh.SetInputData(newSegmentLabelmap)
+    thresh.SetInValue(1)
+    thresh.SetOutValue(0)
+    thresh.SetOutputScalarType(vtk.VTK_UNSIGNED_CHAR)
+    for labelValue, segmentId in enumerate(self.segmentIds, 1):
+      thresh.ThresholdBetween(labelValue, labelValue)
+      thresh.Update()
+      segmentLabelmap = vtkSegmentationCore.vtkOrientedImageData()
+      segmentLabelmap.ShallowCopy(thresh.GetOutput())
+      segmentLabelmap.CopyDirections(newSegmentLabelmap)
+      slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(segmentLabelmap, segmentationNode, segmentId, slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, segmentLabelmap.GetExtent())
 
-    # If original segment is available then restore that
-    if self.originalSelectedSegmentLabelmap:
-      import vtkSegmentationCorePython as vtkSegmentationCore
-      segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
-      slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(self.originalSelectedSegmentLabelmap, segmentationNode, self.selectedSegmentId, slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, self.originalSelectedSegmentLabelmap.GetExtent())
+  def onExportArrivalMap(self):
+    if not self.fm:
+      return
+    arrivalMapType = self.scriptedEffect.parameter("ArrivalMapType")
+    self.exportArrivalMap(arrivalMapType)
+
+  def exportArrivalMap(self, arrivalMapType=ARRIVAL_MAP_RANK):
+    """Export arrival rank or time of the current front to a new scalar volume node"""
+    import vtkSegmentationCorePython as vtkSegmentationCore
+    arrivalMap = vtkSegmentationCore.vtkOrientedImageData()
+    if arrivalMapType == ARRIVAL_MAP_TIME:
+      self.fm.getArrivalTimeImage(arrivalMap)
+    else:
+      self.fm.getArrivalRankImage(arrivalMap)
+    arrivalMap.CopyDirections(self.originalSelectedSegmentLabelmap)
+
+    segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
+    segmentName = segmentationNode.GetSegmentation().GetSegment(self.selectedSegmentId).GetName()
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode",
+      slicer.mrmlScene.GenerateUniqueName(segmentName + " " + arrivalMapType.lower()))
+    slicer.vtkSlicerSegmentationsModuleLogic.CopyOrientedImageDataToVolumeNode(arrivalMap, volumeNode)
+    volumeNode.SetAndObserveTransformNodeID(segmentationNode.GetTransformNodeID())
+    volumeNode.CreateDefaultDisplayNodes()
+    logging.info('FastMarching arrival map exported to {0}'.format(volumeNode.GetName()))
+    return volumeNode
+
+  def storeArrivalRank(self):
+    """Store arrival rank of the complete front in a hidden volume node for each grown segment,
+    so that the segment volume can be adjusted later without marching again. The volume only
+    covers the voxels reached by the front of the segment."""
+    import vtkSegmentationCorePython as vtkSegmentationCore
+    from vtk.util import numpy_support
+    import numpy as np
 
+    # Labels of all the points of the front, not just the currently displayed part
+    self.fm.show(1)
+    self.fm.Modified()
+    self.fm.Update()
+    labels = numpy_support.vtk_to_numpy(self.fm.GetOutput().GetPointData().GetScalars())
+    arrivalRank = vtkSegmentationCore.vtkOrientedImageData()
+    self.fm.getArrivalRankImage(arrivalRank)
+    arrivalRank.CopyDirections(self.originalSelectedSegmentLabelmap)
+    rankExtent = arrivalRank.GetExtent()
+    rankShape = [rankExtent[axis*2+1] - rankExtent[axis*2] + 1 for axis in reversed(range(3))]
+    ranks = numpy_support.vtk_to_numpy(arrivalRank.GetPointData().GetScalars()).reshape(rankShape)
+    labels = labels.reshape(rankShape)
+    # 32-bit ranks are enough unless the front reached more than 2^32 voxels
+    if self.fm.nKnownPoints() < 2**32:
+      rankScalarType, rankDtype = vtk.VTK_UNSIGNED_INT, np.uint32
+    else:
+      rankScalarType, rankDtype = arrivalRank.GetScalarType(), ranks.dtype
+
+    parameterSetNode = self.scriptedEffect.parameterSetNode()
+    segmentationNode = parameterSetNode.GetSegmentationNode()
+    sourceVolumeNode = parameterSetNode.GetSourceVolumeNode()
+    for labelValue, segmentId in enumerate(self.segmentIds, 1):
+      segment = segmentationNode.GetSegmentation().GetSegment(segmentId)
+      if not segment:
+        continue
+      reachedIndices = np.nonzero(labels == labelValue)
+      if len(reachedIndices[0]) == 0:
+        continue
+      # bounding box of the voxels reached by the front of the segment, in k, j, i order
+      boxSlices = tuple(slice(indices.min(), indices.max() + 1) for indices in reachedIndices)
+      segmentExtent = []
+      for axis in range(3):
+        boxSlice = boxSlices[2-axis]
+        segmentExtent += [int(rankExtent[axis*2] + boxSlice.start), int(rankExtent[axis*2] + boxSlice.stop - 1)]
+      segmentArrivalRank = vtkSegmentationCore.vtkOrientedImageData()
+      segmentArrivalRank.SetExtent(segmentExtent)
+      segmentArrivalRank.AllocateScalars(rankScalarType, 1)
+      segmentArrivalRank.CopyDirections(arrivalRank)
+      # seeds are always included
+      segmentRanks = numpy_support.vtk_to_numpy(segmentArrivalRank.GetPointData().GetScalars())
+      segmentRanks[:] = np.where(labels[boxSlices] == labelValue, np.maximum(ranks[boxSlices], 1), 0).astype(rankDtype).ravel()
+
+      role = ARRIVAL_RANK_REFERENCE_ROLE + segmentId
+      volumeNode = segmentationNode.GetNodeReference(role)
+      if not volumeNode:
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode",
+          slicer.mrmlScene.GenerateUniqueName(segment.GetName() + " arrival rank"))
+        volumeNode.SetHideFromEditors(True)
+        segmentationNode.SetNodeReferenceID(role, volumeNode.GetID())
+      slicer.vtkSlicerSegmentationsModuleLogic.CopyOrientedImageDataToVolumeNode(segmentArrivalRank, volumeNode)
+      volumeNode.SetAndObserveTransformNodeID(segmentationNode.GetTransformNodeID())
+      volumeNode.SetAttribute("FastMarching.SegmentID", segmentId)
+      volumeNode.SetAttribute("FastMarching.SourceVolumeID", sourceVolumeNode.GetID() if sourceVolumeNode else "")
+      volumeNode.SetAttribute("FastMarching.NumberOfPoints", str(self.fm.nKnownPoints()))
+      volumeNode.SetAttribute("FastMarching.SegmentVolume", str(self.marcher.value/self.marcher.maximum))
+
+  def restoreArrivalRank(self):
+    """Restore the arrival rank stored for the selected segment, if it was grown in the current source volume
+    and the segment was not modified since the arrival rank was stored"""
+    parameterSetNode = self.scriptedEffect.parameterSetNode()
+    if not parameterSetNode:
+      return
+    segmentationNode = parameterSetNode.GetSegmentationNode()
+    sourceVolumeNode = parameterSetNode.GetSourceVolumeNode()
+    selectedSegmentId = parameterSetNode.GetSelectedSegmentID()
+    if not segmentationNode or not sourceVolumeNode or not selectedSegmentId:
+      return
+    volumeNode = segmentationNode.GetNodeReference(ARRIVAL_RANK_REFERENCE_ROLE + selectedSegmentId)
+    if not volumeNode or not volumeNode.GetImageData():
+      return
+    if (volumeNode.GetAttribute("FastMarching.SourceVolumeID") != sourceVolumeNode.GetID()
+      or volumeNode.GetTransformNodeID() != segmentationNode.GetTransformNodeID()):
+      return
+
+    # The volume is in the same coordinate system as the segmentation
+    import vtkSegmentationCorePython as vtkSegmentationCore
+    arrivalRank = vtkSegmentationCore.vtkOrientedImageData()
+    arrivalRank.ShallowCopy(volumeNode.GetImageData())
+    ijkToRas = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRas)
+    arrivalRank.SetImageToWorldMatrix(ijkToRas)
+    numberOfPoints = int(volumeNode.GetAttribute("FastMarching.NumberOfPoints") or 0)
+    segmentVolume = float(volumeNode.GetAttribute("FastMarching.SegmentVolume") or 1)
+    if self.isSegmentModifiedSinceArrivalRankStored(selectedSegmentId, arrivalRank, numberOfPoints, segmentVolume):
+      logging.info('FastMarching arrival rank {0} not restored, the segment was modified since'.format(volumeNode.GetName()))
+      return
+    self.storedArrivalRank = arrivalRank
+    self.storedNumberOfPoints = numberOfPoints
+    self.selectedSegmentId = selectedSegmentId
+
+    wasBlocked = self.marcher.blockSignals(True)
+    self.marcher.value = segmentVolume * self.marcher.maximum
+    self.marcher.blockSignals(wasBlocked)
+    self.updateGUIFromMRML()
+    logging.info('FastMarching arrival rank restored from {0}'.format(volumeNode.GetName()))
+
+  def isSegmentModifiedSinceArrivalRankStored(self, segmentId, arrivalRank, numberOfPoints, segmentVolume):
+    """Returns True if the segment is not the part of the front that was applied (the points
+    with the lowest arrival rank, up to the segment volume), for example because it was edited since."""
+    import vtkSegmentationCorePython as vtkSegmentationCore
+    from vtk.util import numpy_support
+    import numpy as np
+    segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
+    segmentLabelmap = vtkSegmentationCore.vtkOrientedImageData()
+    segmentationNode.GetBinaryLabelmapRepresentation(segmentId, segmentLabelmap)
+    segmentScalars = segmentLabelmap.GetPointData().GetScalars()
+    numberOfSegmentVoxels = np.count_nonzero(numpy_support.vtk_to_numpy(segmentScalars)) if segmentScalars else 0
+    ranks = numpy_support.vtk_to_numpy(arrivalRank.GetPointData().GetScalars())
+    appliedVoxels = (ranks >= 1) & (ranks <= int((numberOfPoints-1)*segmentVolume) + 1)
+    if numberOfSegmentVoxels != np.count_nonzero(appliedVoxels):
+      return True
+    if numberOfSegmentVoxels == 0:
+      return False
+    # same number of voxels, they must be at the same positions as well
+    resampledLabelmap = vtkSegmentationCore.vtkOrientedImageData()
+    vtkSegmentationCore.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(
+      segmentLabelmap, arrivalRank, resampledLabelmap)
+    resampledVoxels = numpy_support.vtk_to_numpy(resampledLabelmap.GetPointData().GetScalars()) != 0
+    return not np.array_equal(resampledVoxels, appliedVoxels)
+
+  def removeUnusedArrivalRanks(self):
+    """Remove the arrival rank volumes of the segments that were removed from the segmentation"""
+    parameterSetNode = self.scriptedEffect.parameterSetNode()
+    segmentationNode = parameterSetNode.GetSegmentationNode() if parameterSetNode else None
+    if not segmentationNode:
+      return
+    for volumeNode in slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode"):
+      segmentId = volumeNode.GetAttribute("FastMarching.SegmentID")
+      if segmentId is None or segmentationNode.GetSegmentation().GetSegment(segmentId):
+        continue
+      role = ARRIVAL_RANK_REFERENCE_ROLE + segmentId
+      if segmentationNode.GetNodeReferenceID(role) != volumeNode.GetID():
+        # arrival rank of another segmentation
+        continue
+      logging.info('FastMarching arrival rank {0} removed, its segment does not exist anymore'.format(volumeNode.GetName()))
+      segmentationNode.RemoveNodeReferenceIDs(role)
+      slicer.mrmlScene.RemoveNode(volumeNode)
+
+  def updateLabelFromStoredArrivalRank(self, value):
+    """Update the selected segment from the restored arrival rank, same as the filter would show it"""
+    import vtkSegmentationCorePython as vtkSegmentationCore
+    segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
+    if not self.originalSelectedSegmentLabelmap:
+      # first change, keep the current segment so that it can be restored on Cancel
+      self.scriptedEffect.saveStateForUndo()
+      segmentationNode.GetSegmentation().SeparateSegmentLabelmap(self.selectedSegmentId)
+      self.originalSelectedSegmentLabelmap = vtkSegmentationCore.vtkOrientedImageData()
+      segmentationNode.GetBinaryLabelmapRepresentation(self.selectedSegmentId, self.originalSelectedSegmentLabelmap)
+
+    thresh = vtk.vtkImageThreshold()
+    thresh.SetInputData(self.storedArrivalRank)
+    thresh.ThresholdBetween(1, int((self.storedNumberOfPoints-1)*value) + 1)
+    thresh.SetInValue(1)
+    thresh.SetOutValue(0)
+    thresh.SetOutputScalarType(vtk.VTK_UNSIGNED_CHAR)
+    thresh.Update()
+    segmentLabelmap = vtkSegmentationCore.vtkOrientedImageData()
+    segmentLabelmap.ShallowCopy(thresh.GetOutput())
+    segmentLabelmap.CopyDirections(self.storedArrivalRank)
+    slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(segmentLabelmap, segmentationNode, self.selectedSegmentId, slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, segmentLabelmap.GetExtent())
+
+  def getSession(self):
+    """Returns the state of the current marching session"""
+    return {
+      "fm": self.fm,
+      "fmInputs": self.fmInputs,
+      "originalSelectedSegmentLabelmap": self.originalSelectedSegmentLabelmap,
+      "selectedSegmentId": self.selectedSegmentId,
+      "segmentIds": self.segmentIds,
+      "originalOtherSegmentLabelmaps": self.originalOtherSegmentLabelmaps,
+      "marchingExtent": self.marchingExtent,
+      "marchingBoundsExtent": self.marchingBoundsExtent,
+      "totalNumberOfVoxels": self.totalNumberOfVoxels,
+      "numberOfSeedPoints": self.numberOfSeedPoints,
+      "voxelVolume": self.voxelVolume,
+      "storedArrivalRank": self.storedArrivalRank,
+      "storedNumberOfPoints": self.storedNumberOfPoints,
+      "segmentVolume": self.marcher.value,
+      }
+
+  def setSession(self, session):
+    """Continue a marching session returned by getSession"""
+    self.fm = session["fm"]
+    self.fmInputs = session["fmInputs"]
+    self.originalSelectedSegmentLabelmap = session["originalSelectedSegmentLabelmap"]
+    self.selectedSegmentId = session["selectedSegmentId"]
+    self.segmentIds = session["segmentIds"]
+    self.originalOtherSegmentLabelmaps = session["originalOtherSegmentLabelmaps"]
+    self.marchingExtent = session["marchingExtent"]
+    self.marchingBoundsExtent = session["marchingBoundsExtent"]
+    self.totalNumberOfVoxels = session["totalNumberOfVoxels"]
+    self.numberOfSeedPoints = session["numberOfSeedPoints"]
+    self.voxelVolume = session["voxelVolume"]
+    self.storedArrivalRank = session["storedArrivalRank"]
+    self.storedNumberOfPoints = session["storedNumberOfPoints"]
+    wasBlocked = self.marcher.blockSignals(True)
+    self.marcher.value = session["segmentVolume"]
+    self.marcher.blockSignals(wasBlocked)
+
+  def clearSession(self):
+    """Forget the current marching session, without changing the segments"""
     self.originalSelectedSegmentLabelmap = None
     self.selectedSegmentId = None
+    self.segmentIds = []
+    self.originalOtherSegmentLabelmaps = {}
     self.fm = None
+    self.fmInputs = None
+    self.marchingExtent = None
+    self.marchingBoundsExtent = None
+    self.storedArrivalRank = None
+    self.storedNumberOfPoints = 0
+
+  def switchSession(self):
+    """If another segment is selected then keep the marching session of the previously selected segment
+    in the session cache and continue the session of the newly selected segment, if there is one.
+    The segments shown by the kept session are not changed.
+    """
+    parameterSetNode = self.scriptedEffect.parameterSetNode()
+    if not parameterSetNode or self.marchingTask:
+      # the segment that is being grown cannot be switched
+      return
+    selectedSegmentId = parameterSetNode.GetSelectedSegmentID()
+    if selectedSegmentId == self.sessionSelectedSegmentId:
+      return
+    self.sessionSelectedSegmentId = selectedSegmentId
+    hasSession = self.fm is not None or self.storedArrivalRank is not None
+    if hasSession and self.selectedSegmentId == selectedSegmentId:
+      return
+
+    sourceImageData = self.scriptedEffect.sourceVolumeImageData()
+    sourceImageMTime = sourceImageData.GetMTime() if sourceImageData else 0
+    if hasSession:
+      # a front can only be continued in the source image that it was grown in
+      sessionKey = (self.selectedSegmentId, self.fmInputs[1] if self.fmInputs else sourceImageMTime)
+      self.sessionCache[sessionKey] = self.getSession()
+      self.clearSession()
+
+    # Remove least recently used sessions if the cache is too large.
+    # The segments keep the result that is currently shown.
+    while (len(self.sessionCache) > 0
+      and sum([self.getSessionMemorySizeKB(session) for session in self.sessionCache.values()]) > MARCHING_SESSION_CACHE_SIZE_MB*1024):
+      evictedSegmentId = self.sessionCache.popitem(last=False)[0][0]
+      logging.info('FastMarching session of segment {0} removed from the cache'.format(evictedSegmentId))
+
+    sessionKey = (selectedSegmentId, sourceImageMTime)
+    if sessionKey in self.sessionCache:
+      # the continued session changes the segment, the current state must be restorable by undo
+      self.scriptedEffect.saveStateForUndo()
+      self.setSession(self.sessionCache.pop(sessionKey))
+      logging.info('FastMarching session of segment {0} continued'.format(selectedSegmentId))
+    else:
+      self.restoreArrivalRank()
+
+  def getSessionMemorySizeKB(self, session):
+    """Memory used by a marching session returned by getSession, in kilobytes"""
+    sizeKB = 0
+    if session["fm"]:
+      # per-voxel arrays of the filter are allocated for the processed region, which is the extent of its output
+      output = session["fm"].GetOutput()
+      dim = output.GetDimensions()
+      sizeKB += dim[0]*dim[1]*dim[2] * session["fm"].memoryBytesPerVoxel() / 1024 + output.GetActualMemorySize()
+    originalLabelmaps = [session["originalSelectedSegmentLabelmap"]] + list(session["originalOtherSegmentLabelmaps"].values())
+    sizeKB += sum([labelmap.GetActualMemorySize() for labelmap in originalLabelmaps if labelmap])
+    return sizeKB
+
+  def reset(self):
+    self.restoreOriginalSegments(self.getSession())
+    self.clearSession()
 
     self.updateGUIFromMRML()
 
+  def restoreOriginalSegments(self, session):
+    """Restore the segments that were changed by a marching session returned by getSession"""
+
+    # If original segment is available then restore that
+    segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
+    originalSelectedSegmentLabelmap = session["originalSelectedSegmentLabelmap"]
+    if originalSelectedSegmentLabelmap and segmentationNode.GetSegmentation().GetSegment(session["selectedSegmentId"]):
+      slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(originalSelectedSegmentLabelmap, segmentationNode, session["selectedSegmentId"], slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, originalSelectedSegmentLabelmap.GetExtent())
+
+    # Restore the other segments that were grown at the same time
+    for segmentId, originalLabelmap in session["originalOtherSegmentLabelmaps"].items():
+      if segmentationNode.GetSegmentation().GetSegment(segmentId):
+        slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(originalLabelmap, segmentationNode, segmentId, slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, originalLabelmap.GetExtent())
+
+  def resetCachedSessions(self):
+    """Restore the segments previewed by the cached sessions and forget the sessions"""
+    parameterSetNode = self.scriptedEffect.parameterSetNode()
+    if parameterSetNode and parameterSetNode.GetSegmentationNode():
+      for session in self.sessionCache.values():
+        self.restoreOriginalSegments(session)
+    self.sessionCache.clear()
+
   def onCancel(self):
+    self.cancelMarching()
     self.reset()
+    self.resetCachedSessions()
 
   def onApply(self):
     # Apply changes
@@ -272,7 +1391,16 @@ The effect uses <a href="http://www.spl.harvard.edu/publications/item/view/193">
     modifierLabelmap = vtkSegmentationCore.vtkOrientedImageData()
     segmentationNode.GetBinaryLabelmapRepresentation(self.selectedSegmentId, modifierLabelmap)
     self.scriptedEffect.modifySelectedSegmentByLabelmap(modifierLabelmap, slicer.qSlicerSegmentEditorAbstractEffect.ModificationModeSet)
+    # Keep the arrival order so that the segment volume can be adjusted when the effect is selected again
+    if self.fm:
+      self.storeArrivalRank()
+    elif self.storedArrivalRank is not None:
+      volumeNode = segmentationNode.GetNodeReference(ARRIVAL_RANK_REFERENCE_ROLE + self.selectedSegmentId)
+      if volumeNode:
+        volumeNode.SetAttribute("FastMarching.SegmentVolume", str(self.marcher.value/self.marcher.maximum))
     self.originalSelectedSegmentLabelmap = None
+    # other grown segments already contain the result
+    self.originalOtherSegmentLabelmaps = {}
 
     self.reset()
     self.scriptedEffect.selectEffect("")
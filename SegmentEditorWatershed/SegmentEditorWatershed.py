@@ -28,3 +28,300 @@ class SegmentEditorWatershed(ScriptedLoadableModule):
     effectFilename = os.path.join(os.path.dirname(__file__), self.__class__.__name__+'Lib/SegmentEditorEffect.py')
     instance.setPythonSource(effectFilename.replace('\\','/'))
     instance.self().register()
+
+class SegmentEditorWatershedTest(ScriptedLoadableModuleTest):
+  """
+  This is the test case for your scripted module.
+  Uses ScriptedLoadableModuleTest base class, available at:
+  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  """
+
+  def setUp(self):
+    """ Do whatever is needed to reset the state - typically a scene clear will be enough.
+    """
+    slicer.mrmlScene.Clear(0)
+
+  def runTest(self):
+    """Run as few or as many tests as needed here.
+    """
+    self.setUp()
+    self.test_DownsampleUpsampleLabels()
+    self.test_IncrementalUpdateRegion()
+    self.test_FloodSuperpixelGraph()
+    self.test_FeatureImageCache()
+    self.test_PreviewTaskCancellation()
+
+  def getEffect(self):
+    """Returns the Watershed effect of a new segment editor widget"""
+    self.segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
+    self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
+    return self.segmentEditorWidget.effectByName("Watershed").self()
+
+  def test_DownsampleUpsampleLabels(self):
+    """Labels of the low resolution preview: each bin gets its largest label, the partial bins
+    at the end of the axes get the label of the nearest bin and the seeds are kept as they are.
+    """
+    self.delayDisplay("Starting test_DownsampleUpsampleLabels")
+    import numpy
+    effect = self.getEffect()
+
+    labels = numpy.zeros((4, 5, 6), dtype=numpy.int16)
+    labels[0, 0, 0] = 1
+    labels[1, 2, 3] = 2
+    # in the partial bin along y, ignored
+    labels[0, 4, 0] = 3
+    downsampled = effect.downsampleLabels(labels, (2, 2, 2))
+    self.assertEqual(downsampled.shape, (2, 2, 3))
+    self.assertEqual(downsampled[0, 0, 0], 1)
+    self.assertEqual(downsampled[0, 1, 1], 2)
+    self.assertEqual(numpy.count_nonzero(downsampled), 2)
+
+    seeds = numpy.zeros(labels.shape, dtype=numpy.int16)
+    seeds[3, 4, 5] = 1
+    upsampled = effect.upsampleLabels(downsampled, (2, 2, 2), seeds)
+    self.assertEqual(upsampled.shape, seeds.shape)
+    self.assertEqual(upsampled.dtype, downsampled.dtype)
+    numpy.testing.assert_array_equal(upsampled[0:2, 0:2, 0:2], 1)
+    numpy.testing.assert_array_equal(upsampled[0:2, 2:4, 2:4], 2)
+    # partial bin along y is filled from the last complete bin
+    numpy.testing.assert_array_equal(upsampled[0:2, 4, 2:4], 2)
+    self.assertEqual(upsampled[3, 4, 5], 1)
+    self.assertEqual(upsampled[3, 3, 5], 0)
+
+    self.delayDisplay("Test passed")
+
+  def test_IncrementalUpdateRegion(self):
+    """Region recomputed by the incremental update: the added seeds and the basins that they touch,
+    or the full segmentation if seeds were removed or the region would be too large.
+    """
+    self.delayDisplay("Starting test_IncrementalUpdateRegion")
+    import numpy
+    import SimpleITK as sitk
+    effect = self.getEffect()
+
+    # Small basin in the middle of a large one
+    basins = numpy.ones((20, 20, 20), dtype=numpy.int32)
+    basins[8:12, 8:12, 8:12] = 2
+    basinStatistics = sitk.LabelShapeStatisticsImageFilter()
+    basinStatistics.ComputePerimeterOff()
+    basinStatistics.Execute(sitk.GetImageFromArray(basins))
+
+    seeds = numpy.zeros(basins.shape, dtype=numpy.int16)
+    seeds[2, 2, 2] = 1
+    seeds[17, 17, 17] = 2
+    task = {"previewKey": "preview", "aborted": False}
+    previousState = {"key": "preview", "workingSeeds": seeds.copy(),
+      "basins": basins, "basinStatistics": basinStatistics}
+
+    self.assertEqual(effect.getIncrementalUpdateRegion(task, previousState, seeds, None), [])
+    otherTask = {"previewKey": "other", "aborted": False}
+    self.assertIsNone(effect.getIncrementalUpdateRegion(otherTask, previousState, seeds, None))
+
+    erasedSeeds = seeds.copy()
+    erasedSeeds[2, 2, 2] = 0
+    self.assertIsNone(effect.getIncrementalUpdateRegion(task, previousState, erasedSeeds, None))
+
+    # Seed added in the small basin: the whole basin and a margin around it is recomputed
+    addedSeeds = seeds.copy()
+    addedSeeds[10, 10, 10] = 1
+    region = effect.getIncrementalUpdateRegion(task, previousState, addedSeeds, None)
+    self.assertEqual(len(region), 3)
+    for axisRegion in region:
+      self.assertLess(axisRegion.start, 8)
+      self.assertGreater(axisRegion.stop, 12)
+      self.assertLess(axisRegion.stop - axisRegion.start, 20)
+
+    # Seed added in the large basin: the region would be most of the volume
+    addedSeeds = seeds.copy()
+    addedSeeds[0, 0, 10] = 1
+    self.assertIsNone(effect.getIncrementalUpdateRegion(task, previousState, addedSeeds, None))
+
+    self.delayDisplay("Test passed")
+
+  def createSuperpixelGraph(self, basins, edges):
+    """Superpixel graph in the format of computeSuperpixelGraph from a list of (basinA, basinB, strength)"""
+    import numpy
+    numberOfBasins = int(basins.max()) + 1
+    neighborLists = [[] for basin in range(numberOfBasins)]
+    for basinA, basinB, strength in edges:
+      neighborLists[basinA].append((basinB, strength))
+      neighborLists[basinB].append((basinA, strength))
+    offsets = numpy.zeros(numberOfBasins + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(neighborList) for neighborList in neighborLists])
+    neighbors = numpy.array([neighbor for neighborList in neighborLists for neighbor, strength in neighborList], dtype=numpy.int32)
+    strengths = numpy.array([strength for neighborList in neighborLists for neighbor, strength in neighborList], dtype=numpy.float32)
+    return {"key": None, "basins": basins, "offsets": offsets, "neighbors": neighbors, "strengths": strengths}
+
+  def test_FloodSuperpixelGraph(self):
+    """Basins get the label that reaches them through the lowest boundary along the whole path,
+    seeded basins get the label of most of their seeds.
+    """
+    self.delayDisplay("Starting test_FloodSuperpixelGraph")
+    import numpy
+    effect = self.getEffect()
+    task = {"aborted": False}
+
+    # Chain of basins 1-2-3-4. Basin 2 is next to seeded basin 1, but label 2 can reach it
+    # from basin 4 through lower boundaries.
+    basins = numpy.array([[[1, 1, 2, 3, 4]]], dtype=numpy.int32)
+    graph = self.createSuperpixelGraph(basins, [(1, 2, 5.0), (2, 3, 1.0), (3, 4, 4.0)])
+    seeds = numpy.array([[[1, 0, 0, 0, 2]]], dtype=numpy.int16)
+    labels = effect.floodSuperpixelGraph(task, graph, seeds)
+    numpy.testing.assert_array_equal(labels, [[[1, 1, 2, 2, 2]]])
+
+    # Label with most seeds in a basin wins, seeds are kept
+    basins = numpy.array([[[1, 1, 1, 2, 2]]], dtype=numpy.int32)
+    graph = self.createSuperpixelGraph(basins, [(1, 2, 1.0)])
+    seeds = numpy.array([[[2, 2, 1, 0, 0]]], dtype=numpy.int16)
+    labels = effect.floodSuperpixelGraph(task, graph, seeds)
+    numpy.testing.assert_array_equal(labels, [[[2, 2, 1, 2, 2]]])
+
+    # Basins that no label can reach stay empty
+    basins = numpy.array([[[1, 2, 3]]], dtype=numpy.int32)
+    graph = self.createSuperpixelGraph(basins, [(1, 2, 1.0)])
+    seeds = numpy.array([[[1, 0, 0]]], dtype=numpy.int16)
+    labels = effect.floodSuperpixelGraph(task, graph, seeds)
+    numpy.testing.assert_array_equal(labels, [[[1, 1, 0]]])
+
+    self.delayDisplay("Test passed")
+
+  def test_FeatureImageCache(self):
+    """Feature images are reused for the same source volume, clipped extent, source image and object scale.
+    Least recently used images are removed when the cache is full, the current image is always kept.
+    """
+    self.delayDisplay("Starting test_FeatureImageCache")
+    import numpy
+    import sys
+    import SimpleITK as sitk
+    from unittest import mock
+    effect = self.getEffect()
+    effect.clearFeatureImageCache()
+
+    # 1 MB images
+    key = ("vtkMRMLScalarVolumeNode1", (0, 63, 0, 63, 0, 63), 100, 2.0)
+    otherScaleKey = key[:3] + (3.0,)
+    otherSourceKey = key[:2] + (101,) + key[3:]
+    featureImages = {imageKey: sitk.Image([64, 64, 64], sitk.sitkFloat32) for imageKey in [key, otherScaleKey, otherSourceKey]}
+
+    self.assertIsNone(effect.getCachedFeatureImage(key))
+    effect.addFeatureImageToCache(key, featureImages[key])
+    self.assertIs(effect.getCachedFeatureImage(key), featureImages[key])
+    self.assertIsNone(effect.getCachedFeatureImage(otherScaleKey))
+    self.assertIsNone(effect.getCachedFeatureImage(otherSourceKey))
+
+    effectModule = sys.modules[type(effect).__module__]
+    with mock.patch.object(effectModule, "FEATURE_IMAGE_CACHE_SIZE_MB", 2):
+      effect.addFeatureImageToCache(otherScaleKey, featureImages[otherScaleKey])
+      self.assertEqual(list(effect.featureImageCache.keys()), [key, otherScaleKey])
+      # a hit makes the image the most recently used one, the other one is removed
+      self.assertIs(effect.getCachedFeatureImage(key), featureImages[key])
+      effect.addFeatureImageToCache(otherSourceKey, featureImages[otherSourceKey])
+      self.assertEqual(list(effect.featureImageCache.keys()), [key, otherSourceKey])
+      self.assertIsNone(effect.getCachedFeatureImage(otherScaleKey))
+
+      # the superpixel graph uses the same memory budget
+      effect.superpixelGraph = {"key": otherSourceKey, "basins": numpy.zeros((64, 64, 64), dtype=numpy.int32),
+        "offsets": numpy.zeros(1, dtype=numpy.int64), "neighbors": numpy.zeros(0, dtype=numpy.int32),
+        "strengths": numpy.zeros(0, dtype=numpy.float32)}
+      effect.addFeatureImageToCache(otherSourceKey, featureImages[otherSourceKey])
+      self.assertEqual(list(effect.featureImageCache.keys()), [otherSourceKey])
+
+    with mock.patch.object(effectModule, "FEATURE_IMAGE_CACHE_SIZE_MB", 0):
+      effect.addFeatureImageToCache(key, featureImages[key])
+      self.assertEqual(list(effect.featureImageCache.keys()), [key])
+      self.assertIs(effect.getCachedFeatureImage(key), featureImages[key])
+
+    effect.clearFeatureImageCache()
+    self.assertEqual(len(effect.featureImageCache), 0)
+    self.assertIsNone(effect.superpixelGraph)
+    self.assertIsNone(effect.getCachedFeatureImage(key))
+
+    self.delayDisplay("Test passed")
+
+  def createFinishedPreviewTask(self, state=None, error=None):
+    """Preview task whose thread has already stopped, in the format of startPreviewTask"""
+    import threading
+    task = {"featureImageKey": "features", "featureImage": "featureImage", "superpixelGraph": None,
+      "activeFilter": None, "aborted": False, "state": state, "error": error}
+    task["thread"] = threading.Thread(target=lambda: None)
+    task["thread"].start()
+    task["thread"].join()
+    return task
+
+  def test_PreviewTaskCancellation(self):
+    """Result of a cancelled or failed preview computation is never shown. A computation for new seeds
+    is only started when the cancelled one has stopped, and an outdated preview is not applied.
+    """
+    self.delayDisplay("Starting test_PreviewTaskCancellation")
+    import sys
+    import threading
+    from unittest import mock
+    effect = self.getEffect()
+    effect.cancelPreviewTask()
+    effect.abortedPreviewTask = None
+    effect.previewState = None
+    effect.clearFeatureImageCache()
+    previousState = {"key": "previous"}
+    newState = {"key": "new"}
+
+    with mock.patch.object(effect, "getPreviewNode", return_value="preview"), mock.patch.object(effect, "preview") as preview:
+      # a cancelled computation stops at the next step and does not store any result
+      task = {"previewKey": "preview", "aborted": True, "shrinkFactors": (1, 1, 1), "featureImage": "featureImage",
+        "seedImage": None, "seeds": None, "state": None, "error": None}
+      effect.runPreviewTask(task)
+      self.assertIsNone(task["state"])
+      self.assertIsNone(task["error"])
+
+      # seeds change while the cancelled computation is still running
+      effect.previewState = previousState
+      canStop = threading.Event()
+      abortedTask = self.createFinishedPreviewTask(state=newState)
+      abortedTask["thread"] = threading.Thread(target=canStop.wait)
+      abortedTask["thread"].daemon = True
+      abortedTask["thread"].start()
+      effect.previewTask = abortedTask
+      effect.startPreviewTask("preview", None, (1, 1, 1), None, None)
+      self.assertTrue(abortedTask["aborted"])
+      self.assertIsNone(effect.previewTask)
+      self.assertIs(effect.abortedPreviewTask, abortedTask)
+      self.assertTrue(effect.previewTaskPending)
+      effect.onPreviewTaskTimer()
+      preview.assert_not_called()
+
+      # the computation for the newest seeds is started when the cancelled one stops, its result is ignored
+      canStop.set()
+      abortedTask["thread"].join()
+      effect.onPreviewTaskTimer()
+      preview.assert_called_once()
+      self.assertIsNone(effect.abortedPreviewTask)
+      self.assertFalse(effect.previewTaskPending)
+      self.assertIs(effect.previewState, previousState)
+      self.assertEqual(len(effect.featureImageCache), 0)
+
+      # failed computation keeps the previous result
+      preview.reset_mock()
+      effect.previewTask = self.createFinishedPreviewTask(state=newState, error=RuntimeError("failed"))
+      effect.onPreviewTaskTimer()
+      preview.assert_not_called()
+      self.assertIsNone(effect.previewTask)
+      self.assertIs(effect.previewState, previousState)
+      self.assertIsNotNone(effect.previewTaskError)
+
+      # completed computation is shown
+      effect.previewTask = self.createFinishedPreviewTask(state=newState)
+      effect.onPreviewTaskTimer()
+      preview.assert_called_once()
+      self.assertIs(effect.previewState, newState)
+      self.assertEqual(effect.getCachedFeatureImage("features"), "featureImage")
+
+      # preview that is not computed for the current seeds at full resolution is not applied
+      effectModule = sys.modules[type(effect).__module__]
+      with mock.patch.object(effect, "waitForPreviewTask"), \
+          mock.patch.object(effectModule.slicer.util, "errorDisplay") as errorDisplay, \
+          mock.patch.object(effectModule.AbstractScriptedSegmentEditorAutoCompleteEffect, "onApply") as baseApply:
+        effect.onApply()
+        errorDisplay.assert_called_once()
+        baseApply.assert_not_called()
+
+    effect.clearFeatureImageCache()
+    self.delayDisplay("Test passed")
@@ -1,8 +1,20 @@
 import os
 import vtk, qt, ctk, slicer
 import logging
+import threading
+from collections import OrderedDict
 from SegmentEditorEffects import *
 
+# Maximum memory used for keeping feature images of previous previews and the superpixel graph (in megabytes)
+FEATURE_IMAGE_CACHE_SIZE_MB = 1024
+
+# Region that is recomputed by incremental update is grown by this many voxels around the changed seeds
+INCREMENTAL_UPDATE_MARGIN = 5
+
+# Full segmentation is recomputed if the region that incremental update would recompute
+# is larger than this fraction of the clipped volume
+INCREMENTAL_UPDATE_MAX_REGION_FRACTION = 0.5
+
 class SegmentEditorEffect(AbstractScriptedSegmentEditorAutoCompleteEffect):
   """This effect uses Watershed algorithm to partition the input volume"""
 
@@ -13,6 +25,36 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorAutoCompleteEffect):
     self.clippedMasterImageDataRequired = True # source volume intensities are used by this effect
     self.growCutFilter = None
 
+    # Gradient magnitude images computed from the clipped source volume, so that only the watershed
+    # has to be recomputed when the seeds change.
+    # (source volume ID, clipped extent, source image MTime, object scale) -> feature image.
+    # Least recently used item is the first.
+    self.featureImageCache = OrderedDict()
+
+    # Region adjacency graph of the catchment basins of the last feature image, used in superpixel mode
+    self.superpixelGraph = None
+
+    # Apply requires the result at full resolution
+    self.fullResolutionRequested = False
+
+    # Seeds and result of the last computed preview. Used for showing the result when it is computed
+    # and for updating only the region around changed seeds.
+    self.previewState = None
+    # The preview shows the result for the current seeds (not the previous result or the seeds while it is computed)
+    self.previewUpToDate = False
+    # Error of the last failed preview computation
+    self.previewTaskError = None
+
+    # Preview is computed in a background thread, this timer checks if it is completed
+    self.previewTask = None
+    # A cancelled computation may still be running until it reaches a point where it can stop.
+    # A new computation is only started after that, with the seeds that are current then.
+    self.abortedPreviewTask = None
+    self.previewTaskPending = False
+    self.previewTaskTimer = qt.QTimer()
+    self.previewTaskTimer.setInterval(100)
+    self.previewTaskTimer.connect('timeout()', self.onPreviewTaskTimer)
+
   def clone(self):
     import qSlicerSegmentationsEditorEffectsPythonQt as effects
     clonedEffect = effects.qSlicerSegmentEditorScriptedEffect(None)
@@ -35,7 +77,11 @@ Paint each seed with a different segment. Minimum two segments are required.</li
 <li>Click <dfn>Initialize</dfn> to compute preview of full segmentation.</li>
 <li>Browse through image slices. If previewed segmentation result is not correct then switch to
 Paint or other effects and add more seeds in the misclassified region. Full segmentation will be
-updated automatically within a few seconds</li>
+updated automatically within a few seconds, in the background while you keep editing. If <dfn>Incremental update</dfn> is enabled then
+only the region around added seeds is recomputed. Lower <dfn>Preview resolution</dfn> makes updates much faster
+for large volumes; the segmentation is always computed at full resolution when it is applied.
+In <dfn>Superpixels</dfn> mode the image is split into small regions once and seed changes only relabel these regions,
+which is almost instant.</li>
 <li>Click <dfn>Apply</dfn> to update segmentation with the previewed result.</li>
 </ul><p>
 The effect is different from the Grow from seeds effect in that smoothness of structures can be defined, which can prevent leakage.<p>
@@ -45,9 +91,17 @@ The effect uses <a href="https://itk.org/Doxygen/html/classitk_1_1MorphologicalW
 
   def reset(self):
     self.growCutFilter = None
+    self.cancelPreviewTask()
+    self.previewState = None
+    self.clearFeatureImageCache()
     AbstractScriptedSegmentEditorAutoCompleteEffect.reset(self)
     self.updateGUIFromMRML()
 
+  def deactivate(self):
+    AbstractScriptedSegmentEditorAutoCompleteEffect.deactivate(self)
+    self.cancelPreviewTask()
+    self.clearFeatureImageCache()
+
   def setupOptionsFrame(self):
     AbstractScriptedSegmentEditorAutoCompleteEffect.setupOptionsFrame(self)
 
@@ -62,9 +116,44 @@ The effect uses <a href="https://itk.org/Doxygen/html/classitk_1_1MorphologicalW
     self.scriptedEffect.addLabeledOptionsWidget("Object scale:", self.objectScaleMmSlider)
     self.objectScaleMmSlider.connect('valueChanged(double)', self.updateAlgorithmParameterFromGUI)
 
+    self.incrementalUpdateCheckBox = qt.QCheckBox()
+    self.incrementalUpdateCheckBox.setToolTip('When seeds are added, only recompute the region around the new seeds and the basins they touch.'
+      ' Much faster for small corrections in large volumes. Result may be slightly different from recomputing the full segmentation.'
+      ' Full segmentation is always recomputed when seeds are erased.')
+    self.scriptedEffect.addLabeledOptionsWidget("Incremental update:", self.incrementalUpdateCheckBox)
+    self.incrementalUpdateCheckBox.connect('toggled(bool)', self.updateAlgorithmParameterFromGUI)
+
+    self.superpixelsCheckBox = qt.QCheckBox()
+    self.superpixelsCheckBox.setToolTip('Split the image into catchment basins (superpixels) once, and grow the seeds over the graph'
+      ' of neighboring basins instead of the voxels. Segmentation is updated almost instantly when seeds are changed,'
+      ' but boundaries can only be placed between basins.')
+    self.scriptedEffect.addLabeledOptionsWidget("Superpixels:", self.superpixelsCheckBox)
+    self.superpixelsCheckBox.connect('toggled(bool)', self.updateAlgorithmParameterFromGUI)
+
+    self.previewShrinkFactorSelector = qt.QComboBox()
+    self.previewShrinkFactorSelector.addItem("Full", 1)
+    self.previewShrinkFactorSelector.addItem("1/2", 2)
+    self.previewShrinkFactorSelector.addItem("1/4", 4)
+    self.previewShrinkFactorSelector.setToolTip('Compute the preview on the source volume and seeds downsampled by this factor along each axis.'
+      ' Preview updates are much faster for large volumes, but small details may be missing.'
+      ' The segmentation is computed at full resolution when it is applied.')
+    self.previewShrinkFactorSelector.connect("currentIndexChanged(int)", self.updateAlgorithmParameterFromGUI)
+    self.refinePreviewWhenIdleCheckBox = qt.QCheckBox("Refine when idle")
+    self.refinePreviewWhenIdleCheckBox.setToolTip('When the low resolution preview is computed and the seeds are not changed,'
+      ' compute the preview at full resolution in the background.')
+    self.refinePreviewWhenIdleCheckBox.connect('toggled(bool)', self.updateAlgorithmParameterFromGUI)
+    previewResolutionFrame = qt.QHBoxLayout()
+    previewResolutionFrame.addWidget(self.previewShrinkFactorSelector)
+    previewResolutionFrame.addWidget(self.refinePreviewWhenIdleCheckBox)
+    self.scriptedEffect.addLabeledOptionsWidget("Preview resolution:", previewResolutionFrame)
+
   def setMRMLDefaults(self):
     AbstractScriptedSegmentEditorAutoCompleteEffect.setMRMLDefaults(self)
     self.scriptedEffect.setParameterDefault("ObjectScaleMm", 2.0)
+    self.scriptedEffect.setParameterDefault("IncrementalUpdate", 0)
+    self.scriptedEffect.setParameterDefault("Superpixels", 0)
+    self.scriptedEffect.setParameterDefault("PreviewShrinkFactor", 1)
+    self.scriptedEffect.setParameterDefault("RefinePreviewWhenIdle", 0)
 
   def updateGUIFromMRML(self):
     AbstractScriptedSegmentEditorAutoCompleteEffect.updateGUIFromMRML(self)
@@ -72,10 +161,30 @@ The effect uses <a href="https://itk.org/Doxygen/html/classitk_1_1MorphologicalW
     wasBlocked = self.objectScaleMmSlider.blockSignals(True)
     self.objectScaleMmSlider.value = abs(objectScaleMm)
     self.objectScaleMmSlider.blockSignals(wasBlocked)
+    wasBlocked = self.incrementalUpdateCheckBox.blockSignals(True)
+    self.incrementalUpdateCheckBox.checked = (self.scriptedEffect.integerParameter("IncrementalUpdate") != 0)
+    self.incrementalUpdateCheckBox.blockSignals(wasBlocked)
+    wasBlocked = self.superpixelsCheckBox.blockSignals(True)
+    self.superpixelsCheckBox.checked = (self.scriptedEffect.integerParameter("Superpixels") != 0)
+    self.superpixelsCheckBox.blockSignals(wasBlocked)
+    # seed changes are already fast in superpixel mode
+    self.incrementalUpdateCheckBox.enabled = not self.superpixelsCheckBox.checked
+    previewShrinkFactor = self.scriptedEffect.integerParameter("PreviewShrinkFactor")
+    wasBlocked = self.previewShrinkFactorSelector.blockSignals(True)
+    self.previewShrinkFactorSelector.setCurrentIndex(max(0, self.previewShrinkFactorSelector.findData(previewShrinkFactor)))
+    self.previewShrinkFactorSelector.blockSignals(wasBlocked)
+    wasBlocked = self.refinePreviewWhenIdleCheckBox.blockSignals(True)
+    self.refinePreviewWhenIdleCheckBox.checked = (self.scriptedEffect.integerParameter("RefinePreviewWhenIdle") != 0)
+    self.refinePreviewWhenIdleCheckBox.blockSignals(wasBlocked)
+    self.refinePreviewWhenIdleCheckBox.enabled = (previewShrinkFactor > 1)
 
   def updateMRMLFromGUI(self):
     AbstractScriptedSegmentEditorAutoCompleteEffect.updateMRMLFromGUI(self)
     self.scriptedEffect.setParameter("ObjectScaleMm", self.objectScaleMmSlider.value)
+    self.scriptedEffect.setParameter("IncrementalUpdate", 1 if self.incrementalUpdateCheckBox.checked else 0)
+    self.scriptedEffect.setParameter("Superpixels", 1 if self.superpixelsCheckBox.checked else 0)
+    self.scriptedEffect.setParameter("PreviewShrinkFactor", self.previewShrinkFactorSelector.currentData)
+    self.scriptedEffect.setParameter("RefinePreviewWhenIdle", 1 if self.refinePreviewWhenIdleCheckBox.checked else 0)
 
   def updateAlgorithmParameterFromGUI(self):
     self.updateMRMLFromGUI()
@@ -85,16 +194,9 @@ The effect uses <a href="https://itk.org/Doxygen/html/classitk_1_1MorphologicalW
       self.delayedAutoUpdateTimer.start()
 
   def computePreviewLabelmap(self, mergedImage, outputLabelmap):
-
-    import vtkSegmentationCorePython as vtkSegmentationCore
-    import vtkSlicerSegmentationsModuleLogicPython as vtkSlicerSegmentationsModuleLogic
-
-    # This can be a long operation - indicate it to the user
-    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
-
-    sourceVolumeNode = slicer.vtkMRMLScalarVolumeNode()
-    slicer.mrmlScene.AddNode(sourceVolumeNode)
-    slicer.vtkSlicerSegmentationsModuleLogic.CopyOrientedImageDataToVolumeNode(self.clippedMasterImageData, sourceVolumeNode)
+    """Shows the watershed result for the current seeds if it is already computed. Otherwise starts computing it
+    in the background and shows the previous result (or just the seeds) until the new result is available.
+    """
 
     mergedLabelmapNode = slicer.vtkMRMLLabelMapVolumeNode()
     slicer.mrmlScene.AddNode(mergedLabelmapNode)
@@ -104,23 +206,37 @@ The effect uses <a href="https://itk.org/Doxygen/html/classitk_1_1MorphologicalW
     mergedImage.GetImageToWorldMatrix(outputRasToIjk)
     outputExtent = mergedImage.GetExtent()
 
-    # Run segmentation algorithm
+    import numpy
     import SimpleITK as sitk
     import sitkUtils
     # Read input data from Slicer into SimpleITK
-    labelImage = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(mergedLabelmapNode.GetName()))
-    backgroundImage = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(sourceVolumeNode.GetName()))
-    # Run watershed filter
-    featureImage = sitk.GradientMagnitudeRecursiveGaussian(backgroundImage, float(self.scriptedEffect.doubleParameter("ObjectScaleMm")))
-    del backgroundImage
-    f = sitk.MorphologicalWatershedFromMarkersImageFilter()
-    f.SetMarkWatershedLine(False)
-    f.SetFullyConnected(False)
-    labelImage = f.Execute(featureImage, labelImage)
-    del featureImage
-    # Pixel type of watershed output is the same as the input. Convert it to int16 now.
-    if labelImage.GetPixelID() != sitk.sitkInt16:
-      labelImage = sitk.Cast(labelImage, sitk.sitkInt16)
+    seedImage = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(mergedLabelmapNode.GetName()))
+    seeds = sitk.GetArrayFromImage(seedImage)
+    # Label values of the merged image depend on the list of segments
+    inputKey = (self.getFeatureImageKey(), tuple(self.getVisibleSegmentIds()),
+      self.scriptedEffect.integerParameter("Superpixels") != 0)
+
+    previewState = self.previewState
+    sameInputs = (previewState is not None and previewState["inputKey"] == inputKey
+      and numpy.array_equal(previewState["seeds"], seeds))
+    shrinkFactors = self.getPreviewShrinkFactors(seeds.shape)
+    if self.fullResolutionRequested or (sameInputs and (previewState["shrinkFactors"] == (1, 1, 1)
+      or self.scriptedEffect.integerParameter("RefinePreviewWhenIdle") != 0)):
+      # keep or compute the full resolution result if the seeds have not changed
+      shrinkFactors = (1, 1, 1)
+    previewKey = (inputKey[0] + (shrinkFactors,),) + inputKey[1:]
+
+    self.previewUpToDate = sameInputs and previewState["key"] == previewKey
+    if self.previewUpToDate:
+      labelImage = sitk.GetImageFromArray(previewState["result"])
+    else:
+      self.startPreviewTask(previewKey, inputKey, shrinkFactors, seedImage, seeds)
+      if previewState is not None and previewState["inputKey"][1] == inputKey[1] and previewState["result"].shape == seeds.shape:
+        labelImage = sitk.GetImageFromArray(previewState["result"])
+      else:
+        labelImage = sitk.Cast(seedImage, sitk.sitkInt16)
+    labelImage.CopyInformation(seedImage)
+
     # Write result from SimpleITK to Slicer. This currently performs a deep copy of the bulk data.
     sitk.WriteImage(labelImage, sitkUtils.GetSlicerITKReadWriteAddress(mergedLabelmapNode.GetName()))
 
@@ -129,7 +245,493 @@ The effect uses <a href="https://itk.org/Doxygen/html/classitk_1_1MorphologicalW
     outputLabelmap.SetImageToWorldMatrix(outputRasToIjk)
     outputLabelmap.SetExtent(outputExtent)
 
-    slicer.mrmlScene.RemoveNode(sourceVolumeNode)
     slicer.mrmlScene.RemoveNode(mergedLabelmapNode)
 
-    qt.QApplication.restoreOverrideCursor()
+  def getPreviewShrinkFactors(self, shape):
+    """Downsampling factors of the preview along each axis of an image of the specified shape (in z, y, x order).
+    Axes that are too short are not downsampled."""
+    shrinkFactor = self.scriptedEffect.integerParameter("PreviewShrinkFactor")
+    return tuple([shrinkFactor if size >= 2 * shrinkFactor else 1 for size in shape])
+
+  def startPreviewTask(self, previewKey, inputKey, shrinkFactors, seedImage, seeds):
+    """Start computing the watershed result for the seeds in a background thread.
+    Computation of previous seeds is cancelled, as its result would not be shown anymore.
+    If a cancelled computation is still running then the preview is updated again when it stops.
+    """
+    self.cancelPreviewTask()
+    if self.abortedPreviewTask is not None:
+      self.previewTaskPending = True
+      self.previewTaskTimer.start()
+      return
+
+    featureImageKey = previewKey[0]
+    task = {
+      "previewKey": previewKey,
+      "inputKey": inputKey,
+      "shrinkFactors": shrinkFactors,
+      "seedImage": seedImage,
+      "seeds": seeds,
+      "featureImageKey": featureImageKey,
+      "featureImage": self.getCachedFeatureImage(featureImageKey),
+      "sourceImage": None,
+      "previousState": self.previewState if self.scriptedEffect.integerParameter("IncrementalUpdate") != 0 else None,
+      "superpixels": previewKey[2],
+      "superpixelGraph": None,
+      "activeFilter": None,
+      "aborted": False,
+      "state": None,
+      "error": None,
+      }
+    if task["superpixels"]:
+      task["previousState"] = None
+      if self.superpixelGraph is not None and self.superpixelGraph["key"] == featureImageKey:
+        task["superpixelGraph"] = self.superpixelGraph
+    if task["featureImage"] is None:
+      # MRML nodes can only be accessed from the main thread
+      import SimpleITK as sitk
+      import sitkUtils
+      clippedSourceVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+      slicer.mrmlScene.AddNode(clippedSourceVolumeNode)
+      slicer.vtkSlicerSegmentationsModuleLogic.CopyOrientedImageDataToVolumeNode(self.clippedMasterImageData, clippedSourceVolumeNode)
+      task["sourceImage"] = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(clippedSourceVolumeNode.GetName()))
+      slicer.mrmlScene.RemoveNode(clippedSourceVolumeNode)
+
+    self.previewTaskError = None
+    task["thread"] = threading.Thread(target=self.runPreviewTask, args=(task,))
+    task["thread"].daemon = True
+    self.previewTask = task
+    task["thread"].start()
+    self.previewTaskTimer.start()
+    slicer.util.showStatusMessage('Computing Watershed preview...')
+
+  def cancelPreviewTask(self):
+    """Abort the preview computation that is in progress. The thread is not waited for, its result is ignored."""
+    self.previewTaskPending = False
+    task = self.previewTask
+    if not task:
+      return
+    self.previewTask = None
+    task["aborted"] = True
+    activeFilter = task["activeFilter"]
+    if activeFilter:
+      activeFilter.Abort()
+    # tasks are only started when the previous aborted task has stopped
+    self.abortedPreviewTask = task
+
+  def waitForPreviewTask(self):
+    """Wait until the preview is computed for the current seeds and show it"""
+    while self.previewTask or self.previewTaskPending:
+      task = self.previewTask if self.previewTask else self.abortedPreviewTask
+      if task:
+        task["thread"].join()
+      self.onPreviewTaskTimer()
+
+  def onPreviewTaskTimer(self):
+    abortedTask = self.abortedPreviewTask
+    if abortedTask is not None and not abortedTask["thread"].is_alive():
+      self.abortedPreviewTask = None
+      if self.previewTaskPending:
+        # seeds have changed while the aborted computation was running
+        self.previewTaskPending = False
+        if self.getPreviewNode():
+          self.preview()
+    task = self.previewTask
+    if not task:
+      if self.abortedPreviewTask is None:
+        self.previewTaskTimer.stop()
+      return
+    if task["thread"].is_alive():
+      return
+    self.previewTaskTimer.stop()
+    self.previewTask = None
+    if task["error"]:
+      self.previewTaskError = task["error"]
+      logging.error('Watershed preview computation failed: {0}'.format(task["error"]))
+      slicer.util.showStatusMessage('Watershed preview computation failed', 2000)
+      return
+    if task["superpixelGraph"] is not None:
+      self.superpixelGraph = task["superpixelGraph"]
+    self.addFeatureImageToCache(task["featureImageKey"], task["featureImage"])
+    self.previewState = task["state"]
+    slicer.util.showStatusMessage('Watershed preview updated', 2000)
+    # Show the result. If seeds have changed since the computation was started
+    # then the computation is restarted with the newest seeds.
+    if self.getPreviewNode():
+      self.preview()
+
+  def onApply(self):
+    # Apply the full resolution result of the current seeds, not a result that is still being computed
+    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    self.delayedAutoUpdateTimer.stop()
+    self.fullResolutionRequested = True
+    self.previewUpToDate = False
+    try:
+      self.preview()
+      self.waitForPreviewTask()
+    finally:
+      self.fullResolutionRequested = False
+      qt.QApplication.restoreOverrideCursor()
+    if self.getPreviewNode() and not self.previewUpToDate:
+      # The preview shows a low resolution or outdated result, or just the seeds
+      message = 'Watershed segmentation could not be computed, segments were not modified.'
+      if self.previewTaskError:
+        message += '\n\n{0}'.format(self.previewTaskError)
+      slicer.util.errorDisplay(message)
+      return
+    AbstractScriptedSegmentEditorAutoCompleteEffect.onApply(self)
+
+  def runPreviewTask(self, task):
+    """Compute the watershed result of the task. Runs in a background thread,
+    so it must not access MRML or the effect state, only the task."""
+    try:
+      import SimpleITK as sitk
+      shrinkFactors = task["shrinkFactors"]
+      featureImage = task["featureImage"]
+      if featureImage is None:
+        sourceImage = task["sourceImage"]
+        if shrinkFactors != (1, 1, 1):
+          shrinkFilter = sitk.BinShrinkImageFilter()
+          # SimpleITK images are indexed in x, y, z order
+          shrinkFilter.SetShrinkFactors([int(factor) for factor in reversed(shrinkFactors)])
+          sourceImage = self.executeTaskFilter(task, shrinkFilter, sourceImage)
+        gradientFilter = sitk.GradientMagnitudeRecursiveGaussianImageFilter()
+        gradientFilter.SetSigma(task["featureImageKey"][3])
+        featureImage = self.executeTaskFilter(task, gradientFilter, sourceImage)
+        del sourceImage
+        task["featureImage"] = featureImage
+        task["sourceImage"] = None
+
+      # Watershed is computed at the resolution of the feature image
+      seeds = task["seeds"]
+      if shrinkFactors == (1, 1, 1):
+        workingSeedImage = task["seedImage"]
+        workingSeeds = seeds
+      else:
+        workingSeeds = self.downsampleLabels(seeds, shrinkFactors)
+        workingSeedImage = sitk.GetImageFromArray(workingSeeds)
+        workingSeedImage.CopyInformation(featureImage)
+      self.checkPreviewTaskAborted(task)
+
+      previousState = task["previousState"]
+      updateRegion = None
+      if previousState is not None:
+        updateRegion = self.getIncrementalUpdateRegion(task, previousState, workingSeeds, featureImage)
+      if task["superpixels"]:
+        # Basins and their graph only depend on the feature image, they are computed once
+        if task["superpixelGraph"] is None:
+          task["superpixelGraph"] = self.computeSuperpixelGraph(task, featureImage)
+          self.checkPreviewTaskAborted(task)
+        workingResult = self.floodSuperpixelGraph(task, task["superpixelGraph"], workingSeeds)
+        basins = None
+        basinStatistics = None
+      elif updateRegion is None:
+        # Run watershed filter on the full clipped volume
+        labelImage = self.runWatershed(task, featureImage, workingSeedImage)
+        # Pixel type of watershed output is the same as the input. Convert it to int16 now.
+        if labelImage.GetPixelID() != sitk.sitkInt16:
+          labelImage = sitk.Cast(labelImage, sitk.sitkInt16)
+        workingResult = sitk.GetArrayFromImage(labelImage)
+        basins = None
+        basinStatistics = None
+      else:
+        # the previous result may still be shown, so it is not modified
+        workingResult = previousState["workingResult"].copy()
+        if updateRegion:
+          self.updateResultInRegion(task, featureImage, workingSeeds, workingResult, updateRegion)
+        # else: seeds have not changed, the previous result is still valid
+        basins = previousState["basins"]
+        basinStatistics = previousState["basinStatistics"]
+
+      self.checkPreviewTaskAborted(task)
+      if shrinkFactors == (1, 1, 1):
+        result = workingResult
+      else:
+        result = self.upsampleLabels(workingResult, shrinkFactors, seeds)
+      task["state"] = {"key": task["previewKey"], "inputKey": task["inputKey"], "shrinkFactors": shrinkFactors,
+        "seeds": seeds, "result": result, "workingSeeds": workingSeeds, "workingResult": workingResult,
+        "basins": basins, "basinStatistics": basinStatistics}
+    except Exception as e:
+      if not task["aborted"]:
+        task["error"] = e
+
+  def downsampleLabels(self, labels, shrinkFactors):
+    """Downsample a label array (z, y, x order) the same way as BinShrinkImageFilter does,
+    but taking the largest label of each bin instead of the average. Voxels after the last complete bin are ignored."""
+    shape = [size // factor for size, factor in zip(labels.shape, shrinkFactors)]
+    bins = labels[:shape[0]*shrinkFactors[0], :shape[1]*shrinkFactors[1], :shape[2]*shrinkFactors[2]].reshape(
+      shape[0], shrinkFactors[0], shape[1], shrinkFactors[1], shape[2], shrinkFactors[2])
+    return bins.max(axis=(1, 3, 5))
+
+  def upsampleLabels(self, labels, shrinkFactors, seeds):
+    """Upsample a downsampled label array to the shape of the seeds. Voxels after the last complete bin
+    get the label of the nearest bin. Seeds are kept as they are."""
+    import numpy
+    upsampled = labels
+    for axis in range(3):
+      upsampled = numpy.repeat(upsampled, shrinkFactors[axis], axis=axis)
+    upsampled = numpy.pad(upsampled, [(0, seeds.shape[axis] - upsampled.shape[axis]) for axis in range(3)], mode='edge')
+    return numpy.where(seeds != 0, seeds, upsampled).astype(labels.dtype)
+
+  def checkPreviewTaskAborted(self, task):
+    """Stop the computation if the task was cancelled. Called between the steps that cannot be aborted."""
+    if task["aborted"]:
+      raise RuntimeError("Watershed preview computation aborted")
+
+  def executeTaskFilter(self, task, filter, *inputs):
+    """Execute a SimpleITK filter so that it can be aborted by cancelPreviewTask"""
+    self.checkPreviewTaskAborted(task)
+    task["activeFilter"] = filter
+    try:
+      return filter.Execute(*inputs)
+    finally:
+      task["activeFilter"] = None
+
+  def runWatershed(self, task, featureImage, markerImage):
+    import SimpleITK as sitk
+    f = sitk.MorphologicalWatershedFromMarkersImageFilter()
+    f.SetMarkWatershedLine(False)
+    f.SetFullyConnected(False)
+    return self.executeTaskFilter(task, f, featureImage, markerImage)
+
+  def getVisibleSegmentIds(self):
+    """Segments that are merged into the seed image, in the order of their label values"""
+    segmentationNode = self.scriptedEffect.parameterSetNode().GetSegmentationNode()
+    visibleSegmentIds = vtk.vtkStringArray()
+    segmentationNode.GetDisplayNode().GetVisibleSegmentIDs(visibleSegmentIds)
+    return [visibleSegmentIds.GetValue(index) for index in range(visibleSegmentIds.GetNumberOfValues())]
+
+  def getIncrementalUpdateRegion(self, task, previousState, seeds, featureImage):
+    """Returns the region (numpy slices in z, y, x order) that has to be recomputed after seeds were added:
+    the added seeds and the watershed basins (without markers) that they touch, grown by INCREMENTAL_UPDATE_MARGIN.
+    Returns an empty list if the seeds have not changed and None if the full segmentation has to be recomputed
+    (seeds were removed or the region would be too large).
+    """
+    if previousState["key"] != task["previewKey"] or previousState["workingSeeds"].shape != seeds.shape:
+      return None
+    import numpy
+    previousSeeds = previousState["workingSeeds"]
+    changed = seeds != previousSeeds
+    if numpy.any(changed & (previousSeeds != 0)):
+      # Seeds were erased or painted over: the region of the previous label may shrink anywhere,
+      # and the previous result around the changed region would keep growing it
+      logging.info('Watershed seeds were removed, recomputing full segmentation')
+      return None
+    changedVoxels = numpy.nonzero(changed)
+    if len(changedVoxels[0]) == 0:
+      return []
+    regionStart = [int(indices.min()) for indices in changedVoxels]
+    regionEnd = [int(indices.max())+1 for indices in changedVoxels]
+
+    # Seeds can take over the basins that they are in, so those are recomputed as well.
+    # Basins only depend on the feature image, they are computed once.
+    import SimpleITK as sitk
+    if previousState["basins"] is None:
+      basinImage = self.computeBasins(task, featureImage)
+      basinStatistics = sitk.LabelShapeStatisticsImageFilter()
+      basinStatistics.ComputePerimeterOff()
+      self.executeTaskFilter(task, basinStatistics, basinImage)
+      previousState["basins"] = sitk.GetArrayFromImage(basinImage)
+      previousState["basinStatistics"] = basinStatistics
+      self.checkPreviewTaskAborted(task)
+    basinStatistics = previousState["basinStatistics"]
+    for basin in numpy.unique(previousState["basins"][changedVoxels]):
+      if not basinStatistics.HasLabel(int(basin)):
+        continue
+      # bounding box is (x, y, z, size x, size y, size z)
+      boundingBox = basinStatistics.GetBoundingBox(int(basin))
+      for axis in range(3):
+        regionStart[2-axis] = min(regionStart[2-axis], boundingBox[axis])
+        regionEnd[2-axis] = max(regionEnd[2-axis], boundingBox[axis] + boundingBox[axis+3])
+
+    region = []
+    regionSize = 1
+    for axis in range(3):
+      start = max(regionStart[axis] - INCREMENTAL_UPDATE_MARGIN, 0)
+      end = min(regionEnd[axis] + INCREMENTAL_UPDATE_MARGIN, seeds.shape[axis])
+      region.append(slice(start, end))
+      regionSize *= end - start
+    if regionSize > seeds.size * INCREMENTAL_UPDATE_MAX_REGION_FRACTION:
+      logging.info('Watershed incremental update region is too large, recomputing full segmentation')
+      return None
+    return region
+
+  def computeBasins(self, task, featureImage):
+    """Catchment basins of the feature image (watershed without markers), labelled from 1"""
+    import SimpleITK as sitk
+    basinFilter = sitk.MorphologicalWatershedImageFilter()
+    basinFilter.SetLevel(0)
+    basinFilter.SetMarkWatershedLine(False)
+    basinFilter.SetFullyConnected(False)
+    return self.executeTaskFilter(task, basinFilter, featureImage)
+
+  def computeSuperpixelGraph(self, task, featureImage):
+    """Compute the catchment basins of the feature image and their region adjacency graph.
+    Strength of the boundary between two neighbor basins is the lowest feature value where the
+    two basins meet (the larger value of the two neighbor voxels), which is where flooding would cross it.
+    The graph is stored in compressed sparse row format: the neighbors of basin i are
+    neighbors[offsets[i]:offsets[i+1]], with the boundary strengths in the same positions of strengths.
+    All arrays are kept as numpy arrays of the smallest suitable type, as the graph is kept in memory.
+    """
+    import numpy
+    import SimpleITK as sitk
+    basins = sitk.GetArrayFromImage(self.computeBasins(task, featureImage)).astype(numpy.int32)
+    self.checkPreviewTaskAborted(task)
+    feature = sitk.GetArrayFromImage(featureImage)
+    numberOfBasins = int(basins.max()) + 1
+
+    # Boundary voxel pairs along each axis (basin index pairs are stored as a single int64 value)
+    edgeKeys = []
+    edgeStrengths = []
+    for axis in range(3):
+      lower = [slice(None)] * 3
+      upper = [slice(None)] * 3
+      lower[axis] = slice(None, -1)
+      upper[axis] = slice(1, None)
+      lowerBasins = basins[tuple(lower)]
+      upperBasins = basins[tuple(upper)]
+      boundary = lowerBasins != upperBasins
+      basinsA = lowerBasins[boundary].astype(numpy.int64)
+      basinsB = upperBasins[boundary].astype(numpy.int64)
+      edgeKeys.append(numpy.minimum(basinsA, basinsB) * numberOfBasins + numpy.maximum(basinsA, basinsB))
+      edgeStrengths.append(numpy.maximum(feature[tuple(lower)][boundary], feature[tuple(upper)][boundary]))
+      self.checkPreviewTaskAborted(task)
+    edgeKeys = numpy.concatenate(edgeKeys)
+    edgeStrengths = numpy.concatenate(edgeStrengths)
+
+    # Keep the weakest point of each boundary
+    order = numpy.lexsort((edgeStrengths, edgeKeys))
+    edgeKeys = edgeKeys[order]
+    edgeStrengths = edgeStrengths[order]
+    first = numpy.ones(len(edgeKeys), dtype=bool)
+    first[1:] = edgeKeys[1:] != edgeKeys[:-1]
+    edgeKeys = edgeKeys[first]
+    edgeStrengths = edgeStrengths[first].astype(numpy.float32)
+    basinsA = (edgeKeys // numberOfBasins).astype(numpy.int32)
+    basinsB = (edgeKeys % numberOfBasins).astype(numpy.int32)
+    self.checkPreviewTaskAborted(task)
+
+    # Each edge is stored in both directions
+    sources = numpy.concatenate((basinsA, basinsB))
+    order = numpy.argsort(sources, kind='stable')
+    neighbors = numpy.concatenate((basinsB, basinsA))[order]
+    strengths = numpy.concatenate((edgeStrengths, edgeStrengths))[order]
+    offsets = numpy.zeros(numberOfBasins + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum(numpy.bincount(sources, minlength=numberOfBasins))
+
+    logging.info('Watershed superpixel graph computed: {0} basins, {1} boundaries'.format(numberOfBasins - 1, len(edgeKeys)))
+    return {"key": task["featureImageKey"], "basins": basins,
+      "offsets": offsets, "neighbors": neighbors, "strengths": strengths}
+
+  def floodSuperpixelGraph(self, task, superpixelGraph, seeds):
+    """Label the basins by growing the seeds over the superpixel graph (same as the watershed but with basins
+    instead of voxels): each basin gets the label that can reach it through the lowest boundary, that is,
+    the label with the smallest maximum boundary strength along the path. A basin that contains seeds gets
+    the label that has most seed voxels in it. Returns the label array, with the seeds kept as they are.
+    The flooding is computed for all the basins of the front at once, by relaxing the edges of the basins
+    whose cost decreased in the previous iteration until no cost decreases anymore.
+    """
+    import numpy
+    basins = superpixelGraph["basins"]
+    offsets = superpixelGraph["offsets"]
+    neighbors = superpixelGraph["neighbors"]
+    strengths = superpixelGraph["strengths"]
+    numberOfBasins = len(offsets) - 1
+
+    # Label of seeded basins
+    seedVoxels = seeds != 0
+    numberOfLabels = int(seeds.max()) + 1
+    seedKeys = basins[seedVoxels].astype(numpy.int64) * numberOfLabels + seeds[seedVoxels]
+    seedKeys, seedCounts = numpy.unique(seedKeys, return_counts=True)
+    seedBasins = seedKeys // numberOfLabels
+    order = numpy.lexsort((-seedCounts, seedBasins))
+    seedBasins = seedBasins[order]
+    first = numpy.ones(len(seedBasins), dtype=bool)
+    first[1:] = seedBasins[1:] != seedBasins[:-1]
+    basinLabels = numpy.zeros(numberOfBasins, dtype=numpy.int16)
+    basinLabels[seedBasins[first]] = (seedKeys % numberOfLabels)[order][first]
+
+    # Cost of a basin is the highest boundary on the lowest path from a seeded basin
+    costs = numpy.full(numberOfBasins, numpy.inf, dtype=numpy.float32)
+    front = seedBasins[first]
+    costs[front] = 0
+    while len(front) > 0:
+      self.checkPreviewTaskAborted(task)
+      # all edges of the front basins
+      edgeCounts = offsets[front + 1] - offsets[front]
+      edgeStarts = numpy.repeat(offsets[front] - numpy.cumsum(edgeCounts) + edgeCounts, edgeCounts)
+      edges = edgeStarts + numpy.arange(len(edgeStarts))
+      sources = numpy.repeat(front, edgeCounts)
+      targets = neighbors[edges]
+      targetCosts = numpy.maximum(costs[sources], strengths[edges])
+      lower = targetCosts < costs[targets]
+      sources = sources[lower]
+      targets = targets[lower]
+      targetCosts = targetCosts[lower]
+      # keep the lowest cost of each target basin
+      order = numpy.lexsort((targetCosts, targets))
+      targets = targets[order]
+      first = numpy.ones(len(targets), dtype=bool)
+      first[1:] = targets[1:] != targets[:-1]
+      front = targets[first]
+      costs[front] = targetCosts[order][first]
+      basinLabels[front] = basinLabels[sources[order][first]]
+
+    labels = basinLabels[basins]
+    return numpy.where(seedVoxels, seeds, labels).astype(numpy.int16)
+
+  def updateResultInRegion(self, task, featureImage, seeds, result, region):
+    """Recompute the watershed in the region of the previous result. The previous result on the sides of
+    the region is used as seed, so that the recomputed region fits the rest of the segmentation.
+    """
+    import numpy
+    import SimpleITK as sitk
+    region = tuple(region)
+    boundary = result[region].copy()
+    inside = tuple(slice(1 if axisRegion.start > 0 else 0, -1 if axisRegion.stop < size else None)
+      for axisRegion, size in zip(region, seeds.shape))
+    boundary[inside] = 0
+    markers = numpy.where(seeds[region] != 0, seeds[region], boundary).astype(seeds.dtype)
+
+    # SimpleITK images are indexed in x, y, z order
+    regionFeatureImage = featureImage[region[2], region[1], region[0]]
+    markerImage = sitk.GetImageFromArray(markers)
+    markerImage.CopyInformation(regionFeatureImage)
+    result[region] = sitk.GetArrayFromImage(self.runWatershed(task, regionFeatureImage, markerImage))
+
+  def getFeatureImageKey(self):
+    """Parameters that the feature image depends on"""
+    sourceVolumeNode = self.scriptedEffect.parameterSetNode().GetSourceVolumeNode()
+    sourceImageData = self.scriptedEffect.sourceVolumeImageData()
+    return (sourceVolumeNode.GetID() if sourceVolumeNode else None,
+      tuple(self.clippedMasterImageData.GetExtent()),
+      sourceImageData.GetMTime() if sourceImageData else 0,
+      float(self.scriptedEffect.doubleParameter("ObjectScaleMm")))
+
+  def getCachedFeatureImage(self, key):
+    """Returns the gradient magnitude of the clipped source volume as a SimpleITK image,
+    if it has been computed already (None otherwise). Feature images are cached, as they do not depend on the seeds.
+    """
+    if key not in self.featureImageCache:
+      return None
+    self.featureImageCache.move_to_end(key)
+    return self.featureImageCache[key]
+
+  def addFeatureImageToCache(self, key, featureImage):
+    self.featureImageCache[key] = featureImage
+    self.featureImageCache.move_to_end(key)
+
+    # Remove least recently used images if the cache is too large (the current image is always kept).
+    # The superpixel graph is computed from one of the images, it uses the same memory budget.
+    def memorySizeKB(image):
+      return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent() / 1024
+    superpixelGraphSizeKB = 0
+    if self.superpixelGraph is not None:
+      superpixelGraphSizeKB = sum([self.superpixelGraph[name].nbytes for name in ["basins", "offsets", "neighbors", "strengths"]]) / 1024
+    while (len(self.featureImageCache) > 1
+      and sum([memorySizeKB(image) for image in self.featureImageCache.values()]) + superpixelGraphSizeKB > FEATURE_IMAGE_CACHE_SIZE_MB*1024):
+      self.featureImageCache.popitem(last=False)
+
+  def clearFeatureImageCache(self):
+    """Release the memory of the feature images and the superpixel graph, they are only reused while the seeds are edited"""
+    self.featureImageCache.clear()
+    self.superpixelGraph = None